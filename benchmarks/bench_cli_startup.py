@@ -0,0 +1,104 @@
+"""
+Benchmark the start-up time of the `mccell` command line.
+
+Runs a fresh interpreter several times per case and reports the median wall-clock
+time and which heavy modules (torch, pronto, pandas, cellxgene_census,
+tiledbsoma) were imported:
+
+  - `mccell <command> --help`: building the parser and dispatching.
+  - `import <module>`: the module each subcommand's handler imports, i.e. the
+    import overhead a SLURM task pays before doing any work.
+
+Usage:
+    python -m benchmarks.bench_cli_startup [--repeat 5]
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+from src.utils.paths import PROJECT_ROOT
+
+HEAVY_MODULES = ["torch", "pronto", "pandas", "cellxgene_census", "tiledbsoma"]
+
+COMMANDS = [
+    ["--help"],
+    ["cache-ontology", "--help"],
+    ["preprocess", "--help"],
+    ["snapshot-obs", "--help"],
+    ["filter-soma", "--help"],
+    ["download-h5ad", "--help"],
+    ["counts", "--help"],
+    ["hvg", "--help"],
+    ["export", "--help"],
+    ["train", "--help"],
+]
+
+HANDLER_MODULES = {
+    "cache-ontology": "src.data_pipeline.cache_ontology",
+    "preprocess": "src.data_pipeline.pipeline",
+    "snapshot-obs": "src.data_pipeline.obs_snapshot",
+    "filter-soma": "src.data_pipeline.soma_filter",
+    "download-h5ad": "src.data_pipeline.h5ad_download",
+    "counts": "src.data_pipeline.count_cube",
+    "hvg": "src.data_pipeline.genes",
+    "export": "src.data_pipeline.artifacts",
+    "train": "src.train.run",
+}
+
+_REPORT_HEAVY = f"print('HEAVY:' + ','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+
+_PARSE_PROBE = f"""
+import sys
+from src.cli import build_parser
+try:
+    build_parser().parse_args(sys.argv[1:])
+except SystemExit:
+    pass
+{_REPORT_HEAVY}
+"""
+
+_IMPORT_PROBE = f"""
+import importlib, sys
+try:
+    importlib.import_module(sys.argv[1])
+except ImportError as e:
+    print(f"(not importable here: {{e}})")
+{_REPORT_HEAVY}
+"""
+
+
+def _run(code, args):
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-c", code, *args],
+        cwd=PROJECT_ROOT, capture_output=True, text=True, check=True,
+    )
+    elapsed = time.perf_counter() - start
+    heavy = result.stdout.rsplit("HEAVY:", 1)[-1].strip()
+    return elapsed, heavy
+
+
+def _report(label, code, args, repeat):
+    timings = []
+    for _ in range(repeat):
+        elapsed, heavy = _run(code, args)
+        timings.append(elapsed)
+    print(f"{label:44s} {statistics.median(timings) * 1000:8.1f} ms   heavy imports: {heavy or 'none'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    _report("python -c pass", "import sys; " + _REPORT_HEAVY, [], args.repeat)
+    for command in COMMANDS:
+        _report("mccell " + " ".join(command), _PARSE_PROBE, command, args.repeat)
+    for command, module in HANDLER_MODULES.items():
+        _report(f"{command}: import {module}", _IMPORT_PROBE, [module], args.repeat)
+
+
+if __name__ == "__main__":
+    main()
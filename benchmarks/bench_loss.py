@@ -0,0 +1,136 @@
+"""
+Benchmark `MarginalizationLoss` against the dense formulation on ontologies of
+increasing size.
+
+Builds a random ontology DAG per `--terms` size (leaves are the terms
+without children, labels are drawn over all terms) and times forward plus
+backward of:
+
+  - dense: the ontology matrices as dense float32 tensors, a per-sample
+    `.item()` leaf mask, dense einsum and row gathers, weighted BCE.
+  - sparse: `MarginalizationLoss(fused=False)` (sparse CSR matrices, device-side leaf mask).
+  - fused: `MarginalizationLoss` (the parent loss as one autograd node).
+  - log: `MarginalizationLoss(log_space=True)` (logsumexp over each node's leaves).
+
+Reports the median time per step and the memory held by the ontology tensors.
+
+Usage:
+    python -m benchmarks.bench_loss [--terms 150 1000 3000] [--batch-size 256] [--device cuda:0]
+
+See `benchmarks.bench_parent_loss` for the memory of the sparse and fused parent losses.
+"""
+import argparse
+import statistics
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from src.data_pipeline.preprocess_ontology import ontology_matrices_from_closure
+from src.train.loss import MarginalizationLoss, _LabelRows
+
+
+def random_ontology(n_terms, second_parent=0.3, seed=0):
+    """
+    Returns (terms, leaf_values, internal_values, closure) of a random DAG in
+    which each term has a parent among the terms before it and, with
+    probability `second_parent`, a second one (like the Cell Ontology's
+    multiple inheritance).
+    """
+    rng = np.random.default_rng(seed)
+    closure = np.eye(n_terms, dtype=bool)
+    has_child = np.zeros(n_terms, dtype=bool)
+    for i in range(1, n_terms):
+        parents = rng.integers(0, i, size=2 if rng.random() < second_parent else 1)
+        closure[i] |= closure[parents].any(axis=0)
+        has_child[parents] = True
+    terms = [f"CL:{i:07d}" for i in range(n_terms)]
+    leaf_values = [t for t, c in zip(terms, has_child) if not c]
+    internal_values = [t for t, c in zip(terms, has_child) if c]
+    return terms, leaf_values, internal_values, closure
+
+
+def _dense_loss(tensors, outputs, y_batch, leaf_indices_set, leaf_weight=8.0):
+    marginalization, parent_child, exclusion = tensors
+    is_leaf_mask = torch.tensor([y.item() in leaf_indices_set for y in y_batch], device=outputs.device)
+    loss_leafs = torch.tensor(0.0, device=outputs.device)
+    if is_leaf_mask.any():
+        loss_leafs = F.cross_entropy(outputs[is_leaf_mask], y_batch[is_leaf_mask]) * leaf_weight
+    probs = torch.einsum('ij,kj->ki', marginalization, F.softmax(outputs, dim=1)).clamp(0, 1)
+    loss_parents = F.binary_cross_entropy(probs, parent_child[y_batch], weight=exclusion[y_batch])
+    return loss_leafs + loss_parents
+
+
+def _median_seconds(fn, device, repeat):
+    times = []
+    for i in range(repeat + 1):
+        start = time.perf_counter()
+        fn()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        if i > 0:
+            times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def _tensor_bytes(t):
+    if t.layout == torch.sparse_csr:
+        return sum(x.numel() * x.element_size() for x in (t.crow_indices(), t.col_indices(), t.values()))
+    return t.numel() * t.element_size()
+
+
+def _ontology_mb(loss_fn):
+    """Memory held by the tensors a `MarginalizationLoss` builds from the ontology."""
+    tensors = [t for t in vars(loss_fn).values() if isinstance(t, torch.Tensor)]
+    # Plus the index lists of the per-label rows (correction rows or target codes)
+    tensors += [t for rows in vars(loss_fn).values() if isinstance(rows, _LabelRows) for t in vars(rows).values()
+                if isinstance(t, torch.Tensor)]
+    return sum(_tensor_bytes(t) for t in tensors) / 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--terms", type=int, nargs="+", default=[150, 1000, 3000])
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--device", default=None)
+    args = parser.parse_args()
+
+    device = torch.device(args.device or ("cuda:0" if torch.cuda.is_available() else "cpu"))
+    for n_terms in args.terms:
+        terms, leaf_values, internal_values, closure = random_ontology(n_terms)
+        all_values = leaf_values + internal_values
+        mapping_dict = {t: i for i, t in enumerate(all_values)}
+        matrices = [df.values for df in ontology_matrices_from_closure(
+            closure, terms, all_values, leaf_values, internal_values)]
+        loss_fn = MarginalizationLoss(*matrices, leaf_values, internal_values, mapping_dict, device=device,
+                                      fused=False)
+        fused_loss_fn = MarginalizationLoss(*matrices, leaf_values, internal_values, mapping_dict, device=device)
+        log_loss_fn = MarginalizationLoss(*matrices, leaf_values, internal_values, mapping_dict, device=device,
+                                          log_space=True)
+        dense = [torch.as_tensor(m, dtype=torch.float32, device=device) for m in matrices]
+        leaf_indices_set = set(range(len(leaf_values)))
+
+        rng = np.random.default_rng(0)
+        outputs = torch.randn(args.batch_size, len(leaf_values), device=device, requires_grad=True)
+        y = torch.from_numpy(rng.integers(0, n_terms, args.batch_size)).to(device)
+        assert torch.allclose(loss_fn(outputs, y)[0], _dense_loss(dense, outputs, y, leaf_indices_set), rtol=1e-4)
+        assert torch.allclose(fused_loss_fn(outputs, y)[0], loss_fn(outputs, y)[0], rtol=1e-4)
+        assert torch.allclose(log_loss_fn(outputs, y)[0], loss_fn(outputs, y)[0], rtol=1e-4)
+
+        dense_seconds = _median_seconds(
+            lambda: _dense_loss(dense, outputs, y, leaf_indices_set).backward(), device, args.repeat)
+        sparse_seconds = _median_seconds(lambda: loss_fn(outputs, y)[0].backward(), device, args.repeat)
+        fused_seconds = _median_seconds(lambda: fused_loss_fn(outputs, y)[0].backward(), device, args.repeat)
+        log_seconds = _median_seconds(lambda: log_loss_fn(outputs, y)[0].backward(), device, args.repeat)
+        dense_mb = sum(_tensor_bytes(t) for t in dense) / 1e6
+        print(f"{n_terms:5d} terms ({len(leaf_values)} leaf, {len(internal_values)} internal): "
+              f"dense {dense_seconds * 1000:7.1f} ms, {dense_mb:7.1f} MB; "
+              f"sparse {sparse_seconds * 1000:7.1f} ms, {_ontology_mb(loss_fn):7.2f} MB; "
+              f"fused {fused_seconds * 1000:7.1f} ms, {_ontology_mb(fused_loss_fn):7.2f} MB; "
+              f"log {log_seconds * 1000:7.1f} ms, {_ontology_mb(log_loss_fn):7.2f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Benchmark batch normalization (library size, log1p, gene scaling, clipping).
+
+Starting from the CSR arrays of a batch, as a `ShardDataset` holds them:
+
+  - dense ops: densify, then one torch op per step on the dense batch
+    (sum, divide, multiply, log1p, divide by the gene deviations, clamp).
+  - csr kernel: `Normalizer.normalize_csr` on the non-zero values, then densify.
+
+Reports the median time per batch.
+
+Usage:
+    python -m benchmarks.bench_normalize [--genes 19000] [--density 0.05] [--batch-sizes 256 1024 4096]
+"""
+import argparse
+import statistics
+import time
+
+import numpy as np
+import torch
+
+from src.data_pipeline.normalize import Normalizer
+from benchmarks.bench_sparse_input import _random_csr, _dense_batch
+
+
+def _dense_ops(csr, n_genes, gene_std, target_sum, clip):
+    X = _dense_batch(*csr, n_genes)
+    X = X / X.sum(dim=1, keepdim=True).clamp_min(1) * target_sum
+    X = torch.log1p(X)
+    X = X / gene_std
+    return X.clamp(max=clip)
+
+
+def _csr_kernel(csr, n_genes, normalizer):
+    indptr, indices, data = csr
+    return _dense_batch(indptr, indices, normalizer.normalize_csr(indptr, indices, data), n_genes)
+
+
+def _median_seconds(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--genes", type=int, default=19_000)
+    parser.add_argument("--density", type=float, default=0.05)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[256, 1024, 4096])
+    parser.add_argument("--target-sum", type=float, default=1e4)
+    parser.add_argument("--clip", type=float, default=10.0)
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    gene_std = rng.uniform(0.5, 2.0, args.genes)
+    normalizer = Normalizer(target_sum=args.target_sum, gene_std=gene_std, clip=args.clip)
+    gene_std = torch.from_numpy(gene_std.astype(np.float32))
+    print(f"{args.genes} genes, density {args.density}, {torch.get_num_threads()} threads")
+    for batch_size in args.batch_sizes:
+        csr = _random_csr(rng, batch_size, args.genes, args.density)
+        expected = _dense_ops(csr, args.genes, gene_std, args.target_sum, args.clip)
+        assert torch.allclose(_csr_kernel(csr, args.genes, normalizer), expected, atol=1e-4)
+        dense = _median_seconds(lambda: _dense_ops(csr, args.genes, gene_std, args.target_sum, args.clip),
+                                args.repeat)
+        kernel = _median_seconds(lambda: _csr_kernel(csr, args.genes, normalizer), args.repeat)
+        print(f"batch {batch_size:5d}: dense ops {dense * 1000:7.1f} ms, csr kernel {kernel * 1000:7.1f} ms "
+              f"({dense / kernel:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
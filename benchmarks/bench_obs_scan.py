@@ -0,0 +1,100 @@
+"""
+Benchmark the single-pass obs scan against the previous two-query approach.
+
+Census is not needed: a synthetic obs table is streamed as Arrow tables with a
+dictionary-encoded cell type column, like the SOMA reader returns them. The
+value filter is treated as already pushed down, i.e. the synthetic table holds
+only the matching cells. Each method runs in a fresh interpreter and reports its
+wall-clock time and peak RSS:
+
+  - legacy: read the whole cell type column into pandas, value_counts(), then
+    read it again for the selected cell types (the old `load_filtered_cell_metadata`).
+  - scan: `scan_cell_types`, counting on dictionary codes and keeping only the
+    `soma_joinid`s and codes of the selected cells.
+
+Usage:
+    python -m benchmarks.bench_obs_scan [--cells 20000000] [--cell-types 700]
+"""
+import argparse
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+BATCH_SIZE = 1 << 20
+
+
+class SyntheticObs:
+    """Streams a synthetic obs table in batches, like `tiledbsoma.DataFrame.read`."""
+
+    def __init__(self, n_cells, n_cell_types, seed=0):
+        rng = np.random.default_rng(seed)
+        # A few cell types hold most cells, as in Census
+        weights = rng.pareto(1.0, n_cell_types) + 1e-3
+        self.cell_types = np.array([f"CL:{i:07d}" for i in range(n_cell_types)])
+        self.codes = rng.choice(n_cell_types, size=n_cells, p=weights / weights.sum()).astype(np.int32)
+
+    def read(self, value_filter=None, column_names=None):
+        import pyarrow as pa
+
+        dictionary = pa.array(self.cell_types)
+        for start in range(0, len(self.codes), BATCH_SIZE):
+            codes = self.codes[start:start + BATCH_SIZE]
+            yield pa.table({
+                "soma_joinid": pa.array(np.arange(start, start + len(codes), dtype=np.int64)),
+                "cell_type_ontology_term_id": pa.DictionaryArray.from_arrays(pa.array(codes), dictionary),
+            })
+
+
+def _legacy(obs, keep, min_cell_count):
+    import pyarrow as pa
+
+    exp_pd = pa.concat_tables(obs.read()).to_pandas()
+    exp_pd["cell_type_ontology_term_id"] = exp_pd["cell_type_ontology_term_id"].astype(str)
+    counts = exp_pd["cell_type_ontology_term_id"].value_counts()
+    selected = set(counts[counts > min_cell_count].index) & keep
+    del exp_pd
+    metadata = pa.concat_tables(obs.read()).to_pandas()
+    metadata["cell_type_ontology_term_id"] = metadata["cell_type_ontology_term_id"].astype(str)
+    return metadata[metadata["cell_type_ontology_term_id"].isin(selected)]
+
+
+def _scan(obs, keep, min_cell_count):
+    from src.data_pipeline.data_loader import scan_cell_types
+
+    soma_joinids, codes, categories, counts = scan_cell_types(obs, keep)
+    selected = np.array([c > min_cell_count and t in keep for t, c in zip(categories, counts)])
+    return soma_joinids[selected[codes]]
+
+
+def _run_method(method, n_cells, n_cell_types):
+    obs = SyntheticObs(n_cells, n_cell_types)
+    keep = set(obs.cell_types[::2])
+    start = time.perf_counter()
+    result = (_legacy if method == "legacy" else _scan)(obs, keep, min_cell_count=5000)
+    elapsed = time.perf_counter() - start
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{method:8s} {elapsed:8.2f} s   peak RSS {peak_mb:8.0f} MB   {len(result)} cells selected")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cells", type=int, default=20_000_000)
+    parser.add_argument("--cell-types", type=int, default=700)
+    parser.add_argument("--method", choices=["legacy", "scan"], default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.method:
+        _run_method(args.method, args.cells, args.cell_types)
+        return
+
+    print(f"{args.cells} cells, {args.cell_types} cell types")
+    for method in ["legacy", "scan"]:
+        subprocess.run([sys.executable, "-m", "benchmarks.bench_obs_scan", "--method", method,
+                        "--cells", str(args.cells), "--cell-types", str(args.cell_types)], check=True)
+
+
+if __name__ == "__main__":
+    main()
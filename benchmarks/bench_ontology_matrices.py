@@ -0,0 +1,82 @@
+"""
+Benchmark the per-term ontology matrix builders against the single-closure builder.
+
+Selects every CL descendant of a root term (the hematopoietic subtree by default,
+or the whole ontology with --root CL:0000000), splits it into leaf and internal
+nodes like `preprocess_data_ontology`, then times:
+
+  - legacy: build_marginalization_df + build_parent_child_mask + build_exclusion_df
+  - closure (pronto): build_ontology_matrices on the pronto.Ontology
+  - closure (index): build_ontology_matrices on the memory-mapped OntologyIndex
+
+and checks that all three produce identical DataFrames.
+
+Usage:
+    python -m benchmarks.bench_ontology_matrices [--root CL:0000988] [--skip-legacy]
+"""
+import argparse
+import time
+
+import pandas as pd
+
+from src.utils.ontology_utils import load_ontology, load_ontology_index
+from src.data_pipeline.preprocess_ontology import (
+    build_marginalization_df,
+    build_parent_child_mask,
+    build_exclusion_df,
+    build_ontology_matrices,
+)
+
+
+def _timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--root", default="CL:0000988", help="Root CL ID of the subtree to build matrices for.")
+    parser.add_argument("--skip-legacy", action="store_true", help="Skip the slow per-term builders.")
+    args = parser.parse_args()
+
+    cl = load_ontology()
+    if cl is None:
+        return
+    index = load_ontology_index()
+
+    terms = sorted(t.id for t in cl[args.root].subclasses(with_self=True) if t.id.startswith("CL"))
+    leaf_values = [t for t in terms if cl[t].is_leaf()]
+    internal_values = [t for t in terms if not cl[t].is_leaf()]
+    all_cell_values = leaf_values + internal_values
+    print(f"{len(all_cell_values)} terms under {args.root}: {len(leaf_values)} leaf, {len(internal_values)} internal")
+
+    results = {}
+    if not args.skip_legacy:
+        results["legacy"], elapsed = _timed(lambda: (
+            build_marginalization_df(internal_values, leaf_values, cl),
+            build_parent_child_mask(all_cell_values, internal_values, cl, include_self=True),
+            build_exclusion_df(all_cell_values, internal_values, cl),
+        ))
+        print(f"  legacy per-term builders: {elapsed:8.3f} s")
+
+    results["closure (pronto)"], elapsed = _timed(
+        lambda: build_ontology_matrices(all_cell_values, leaf_values, internal_values, cl)
+    )
+    print(f"  closure (pronto):         {elapsed:8.3f} s")
+
+    if index is not None:
+        results["closure (index)"], elapsed = _timed(
+            lambda: build_ontology_matrices(all_cell_values, leaf_values, internal_values, index)
+        )
+        print(f"  closure (index):          {elapsed:8.3f} s")
+
+    reference_name, reference = next(iter(results.items()))
+    for name, matrices in results.items():
+        for ref_df, df in zip(reference, matrices):
+            pd.testing.assert_frame_equal(ref_df, df)
+        print(f"  {name} matches {reference_name}")
+
+
+if __name__ == "__main__":
+    main()
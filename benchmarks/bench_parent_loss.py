@@ -0,0 +1,93 @@
+"""
+Benchmark the fused parent loss of `MarginalizationLoss` against the unfused one
+across batch sizes and ontology sizes.
+
+For each random ontology DAG (see `benchmarks.bench_loss`) and batch size, runs
+forward plus backward of:
+
+  - unfused: `MarginalizationLoss(fused=False)`, whose parent loss is a chain of
+    autograd ops (sparse marginalization, clamp, two BCEs, sparse corrections).
+  - fused: `MarginalizationLoss`, whose parent loss is one autograd node.
+
+Reports the median time per step, the memory autograd keeps for backward
+(distinct saved tensors, on any device) and, on CUDA, the peak memory
+allocated during the step.
+
+Usage:
+    python -m benchmarks.bench_parent_loss [--terms 150 1000 3000] [--batch-sizes 256 1024 4096] [--device cuda:0]
+"""
+import argparse
+
+import numpy as np
+import torch
+
+from benchmarks.bench_loss import _median_seconds, random_ontology
+from src.data_pipeline.preprocess_ontology import ontology_matrices_from_closure
+from src.train.loss import MarginalizationLoss
+
+
+def _saved_mb(fn):
+    """Memory of the distinct tensors autograd saves for backward while `fn` runs its forward."""
+    saved = {}
+
+    def pack(t):
+        # Sparse tensors saved by the matmuls are the ontology matrices, not activations
+        if t.layout == torch.strided:
+            saved[t.untyped_storage().data_ptr()] = t.untyped_storage().nbytes()
+        return t
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        loss = fn()
+    loss.backward()
+    return sum(saved.values()) / 1e6
+
+
+def _peak_mb(fn, device):
+    """Peak CUDA memory allocated during forward plus backward, above what was allocated before."""
+    torch.cuda.synchronize(device)
+    start = torch.cuda.memory_allocated(device)
+    torch.cuda.reset_peak_memory_stats(device)
+    fn().backward()
+    torch.cuda.synchronize(device)
+    return (torch.cuda.max_memory_allocated(device) - start) / 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--terms", type=int, nargs="+", default=[150, 1000, 3000])
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[256, 1024, 4096])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--device", default=None)
+    args = parser.parse_args()
+
+    device = torch.device(args.device or ("cuda:0" if torch.cuda.is_available() else "cpu"))
+    for n_terms in args.terms:
+        terms, leaf_values, internal_values, closure = random_ontology(n_terms)
+        all_values = leaf_values + internal_values
+        mapping_dict = {t: i for i, t in enumerate(all_values)}
+        matrices = [df.values for df in ontology_matrices_from_closure(
+            closure, terms, all_values, leaf_values, internal_values)]
+        losses = {
+            "unfused": MarginalizationLoss(*matrices, leaf_values, internal_values, mapping_dict, device=device,
+                                           fused=False),
+            "fused": MarginalizationLoss(*matrices, leaf_values, internal_values, mapping_dict, device=device),
+        }
+        print(f"{n_terms} terms ({len(leaf_values)} leaf, {len(internal_values)} internal):")
+
+        rng = np.random.default_rng(0)
+        for batch_size in args.batch_sizes:
+            outputs = torch.randn(batch_size, len(leaf_values), device=device, requires_grad=True)
+            y = torch.from_numpy(rng.integers(0, n_terms, batch_size)).to(device)
+            results = []
+            for name, loss_fn in losses.items():
+                step = lambda: loss_fn(outputs, y)[0]
+                seconds = _median_seconds(lambda: step().backward(), device, args.repeat)
+                result = f"{name} {seconds * 1000:7.1f} ms, {_saved_mb(step):7.2f} MB saved"
+                if device.type == "cuda":
+                    result += f", {_peak_mb(step, device):7.2f} MB peak"
+                results.append(result)
+            print(f"  batch {batch_size:5d}: " + "; ".join(results))
+
+
+if __name__ == "__main__":
+    main()
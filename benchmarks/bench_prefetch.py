@@ -0,0 +1,83 @@
+"""
+Benchmark the training loop with and without background prefetching.
+
+Simulates a data source that blocks for `--read-ms` per batch (standing in for
+a TileDB read; the sleep releases the GIL like the reader does) and yields
+random count batches, then runs `SimpleNN` training steps on them:
+
+  - serial: fetch, log1p and the step one after the other on the main thread.
+  - prefetch: the same batches through `Prefetcher` with `prepare_batch`, so the
+    fetch and log1p of the next batches overlap the current step.
+
+Reports the time per step and the share of it spent waiting on data.
+
+Usage:
+    python -m benchmarks.bench_prefetch [--read-ms 50] [--batches 40] [--depth 2] [--workers 1]
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from src.train.model import SimpleNN
+from src.train.prefetch import Prefetcher, prepare_batch
+
+
+def _source(n_batches, batch_size, n_genes, n_classes, read_seconds, seed=0):
+    rng = np.random.default_rng(seed)
+    for _ in range(n_batches):
+        time.sleep(read_seconds)
+        X = rng.poisson(0.3, size=(batch_size, n_genes)).astype(np.float32)
+        yield torch.from_numpy(X), torch.from_numpy(rng.integers(0, n_classes, batch_size))
+
+
+def _run(batches, model, device):
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+    loss_fn = torch.nn.CrossEntropyLoss()
+    data_seconds = 0.0
+    n = 0
+    start = step_end = time.perf_counter()
+    for X, y in batches:
+        data_seconds += time.perf_counter() - step_end
+        X, y = X.to(device, non_blocking=True), y.to(device, non_blocking=True)
+        optimizer.zero_grad()
+        loss_fn(model(X), y).backward()
+        optimizer.step()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        n += 1
+        step_end = time.perf_counter()
+    return (time.perf_counter() - start) / n, data_seconds / n
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--read-ms", type=float, default=50.0)
+    parser.add_argument("--batches", type=int, default=40)
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--genes", type=int, default=5000)
+    parser.add_argument("--classes", type=int, default=100)
+    parser.add_argument("--depth", type=int, default=2)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--device", default=None)
+    args = parser.parse_args()
+
+    device = torch.device(args.device or ("cuda:0" if torch.cuda.is_available() else "cpu"))
+    print(f"{args.genes} genes, batch {args.batch_size}, {args.read_ms:.0f} ms per read, device {device}")
+    source_args = (args.batches, args.batch_size, args.genes, args.classes, args.read_ms / 1000)
+    runs = [
+        ("serial", lambda: map(prepare_batch, _source(*source_args))),
+        ("prefetch", lambda: Prefetcher(_source(*source_args), prepare_batch, depth=args.depth,
+                                        workers=args.workers, pin_memory=device.type == "cuda")),
+    ]
+    for name, make_batches in runs:
+        torch.manual_seed(0)
+        model = SimpleNN(args.genes, args.classes).to(device)
+        step_seconds, data_seconds = _run(make_batches(), model, device)
+        print(f"{name:8s}: {step_seconds * 1000:7.1f} ms/step, {data_seconds * 1000:7.1f} ms waiting on data "
+              f"({100 * data_seconds / step_seconds:3.0f}%)")
+
+
+if __name__ == "__main__":
+    main()
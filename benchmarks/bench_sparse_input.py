@@ -0,0 +1,94 @@
+"""
+Benchmark dense vs sparse CSR input to `SimpleNN`.
+
+Builds random count batches with the sparsity of 10x data and times one training
+step of `SimpleNN` (forward, backward, Adam update) per batch, starting from the
+CSR arrays a `ShardDataset` holds:
+
+  - dense: densify, log1p on the dense batch, move to the device, dense first layer.
+  - sparse: wrap as a CSR tensor, log1p on the non-zero values, move to the
+    device, sparse-dense matmul in the first layer.
+
+Reports the median step time and the bytes moved to the device per batch.
+
+Usage:
+    python -m benchmarks.bench_sparse_input [--genes 19000] [--density 0.05] [--batch-sizes 256 1024]
+"""
+import argparse
+import statistics
+import time
+
+import numpy as np
+import torch
+
+from src.train.data import log1p
+from src.train.model import SimpleNN
+
+
+def _random_csr(rng, n_cells, n_genes, density):
+    nnz_per_cell = rng.binomial(n_genes, density, size=n_cells)
+    indptr = np.concatenate([[0], np.cumsum(nnz_per_cell)]).astype(np.int64)
+    indices = np.concatenate([np.sort(rng.choice(n_genes, k, replace=False)) for k in nnz_per_cell])
+    data = rng.integers(1, 30, size=indptr[-1]).astype(np.uint16)
+    return indptr, indices.astype(np.uint16), data
+
+
+def _dense_batch(indptr, indices, data, n_genes):
+    X = np.zeros((len(indptr) - 1, n_genes), dtype=np.float32)
+    X[np.repeat(np.arange(len(indptr) - 1), np.diff(indptr)), indices] = data
+    return torch.from_numpy(X)
+
+
+def _sparse_batch(indptr, indices, data, n_genes):
+    return torch.sparse_csr_tensor(torch.from_numpy(indptr), torch.from_numpy(indices.astype(np.int64)),
+                                   torch.from_numpy(data.astype(np.float32)), size=(len(indptr) - 1, n_genes))
+
+
+def _time_steps(model, make_batch, csr, y, device, repeat):
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+    loss_fn = torch.nn.CrossEntropyLoss()
+    times = []
+    n_bytes = 0
+    for i in range(repeat + 1):
+        start = time.perf_counter()
+        X = log1p(make_batch(*csr)).to(device)
+        optimizer.zero_grad()
+        loss = loss_fn(model(X), y)
+        loss.backward()
+        optimizer.step()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        if i > 0:  # the first step warms up
+            times.append(time.perf_counter() - start)
+        n_bytes = (X.values().nbytes + X.crow_indices().nbytes + X.col_indices().nbytes
+                   if X.layout == torch.sparse_csr else X.nbytes)
+    return statistics.median(times), n_bytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--genes", type=int, default=19_000)
+    parser.add_argument("--density", type=float, default=0.05)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[256, 1024])
+    parser.add_argument("--classes", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--device", default=None)
+    args = parser.parse_args()
+
+    device = torch.device(args.device or ("cuda:0" if torch.cuda.is_available() else "cpu"))
+    rng = np.random.default_rng(0)
+    print(f"{args.genes} genes, density {args.density}, device {device}, {torch.get_num_threads()} threads")
+    for batch_size in args.batch_sizes:
+        csr = _random_csr(rng, batch_size, args.genes, args.density)
+        y = torch.from_numpy(rng.integers(0, args.classes, batch_size)).to(device)
+        for name, make_batch in [("dense", _dense_batch), ("sparse", _sparse_batch)]:
+            torch.manual_seed(0)
+            model = SimpleNN(args.genes, args.classes).to(device)
+            seconds, n_bytes = _time_steps(model, lambda *a: make_batch(*a, args.genes), csr, y, device,
+                                           args.repeat)
+            print(f"batch {batch_size:5d}  {name:6s}: {seconds * 1000:8.1f} ms/step  "
+                  f"{batch_size / seconds:8.0f} cells/s  {n_bytes / 1e6:7.1f} MB to device")
+
+
+if __name__ == "__main__":
+    main()
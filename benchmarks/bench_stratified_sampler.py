@@ -0,0 +1,97 @@
+"""
+Benchmark the reads and label coverage of the stratified block sampler against
+a global shuffle.
+
+Lays out synthetic cells like a Census experiment: cells are grouped by dataset,
+and each dataset stores its cells mostly grouped by cell type, with a skewed
+(Zipf) label distribution over the terms of an artifact bundle. Then draws
+batches until every label has been seen `--min-cells` times (or `--max-batches`
+is reached):
+
+  - shuffle: batches of uniformly random cells (`ExperimentDataset(shuffle=True)`).
+  - stratified: `StratifiedBlockSampler` batches.
+
+Reports the batches drawn, the reads per batch (runs of consecutive cells) and
+the X tiles per batch of `--tile-cells` rows they touch, and the labels still
+short of `--min-cells`.
+
+Usage:
+    python -m benchmarks.bench_stratified_sampler --bundle data/processed/2025-10-17_bundle [--cells 2000000]
+"""
+import argparse
+
+import numpy as np
+
+from src.data_pipeline.artifacts import load_artifact_bundle
+from src.train.sampler import StratifiedBlockSampler, count_runs
+
+
+def _synthetic_labels(rng, n_cells, n_labels, n_datasets, zipf):
+    """Label of each cell in storage order: per dataset, runs of one label with some interleaving."""
+    p = 1.0 / np.arange(1, n_labels + 1) ** zipf
+    p = p[rng.permutation(n_labels)] / p.sum()
+    sizes = rng.multinomial(n_cells, rng.dirichlet(np.ones(n_datasets)))
+    labels = []
+    for size in sizes:
+        present = rng.choice(n_labels, size=min(n_labels, 20), replace=False, p=p)
+        dataset = rng.choice(present, size=size, p=p[present] / p[present].sum())
+        dataset.sort()
+        # Interleave 10% of the cells, as clusters rarely follow annotations exactly
+        swap = rng.random(size) < 0.1
+        dataset[swap] = rng.permutation(dataset[swap])
+        labels.append(dataset)
+    return np.concatenate(labels)
+
+
+def _run(batches, labels, n_labels, min_cells, max_batches, tile_cells):
+    seen = np.zeros(n_labels, dtype=np.int64)
+    runs, tiles = [], []
+    n_batches = 0
+    need = np.bincount(labels, minlength=n_labels) > 0
+    for batch in batches:
+        n_batches += 1
+        seen += np.bincount(labels[batch], minlength=n_labels)
+        runs.append(count_runs(batch))
+        tiles.append(len(np.unique(batch // tile_cells)))
+        if (seen[need] >= min_cells).all() or n_batches == max_batches:
+            break
+    short = int((seen[need] < min_cells).sum())
+    return n_batches, float(np.mean(runs)), float(np.mean(tiles)), short
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bundle", required=True, help="Artifact bundle providing the hierarchy.")
+    parser.add_argument("--cells", type=int, default=2_000_000)
+    parser.add_argument("--datasets", type=int, default=50)
+    parser.add_argument("--zipf", type=float, default=1.5)
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--block-cells", type=int, default=32)
+    parser.add_argument("--min-cells", type=int, default=100)
+    parser.add_argument("--max-batches", type=int, default=20_000)
+    parser.add_argument("--tile-cells", type=int, default=2048)
+    args = parser.parse_args()
+
+    bundle = load_artifact_bundle(args.bundle)
+    n_labels = len(bundle.terms)
+    rng = np.random.default_rng(0)
+    labels = _synthetic_labels(rng, args.cells, n_labels, args.datasets, args.zipf)
+    counts = np.bincount(labels, minlength=n_labels)
+    print(f"{args.cells} cells, {int((counts > 0).sum())} labels (largest {counts.max()}, "
+          f"smallest {counts[counts > 0].min()}), batch {args.batch_size}")
+
+    def shuffled():
+        while True:
+            yield np.sort(rng.choice(args.cells, args.batch_size, replace=False))
+
+    sampler = StratifiedBlockSampler(np.arange(args.cells), labels, bundle, batch_size=args.batch_size,
+                                     block_cells=args.block_cells, n_batches=args.max_batches)
+    for name, batches in [("shuffle", shuffled()), ("stratified", iter(sampler))]:
+        n_batches, runs, tiles, short = _run(batches, labels, n_labels, args.min_cells, args.max_batches,
+                                             args.tile_cells)
+        print(f"{name:10s}: {n_batches:6d} batches, {runs:6.1f} reads/batch, {tiles:6.1f} tiles/batch, "
+              f"{n_batches * runs:9.0f} reads in total, {short} labels under {args.min_cells} cells")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,33 +1,25 @@
 #!/bin/bash
-#!/bin/bash
-#SBATCH --job-name=wget_download
-#SBATCH --output=wget_download_%j.out
-#SBATCH --error=wget_download_%j.err
+#SBATCH --job-name=h5ad_download
+#SBATCH --output=h5ad_download_%j.out
+#SBATCH --error=h5ad_download_%j.err
 #SBATCH --ntasks=1
-#SBATCH --cpus-per-task=1
-#SBATCH --mem=1G
-#SBATCH --time=1:00:00
+#SBATCH --cpus-per-task=8
+#SBATCH --mem=2G
+#SBATCH --time=4:00:00
 #SBATCH --partition=sigbio
 
-# This script downloads the H5AD files listed in h5ad_links.txt using wget.
+# This script downloads the H5AD files resolved by get_h5ad_links.py, 8 at a time.
+# Finished files are recorded in the manifest and partial files are resumed, so
+# the job can simply be resubmitted if it runs out of time.
 
 # Get the directory of the current script
 SCRIPT_DIR=$(cd -- "$(dirname -- "${BASH_SOURCE[0]}")" &> /dev/null && pwd)
-LINKS_FILE="/home/jingqiao/test/h5ad_links.txt"
+MANIFEST_FILE="$SCRIPT_DIR/h5ad_manifest.json"
+OUTPUT_DIR=/scratch/sigbio_project_root/sigbio_project25/jingqiao/mccell-single
 
-if [ ! -f "$LINKS_FILE" ]; then
-    echo "Error: $LINKS_FILE not found. Please run get_h5ad_links.py first."
+if [ ! -f "$MANIFEST_FILE" ]; then
+    echo "Error: $MANIFEST_FILE not found. Please run get_h5ad_links.py first."
     exit 1
 fi
 
-echo "Converting S3 URIs to HTTPS URLs and starting download..."
-# Create a temporary file for the https links
-HTTPS_LINKS_FILE=$(mktemp)
-sed 's|s3://cellxgene-census-public-us-west-2/|https://cellxgene-census-public-us-west-2.s3.us-west-2.amazonaws.com/|' "$LINKS_FILE" > "$HTTPS_LINKS_FILE"
-
-wget --input-file="$HTTPS_LINKS_FILE" --continue --directory-prefix=/scratch/sigbio_project_root/sigbio_project25/jingqiao/mccell-single
-
-# Clean up the temporary file
-rm "$HTTPS_LINKS_FILE"
-
-echo "Download complete."
\ No newline at end of file
+mccell download-h5ad "$OUTPUT_DIR" --manifest "$MANIFEST_FILE" --download-only --workers "${SLURM_CPUS_PER_TASK:-8}"
@@ -2,7 +2,6 @@
 Compute highly variable genes on cluster.
 Tests S3 connectivity first, then computes HVGs.
 """
-import pandas as pd
 import pickle
 import socket
 import sys
@@ -38,56 +37,25 @@ if not connectivity_ok:
 
 print("\n✓ S3 connectivity looks good! Proceeding...\n")
 
-# Now import the heavy libraries
+# Now import the pipeline (which loads Census lazily)
 print("Loading libraries...")
-import cellxgene_census
-from cellxgene_census.experimental.pp import get_highly_variable_genes
+from src.data_pipeline.genes import compute_hvg_genes
 
-# Setup paths
-from src.utils.paths import PROJECT_ROOT
-DATE = '2025-10-17'
-PROCESSED_DATA_DIR = PROJECT_ROOT / "data" / "processed"
+ROOT_CL_ID = 'CL:0000988'  # hematopoietic cell
+MIN_CELL_COUNT = 5000
+N_TOP_GENES = 2000
 
-print(f"Loading mapping dict from: {PROCESSED_DATA_DIR}")
-mapping_dict_df = pd.read_csv(PROCESSED_DATA_DIR / f"{DATE}_mapping_dict_df.csv", index_col=0)
-mapping_dict = pd.Series(mapping_dict_df.iloc[:, 0].values, index=mapping_dict_df.index).to_dict()
-all_cell_values = list(mapping_dict.keys())
-
-print(f"\nComputing HVGs for {len(all_cell_values)} cell types...")
+print(f"\nComputing HVGs for root {ROOT_CL_ID}, min_cell_count {MIN_CELL_COUNT}...")
 print(f"Started at: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
 print("This may take 5-10 minutes...\n")
 
 try:
-    # Compute HVGs from online census
-    print("Opening Census...")
-    with cellxgene_census.open_soma(census_version="2025-01-30") as census:
-        print("Building query filter...")
-        obs_value_filter = f"assay == '10x 3\\' v3' and is_primary_data == True and cell_type_ontology_term_id in {all_cell_values}"
-
-        print("Computing highly variable genes...")
-        print("(This step reads expression data from S3 - be patient)")
-
-        hvg_df = get_highly_variable_genes(
-            census,
-            organism="Homo sapiens",
-            obs_value_filter=obs_value_filter,
-            n_top_genes=2000,
-            batch_key="dataset_id"
-        )
-
-    print(f"\n✓ Computed {len(hvg_df)} highly variable genes!")
-
-    # Save the HVG dataframe and gene list
-    hvg_output_path = PROCESSED_DATA_DIR / f"{DATE}_hvg_2000.csv"
-    gene_list_output_path = PROCESSED_DATA_DIR / f"{DATE}_gene_list_2000.pkl"
-
-    hvg_df.to_csv(hvg_output_path)
-    print(f"✓ Saved HVG dataframe to: {hvg_output_path}")
+    print("(This step reads expression data from S3 - be patient)")
+    hvg_dir = compute_hvg_genes(root_cl_id=ROOT_CL_ID, min_cell_count=MIN_CELL_COUNT, n_top_genes=N_TOP_GENES)
 
-    gene_list = hvg_df["feature_id"].tolist()
-    with open(gene_list_output_path, "wb") as fp:
-        pickle.dump(gene_list, fp)
-    print(f"✓ Saved gene list to: {gene_list_output_path}")
+    with open(hvg_dir / "gene_list.pkl", "rb") as fp:
+        gene_list = pickle.load(fp)
+    print(f"✓ Saved HVG dataframe and gene list to: {hvg_dir}")
 
     print(f"\nFinished at: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
     print("\n✓ SUCCESS! You can now use these HVGs in training.")
@@ -1,11 +1,16 @@
 #!/usr/bin/env python
+"""
+Copies the primary 10x 3' v3 cells of the locally downloaded SOMA database into
+a smaller SOMA database, chunk by chunk.
 
-import cellxgene_census
-import tiledbsoma
-import anndata as ad
-import os
+Memory stays bounded by one chunk of cells (see `--chunk-size`), so this runs on
+a regular 32 GB node; if the job is killed, re-running it resumes after the last
+committed chunk. Same as `mccell filter-soma SOURCE DEST`.
+"""
+import argparse
 
-# --- Configuration ---
+from src.data_pipeline.data_loader import OBS_VALUE_FILTER
+from src.data_pipeline.soma_filter import DEFAULT_CHUNK_SIZE, filter_experiment
 
 # Path to your large, locally downloaded SOMA database
 source_soma_path = "/scratch/sigbio_project_root/sigbio_project25/jingqiao/mccell-single/soma_db_homo_sapiens"
@@ -13,38 +18,12 @@ source_soma_path = "/scratch/sigbio_project_root/sigbio_project25/jingqiao/mccel
 # Path where the new, smaller, filtered SOMA database will be created
 filtered_soma_path = "/scratch/sigbio_project_root/sigbio_project25/jingqiao/mccell-single/soma_db_homo_sapiens_filtered"
 
-# The filter to apply
-# This is the same filter from your get_h5ad_links.py script
-value_filter = 'assay == "10x 3\' v3" and is_primary_data == True'
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--source", default=source_soma_path)
+    parser.add_argument("--dest", default=filtered_soma_path)
+    parser.add_argument("--value-filter", default=OBS_VALUE_FILTER)
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    args = parser.parse_args()
 
-# --- Script ---
-
-print(f"Opening source SOMA database at: {source_soma_path}")
-with cellxgene_census.open_soma(uri=source_soma_path) as census:
-
-    print(f"Querying data with filter: '{value_filter}'")
-    query = census.axis_query(
-        measurement_name="RNA",
-        obs_query=tiledbsoma.AxisQuery(value_filter=value_filter)
-    )
-
-    # --- This is the memory-intensive step ---
-    # It loads the entire filtered dataset into memory before it can be written back to disk.
-    # Ensure you are running this on a machine with enough RAM to hold the filtered data.
-    print("Loading filtered data into memory (this may take a while and use a lot of RAM)...")
-    filtered_adata = query.to_anndata(X_name="raw")
-
-    print("\nFiltered data summary:")
-    print(filtered_adata)
-
-    os.makedirs(filtered_soma_path, exist_ok=True)
-
-    print(f"\nWriting filtered data to new SOMA database at: {filtered_soma_path}")
-    tiledbsoma.io.from_anndata(
-        experiment_uri=filtered_soma_path,
-        anndata=filtered_adata,
-        measurement_name="RNA"
-    )
-
-    print("\nProcess complete.")
-    print(f"A smaller, filtered SOMA database has been created at: {filtered_soma_path}")
+    filter_experiment(args.source, args.dest, value_filter=args.value_filter, chunk_size=args.chunk_size)
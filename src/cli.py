@@ -0,0 +1,359 @@
+"""
+The `mccell` command-line entry point.
+
+Each subcommand imports only the modules it needs, inside its handler, so that
+`mccell --help` and lightweight subcommands start without loading torch, pronto,
+pandas or cellxgene_census.
+"""
+import argparse
+import sys
+
+DEFAULT_ROOT_CL_ID = "CL:0000988"  # hematopoietic cell
+DEFAULT_MIN_CELL_COUNT = 5000
+
+
+def _add_bundle_arguments(parser, multiple_roots=False):
+    if multiple_roots:
+        parser.add_argument("--root", dest="root_cl_ids", action="append", default=None, metavar="ROOT_CL_ID",
+                            help="Root CL ID of an ontology subtree; repeat to process several subtrees "
+                                 f"in one batch (default: {DEFAULT_ROOT_CL_ID}).")
+    else:
+        parser.add_argument("--root", dest="root_cl_id", default=DEFAULT_ROOT_CL_ID,
+                            help=f"Root CL ID of the ontology subtree (default: {DEFAULT_ROOT_CL_ID}).")
+    parser.add_argument("--min-cell-count", type=int, default=DEFAULT_MIN_CELL_COUNT,
+                        help=f"Minimum number of cells per cell type (default: {DEFAULT_MIN_CELL_COUNT}).")
+
+
+def _cmd_cache_ontology(args):
+    from src.data_pipeline.cache_ontology import main
+
+    main(migrate=not args.no_migrate)
+
+
+def _cmd_preprocess(args):
+    kwargs = {"census_version": args.census_version} if args.census_version else {}
+    root_cl_ids = args.root_cl_ids or [DEFAULT_ROOT_CL_ID]
+    if len(root_cl_ids) == 1:
+        from src.data_pipeline.pipeline import run_preprocessing
+
+        bundle = run_preprocessing(root_cl_id=root_cl_ids[0], min_cell_count=args.min_cell_count,
+                                   force=args.force, snapshot=args.snapshot, **kwargs)
+        if bundle is None:
+            return 1
+        print(bundle.path)
+        return
+
+    from src.data_pipeline.pipeline import run_batch_preprocessing
+
+    bundles = run_batch_preprocessing(root_cl_ids, min_cell_count=args.min_cell_count, force=args.force,
+                                      workers=args.workers, snapshot=args.snapshot, **kwargs)
+    if bundles is None:
+        return 1
+    for root_cl_id, bundle in bundles.items():
+        print(f"{root_cl_id}\t{bundle.path if bundle is not None else '-'}")
+    if any(bundle is None for bundle in bundles.values()):
+        return 1
+
+
+def _cmd_snapshot_obs(args):
+    from src.data_pipeline.obs_snapshot import snapshot_obs
+
+    if args.soma_uri is None and args.census_version is None:
+        from src.data_pipeline.data_loader import CENSUS_VERSION
+
+        args.census_version = CENSUS_VERSION
+    snapshot_obs(census_version=args.census_version, soma_uri=args.soma_uri, path=args.output)
+
+
+def _cmd_filter_soma(args):
+    from src.data_pipeline.data_loader import OBS_VALUE_FILTER
+    from src.data_pipeline.soma_filter import DEFAULT_CHUNK_SIZE, filter_experiment
+
+    filter_experiment(args.source, args.dest, value_filter=args.value_filter or OBS_VALUE_FILTER,
+                      chunk_size=args.chunk_size or DEFAULT_CHUNK_SIZE, layer=args.layer)
+
+
+def _cmd_download_h5ad(args):
+    from src.data_pipeline.h5ad_download import fetch_h5ads
+
+    kwargs = {"census_version": args.census_version} if args.census_version else {}
+    manifest = fetch_h5ads(args.output, manifest_path=args.manifest, dataset_ids=args.dataset_id,
+                           workers=args.workers, retries=args.retries, resolve=not args.download_only,
+                           download=not args.resolve_only, verify=args.verify, **kwargs)
+    if any(entry.get("status") == "failed" for entry in manifest.entries.values()):
+        return 1
+
+
+def _cmd_counts(args):
+    import pandas as pd
+
+    from src.data_pipeline.count_cube import load_count_cube, PIPELINE_FILTER
+    from src.utils.ontology_utils import load_ontology_index
+
+    kwargs = {"census_version": args.census_version} if args.census_version else {}
+    cube = load_count_cube(snapshot=args.snapshot, **kwargs)
+    filters = {
+        "assay": None if args.all_assays else (args.assay or PIPELINE_FILTER["assay"]),
+        "is_primary_data": None if args.include_secondary else True,
+        "tissue_general": args.tissue,
+        "dataset_id": args.dataset,
+    }
+    summary = cube.subtree_summary(load_ontology_index(), args.root_cl_id, min_cells=args.min_cells,
+                                   min_cell_count=args.min_cell_count, **filters)
+    with pd.option_context("display.max_rows", args.limit, "display.width", 160, "display.max_colwidth", 50):
+        print(summary.head(args.limit))
+
+
+def _cmd_hvg(args):
+    if args.method == "biomart":
+        from src.data_pipeline.genes import select_biomart_genes
+
+        print(select_biomart_genes(num_genes=args.n_genes))
+    else:
+        from src.data_pipeline.genes import compute_hvg_genes
+
+        print(compute_hvg_genes(root_cl_id=args.root_cl_id, min_cell_count=args.min_cell_count,
+                                n_top_genes=args.n_genes))
+
+
+def _cmd_export(args):
+    from src.data_pipeline.cache import resolve_bundle
+
+    bundle = resolve_bundle(root_cl_id=args.root_cl_id, min_cell_count=args.min_cell_count)
+    if args.format == "csv":
+        from src.data_pipeline.artifacts import export_legacy_artifacts
+
+        if args.output is None:
+            print("--output is required for --format csv", file=sys.stderr)
+            return 2
+        prefix = args.prefix or bundle.path.name
+        export_legacy_artifacts(bundle, args.output, prefix)
+        print(f"Exported {bundle.path} to {args.output} with prefix {prefix}")
+    elif args.format == "shards":
+        from src.data_pipeline.data_loader import OBS_VALUE_FILTER
+        from src.data_pipeline.genes import load_protein_coding_genes
+        from src.data_pipeline.shards import export_shards, export_shards_cached
+
+        if (args.soma_uri is None) == (args.h5ad_dir is None):
+            print("--format shards needs either --soma-uri or --h5ad-dir", file=sys.stderr)
+            return 2
+        gene_list = load_protein_coding_genes()
+        if args.h5ad_dir is not None:
+            from src.data_pipeline.h5ad_ingest import find_h5ads, ingest_h5ads, ingest_h5ads_cached
+
+            h5ad_files = find_h5ads(args.h5ad_dir)
+            if not h5ad_files:
+                print(f"No .h5ad files in {args.h5ad_dir}", file=sys.stderr)
+                return 1
+            if args.output is None:
+                store = ingest_h5ads_cached(bundle, h5ad_files, gene_list, value_dtype=args.dtype,
+                                            shard_size=args.shard_size, workers=args.workers)
+            else:
+                store = ingest_h5ads(bundle, h5ad_files, gene_list, args.output, value_dtype=args.dtype,
+                                     shard_size=args.shard_size, workers=args.workers)
+        elif args.output is None:
+            store = export_shards_cached(bundle, args.soma_uri, gene_list, OBS_VALUE_FILTER,
+                                         value_dtype=args.dtype, shard_size=args.shard_size)
+        else:
+            store = export_shards(bundle, args.soma_uri, gene_list, args.output, OBS_VALUE_FILTER,
+                                  value_dtype=args.dtype, shard_size=args.shard_size)
+        print(store.path)
+
+
+def _cmd_train(args):
+    from src.train.run import train
+
+    if args.soma_uri is None and args.shards is None:
+        print("One of --soma-uri or --shards is required", file=sys.stderr)
+        return 2
+    train(args.soma_uri, root_cl_id=args.root_cl_id, min_cell_count=args.min_cell_count,
+          num_epochs=args.epochs, batches_per_epoch=args.batches_per_epoch, batch_size=args.batch_size,
+          lr=args.lr, device=args.device, output_path=args.output, shard_path=args.shards,
+          sparse=args.sparse, prefetch=args.prefetch, prefetch_workers=args.prefetch_workers,
+          num_workers=args.num_workers, target_sum=args.target_sum, scale=args.scale, clip=args.clip,
+          stratified=args.stratified, block_cells=args.block_cells, alpha=args.alpha,
+          log_space=args.log_space, amp=args.amp, grad_accum_steps=args.grad_accum_steps,
+          log_every=args.log_every, val_every=args.val_every, val_batches=args.val_batches,
+          distributed=args.distributed)
+
+
+# `train` keyword arguments whose command-line option has a different name
+_TRAIN_OPTION_DESTS = {"num_epochs": "epochs", "shard_path": "shards", "output_path": "output"}
+
+
+def _train_config_defaults(path):
+    """The options of a `train --config` file, keyed by their command-line destination."""
+    from src.train.run import load_train_config
+
+    return {_TRAIN_OPTION_DESTS.get(key, key): value for key, value in load_train_config(path).items()}
+
+
+def build_parser(train_defaults=None):
+    parser = argparse.ArgumentParser(prog="mccell", description="McCell hierarchical cell type classification.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    p = subparsers.add_parser("cache-ontology", help="Download the Cell Ontology and build the ontology index.")
+    p.add_argument("--no-migrate", action="store_true",
+                   help="Do not patch cached artifact bundles when the ontology release changes.")
+    p.set_defaults(handler=_cmd_cache_ontology)
+
+    p = subparsers.add_parser("preprocess", help="Build (or fetch from cache) the artifact bundles for subtrees.")
+    _add_bundle_arguments(p, multiple_roots=True)
+    p.add_argument("--workers", type=int, default=None,
+                   help="Worker processes for a multi-root batch (default: one per root, up to the CPU count).")
+    p.add_argument("--census-version", default=None, help="CellXGene Census release (default: the pinned release).")
+    p.add_argument("--force", action="store_true", help="Rebuild every stage even if it is cached.")
+    p.add_argument("--snapshot", default=None,
+                   help="Local obs snapshot to read instead of Census (default: the census version's "
+                        "snapshot under data/processed/obs_snapshot/, if taken).")
+    p.set_defaults(handler=_cmd_preprocess)
+
+    p = subparsers.add_parser("snapshot-obs", help="Copy the obs columns the pipeline uses into a local "
+                                                   "Parquet dataset for offline filtering.")
+    p.add_argument("--census-version", default=None,
+                   help="CellXGene Census release to snapshot, or the label of a --soma-uri snapshot "
+                        "(default: the pinned release when reading Census).")
+    p.add_argument("--soma-uri", default=None, help="Snapshot a local SOMA experiment instead of Census.")
+    p.add_argument("--output", default=None,
+                   help="Output directory (default: data/processed/obs_snapshot/<census version>).")
+    p.set_defaults(handler=_cmd_snapshot_obs)
+
+    p = subparsers.add_parser("filter-soma", help="Copy the filtered cells of a local SOMA experiment into a new "
+                                                  "one, chunk by chunk (resumable).")
+    p.add_argument("source", help="Local source SOMA experiment.")
+    p.add_argument("dest", help="Filtered experiment to create, or to resume if interrupted.")
+    p.add_argument("--value-filter", default=None,
+                   help="Obs value filter (default: the pipeline's primary 10x 3' v3 filter).")
+    p.add_argument("--chunk-size", type=int, default=None,
+                   help="Cells per chunk; bounds peak memory (default: DEFAULT_CHUNK_SIZE of "
+                        "src/data_pipeline/soma_filter.py).")
+    p.add_argument("--layer", default="raw", help="X layer to copy (default: raw).")
+    p.set_defaults(handler=_cmd_filter_soma)
+
+    p = subparsers.add_parser("download-h5ad", help="Resolve and download the source H5AD files of the Census "
+                                                    "datasets concurrently (resumable).")
+    p.add_argument("output", help="Directory to save the H5AD files to.")
+    p.add_argument("--manifest", default=None, help="Download manifest (default: <output>/manifest.json).")
+    p.add_argument("--dataset-id", action="append", default=None,
+                   help="Dataset to fetch; may be repeated (default: all datasets with cells passing the "
+                        "pipeline's obs filter).")
+    p.add_argument("--census-version", default=None, help="CellXGene Census release (default: the pinned release).")
+    p.add_argument("--workers", type=int, default=8, help="Concurrent connections (default: 8).")
+    p.add_argument("--retries", type=int, default=5, help="Retries per dataset (default: 5).")
+    mode = p.add_mutually_exclusive_group()
+    mode.add_argument("--resolve-only", action="store_true", help="Only resolve the H5AD URIs into the manifest.")
+    mode.add_argument("--download-only", action="store_true",
+                      help="Only download the datasets already resolved in the manifest (no Census access).")
+    p.add_argument("--verify", action="store_true", help="Re-hash files already marked complete.")
+    p.set_defaults(handler=_cmd_download_h5ad)
+
+    p = subparsers.add_parser("counts", help="Summarize cell counts of the subtrees under a term, "
+                                             "from the obs snapshot's count cube.")
+    p.add_argument("--root", dest="root_cl_id", default="CL:0000000",
+                   help="Only report this term and its descendants (default: CL:0000000, cell).")
+    p.add_argument("--min-cells", type=int, default=0, help="Only report subtrees with more cells than this.")
+    p.add_argument("--min-cell-count", type=int, default=DEFAULT_MIN_CELL_COUNT,
+                   help="Also count the cell types per subtree with more cells than this, i.e. what "
+                        f"`preprocess` would select (default: {DEFAULT_MIN_CELL_COUNT}).")
+    p.add_argument("--assay", action="append", default=None,
+                   help="Count cells of this assay; repeatable (default: the pipeline's assay).")
+    p.add_argument("--all-assays", action="store_true", help="Count cells of every assay.")
+    p.add_argument("--include-secondary", action="store_true", help="Also count non-primary cells.")
+    p.add_argument("--tissue", action="append", default=None, help="Restrict to this tissue_general; repeatable.")
+    p.add_argument("--dataset", action="append", default=None, help="Restrict to this dataset_id; repeatable.")
+    p.add_argument("--census-version", default=None, help="Use the obs snapshot of this Census release.")
+    p.add_argument("--snapshot", default=None, help="Use this obs snapshot directory.")
+    p.add_argument("--limit", type=int, default=50, help="Number of subtrees to print (default: 50).")
+    p.set_defaults(handler=_cmd_counts)
+
+    p = subparsers.add_parser("hvg", help="Select the gene panel (Census HVGs or BioMart protein-coding genes).")
+    _add_bundle_arguments(p)
+    p.add_argument("--method", choices=["census", "biomart"], default="census")
+    p.add_argument("--n-genes", type=int, default=2000)
+    p.set_defaults(handler=_cmd_hvg)
+
+    p = subparsers.add_parser("export", help="Export preprocessing artifacts.")
+    _add_bundle_arguments(p)
+    p.add_argument("--format", choices=["csv", "shards"], default="csv",
+                   help="csv: the legacy CSV + pickle layout of the artifact bundle. "
+                        "shards: the bundle's cells from a local SOMA experiment (or H5AD files) as memory-mapped CSR "
+                        "training shards.")
+    p.add_argument("--output", default=None,
+                   help="Output directory (required for csv; shards default to the preprocessing cache).")
+    p.add_argument("--prefix", default=None, help="csv: filename prefix (default: the bundle's cache key).")
+    p.add_argument("--soma-uri", default=None, help="shards: path to the local SOMA experiment.")
+    p.add_argument("--h5ad-dir", default=None,
+                   help="shards: read the cells from the downloaded H5AD files in this directory instead "
+                        "(see download-h5ad).")
+    p.add_argument("--workers", type=int, default=None,
+                   help="shards from --h5ad-dir: worker processes (default: one per file, up to the CPU count).")
+    p.add_argument("--dtype", choices=["uint16", "float16"], default="uint16",
+                   help="shards: value type (default: uint16 raw counts).")
+    p.add_argument("--shard-size", type=int, default=1 << 18, help="shards: cells per shard.")
+    p.set_defaults(handler=_cmd_export)
+
+    p = subparsers.add_parser("train", help="Train a model on a local SOMA experiment.")
+    _add_bundle_arguments(p)
+    p.add_argument("--soma-uri", default=None, help="Path to the local SOMA experiment.")
+    p.add_argument("--shards", default=None,
+                   help="Train from this shard store (`export --format shards`) instead of --soma-uri.")
+    p.add_argument("--epochs", type=int, default=10)
+    p.add_argument("--batches-per-epoch", type=int, default=200)
+    p.add_argument("--batch-size", type=int, default=256)
+    p.add_argument("--lr", type=float, default=5e-4)
+    p.add_argument("--device", default=None, help="Torch device (default: cuda:0 if available, else cpu).")
+    p.add_argument("--sparse", action="store_true",
+                   help="Feed batches to the model as sparse CSR tensors instead of densifying them.")
+    p.add_argument("--prefetch", type=int, default=2,
+                   help="Batches prepared ahead of the training step on background threads; 0 disables "
+                        "prefetching (default: 2).")
+    p.add_argument("--prefetch-workers", type=int, default=1,
+                   help="Threads preparing prefetched batches (default: 1).")
+    p.add_argument("--num-workers", type=int, default=0, help="DataLoader worker processes (default: 0).")
+    p.add_argument("--target-sum", type=float, default=None,
+                   help="Normalize each cell's counts to this total before log1p, e.g. 1e4 "
+                        "(default: log1p of the raw counts).")
+    p.add_argument("--scale", action="store_true",
+                   help="Divide each gene by its standard deviation, computed once per shard store and cached "
+                        "(--shards only).")
+    p.add_argument("--clip", type=float, default=None, help="Clip the normalized values at this maximum.")
+    p.add_argument("--stratified", action="store_true",
+                   help="Draw training batches stratified over the ontology's leaf and internal nodes, read as "
+                        "blocks of consecutive cells of one label, instead of shuffling globally.")
+    p.add_argument("--block-cells", type=int, default=32,
+                   help="--stratified: consecutive cells of one label per read (default: 32).")
+    p.add_argument("--alpha", type=float, default=0.0,
+                   help="--stratified: weight labels within a node by cell count ** alpha (default: 0, evenly).")
+    p.add_argument("--log-space", action="store_true",
+                   help="Compute the parent loss from log-probabilities (logsumexp over each node's leaves).")
+    p.add_argument("--amp", choices=["bf16", "fp16"], default=None,
+                   help="Run the model under autocast in this precision (default: float32).")
+    p.add_argument("--grad-accum-steps", type=int, default=1,
+                   help="Batches whose gradients are accumulated per optimizer step (default: 1).")
+    p.add_argument("--log-every", type=int, default=50,
+                   help="Batches between progress messages with the loss and cells/s (default: 50).")
+    p.add_argument("--val-every", type=int, default=1,
+                   help="Epochs between validation passes; 0 disables validation (default: 1).")
+    p.add_argument("--val-batches", type=int, default=50, help="Batches per validation pass (default: 50).")
+    p.add_argument("--distributed", action="store_true",
+                   help="Train data-parallel, one process per rank started by torchrun or SLURM srun (gloo on CPU, "
+                        "NCCL on GPUs); --batch-size and --batches-per-epoch are per rank.")
+    p.add_argument("--config", default=None,
+                   help="JSON or TOML file of `train` keyword arguments (e.g. num_epochs, shard_path, amp), "
+                        "for headless runs; options given on the command line override it.")
+    p.add_argument("--output", default=None, help="Where to save the trained model's state dict.")
+    p.set_defaults(handler=_cmd_train, **(train_defaults or {}))
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if getattr(args, "config", None) is not None:
+        # The config file replaces the defaults of the train options, so the command line still wins
+        args = build_parser(train_defaults=_train_config_defaults(args.config)).parse_args(argv)
+    return args.handler(args) or 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,263 @@
+import hashlib
+import json
+import os
+import pickle
+import shutil
+from pathlib import Path
+
+import numpy as np
+
+BUNDLE_FORMAT_VERSION = 1
+
+# Matrix name -> (row labels, column labels), in terms of the bundle's term groups
+_MATRICES = {
+    "marginalization": ("internal", "leaf"),
+    "parent_child": ("all", "internal"),
+    "exclusion": ("all", "internal"),
+}
+
+
+def _content_hash(terms, n_leaf, packed):
+    """SHA-256 over the ordered term list, the leaf/internal split and the packed matrices."""
+    h = hashlib.sha256()
+    h.update(json.dumps({"terms": list(terms), "n_leaf": n_leaf}, sort_keys=True).encode())
+    for name in _MATRICES:
+        h.update(name.encode())
+        h.update(np.ascontiguousarray(packed[name]).tobytes())
+    return h.hexdigest()
+
+
+class ArtifactBundle:
+    """
+    The preprocessing artifacts for one run, loaded from a bundle directory.
+
+    A bundle stores the ordered term list (leaf nodes first, then internal nodes,
+    i.e. `mapping_dict` order) and the marginalization, parent-child and exclusion
+    matrices already laid out in that order, bit-packed along their columns. The
+    matrices are memory-mapped and only unpacked on access, so no pandas parsing
+    or `.loc` re-sorting is needed before handing them to `MarginalizationLoss`.
+
+    Layout of `<bundle>/`:
+        manifest.json         Format version, term lists, matrix shapes, content hash, metadata.
+        marginalization.npy   (internal x ceil(leaf / 8)) uint8, np.packbits along axis 1.
+        parent_child.npy      (all x ceil(internal / 8)) uint8.
+        exclusion.npy         (all x ceil(internal / 8)) uint8.
+    """
+
+    def __init__(self, path, manifest, packed):
+        self.path = Path(path)
+        self.manifest = manifest
+        self._packed = packed
+
+    @property
+    def terms(self):
+        return self.manifest["terms"]
+
+    @property
+    def leaf_values(self):
+        return self.terms[:self.manifest["n_leaf"]]
+
+    @property
+    def internal_values(self):
+        return self.terms[self.manifest["n_leaf"]:]
+
+    @property
+    def mapping_dict(self):
+        return {term_id: i for i, term_id in enumerate(self.terms)}
+
+    @property
+    def metadata(self):
+        return self.manifest.get("metadata", {})
+
+    @property
+    def content_hash(self):
+        return self.manifest["content_hash"]
+
+    def _unpack(self, name):
+        rows, cols = self.manifest["matrices"][name]["shape"]
+        return np.unpackbits(self._packed[name], axis=1, count=cols).view(bool).reshape(rows, cols)
+
+    @property
+    def marginalization(self):
+        """(internal x leaf) bool array."""
+        return self._unpack("marginalization")
+
+    @property
+    def parent_child(self):
+        """(all x internal) bool array."""
+        return self._unpack("parent_child")
+
+    @property
+    def exclusion(self):
+        """(all x internal) bool array."""
+        return self._unpack("exclusion")
+
+    def to_dataframes(self):
+        """Returns the three matrices as labelled 0/1 DataFrames, like `preprocess_data_ontology`."""
+        import pandas as pd
+
+        labels = {"all": self.terms, "leaf": self.leaf_values, "internal": self.internal_values}
+        return tuple(
+            pd.DataFrame(getattr(self, name).astype(np.int64), index=labels[rows], columns=labels[cols])
+            for name, (rows, cols) in _MATRICES.items()
+        )
+
+    def verify(self):
+        """
+        Recomputes the content hash and compares it to the manifest.
+
+        Raises:
+            ValueError: If the bundle contents do not match the manifest.
+        """
+        actual = _content_hash(self.terms, self.manifest["n_leaf"], self._packed)
+        if actual != self.content_hash:
+            raise ValueError(f"Artifact bundle at {self.path} is corrupt: content hash {actual} != {self.content_hash}")
+
+
+def save_artifact_bundle(path, mapping_dict, leaf_values, internal_values,
+                         marginalization_df, parent_child_df, exclusion_df, metadata=None):
+    """
+    Writes the outputs of `preprocess_data_ontology` as an artifact bundle.
+
+    The DataFrames are re-ordered to `mapping_dict` order once here, so consumers
+    never have to. The bundle is written to a temporary directory and renamed into
+    place, so a partially written bundle is never visible at `path`.
+
+    Args:
+        path (str or Path): The bundle directory to create (replaced if it exists).
+        mapping_dict (dict): CL ID -> integer index (leaf nodes first).
+        leaf_values (list): CL IDs of leaf nodes.
+        internal_values (list): CL IDs of internal nodes.
+        marginalization_df, parent_child_df, exclusion_df (pd.DataFrame): The ontology matrices.
+        metadata (dict, optional): JSON-serializable run parameters stored in the manifest.
+
+    Returns:
+        ArtifactBundle: The saved bundle, loaded from `path`.
+    """
+    path = Path(path)
+    terms = sorted(mapping_dict, key=mapping_dict.get)
+    leaf_sorted = sorted(leaf_values, key=mapping_dict.get)
+    internal_sorted = sorted(internal_values, key=mapping_dict.get)
+    if terms != leaf_sorted + internal_sorted:
+        raise ValueError("mapping_dict must index all leaf nodes before all internal nodes.")
+
+    labels = {"all": terms, "leaf": leaf_sorted, "internal": internal_sorted}
+    frames = {"marginalization": marginalization_df, "parent_child": parent_child_df, "exclusion": exclusion_df}
+    packed = {}
+    shapes = {}
+    for name, (rows, cols) in _MATRICES.items():
+        dense = frames[name].loc[labels[rows], labels[cols]].to_numpy() != 0
+        packed[name] = np.packbits(dense, axis=1)
+        shapes[name] = {"shape": list(dense.shape), "file": f"{name}.npy", "encoding": "packbits"}
+
+    manifest = {
+        "format_version": BUNDLE_FORMAT_VERSION,
+        "n_leaf": len(leaf_sorted),
+        "n_internal": len(internal_sorted),
+        "terms": terms,
+        "matrices": shapes,
+        "content_hash": _content_hash(terms, len(leaf_sorted), packed),
+        "metadata": metadata or {},
+    }
+
+    tmp_path = path.with_name(f".{path.name}.tmp-{os.getpid()}")
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    tmp_path.mkdir(parents=True)
+    for name, array in packed.items():
+        np.save(tmp_path / f"{name}.npy", array)
+    with open(tmp_path / "manifest.json", "w") as f:
+        json.dump(manifest, f, indent=2)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+    return load_artifact_bundle(path)
+
+
+def load_artifact_bundle(path, verify=False):
+    """
+    Memory-maps an artifact bundle written by `save_artifact_bundle`.
+
+    Args:
+        path (str or Path): The bundle directory.
+        verify (bool): If True, check the content hash (reads every matrix once).
+
+    Returns:
+        ArtifactBundle: The loaded bundle.
+
+    Raises:
+        FileNotFoundError: If the bundle does not exist.
+        ValueError: If the bundle format is unsupported or `verify` fails.
+    """
+    path = Path(path)
+    with open(path / "manifest.json") as f:
+        manifest = json.load(f)
+    if manifest.get("format_version") != BUNDLE_FORMAT_VERSION:
+        raise ValueError(f"Unsupported artifact bundle format {manifest.get('format_version')} at {path}.")
+    packed = {
+        name: np.load(path / info["file"], mmap_mode="r")
+        for name, info in manifest["matrices"].items()
+    }
+    bundle = ArtifactBundle(path, manifest, packed)
+    if verify:
+        bundle.verify()
+    return bundle
+
+
+def convert_legacy_artifacts(processed_dir, date, path=None):
+    """
+    Converts a dated set of CSV + pickle artifacts (`{date}_marginalization_df.csv`,
+    `{date}_mapping_dict_df.csv`, ...) written by older versions of
+    `run_preprocessing.py` into an artifact bundle.
+
+    Args:
+        processed_dir (str or Path): Directory holding the legacy files.
+        date (str): The date prefix of the legacy files, e.g. '2025-10-17'.
+        path (str or Path, optional): Bundle directory. Defaults to `{processed_dir}/{date}_bundle`.
+
+    Returns:
+        ArtifactBundle: The converted bundle.
+    """
+    import pandas as pd
+
+    processed_dir = Path(processed_dir)
+    marginalization_df = pd.read_csv(processed_dir / f"{date}_marginalization_df.csv", index_col=0)
+    parent_child_df = pd.read_csv(processed_dir / f"{date}_parent_child_df.csv", index_col=0)
+    exclusion_df = pd.read_csv(processed_dir / f"{date}_exclusion_df.csv", index_col=0)
+    mapping_dict_df = pd.read_csv(processed_dir / f"{date}_mapping_dict_df.csv", index_col=0)
+    mapping_dict = pd.Series(mapping_dict_df.iloc[:, 0].values, index=mapping_dict_df.index).to_dict()
+    with open(processed_dir / f"{date}_leaf_values.pkl", "rb") as fp:
+        leaf_values = pickle.load(fp)
+    with open(processed_dir / f"{date}_internal_values.pkl", "rb") as fp:
+        internal_values = pickle.load(fp)
+
+    return save_artifact_bundle(
+        path or processed_dir / f"{date}_bundle",
+        mapping_dict, leaf_values, internal_values,
+        marginalization_df, parent_child_df, exclusion_df,
+        metadata={"converted_from": f"{date}_*.csv"},
+    )
+
+
+def export_legacy_artifacts(bundle, output_dir, prefix):
+    """
+    Writes a bundle back out in the CSV + pickle layout of older runs
+    (`{prefix}_marginalization_df.csv`, `{prefix}_mapping_dict_df.csv`, ...), for
+    inspection or for tools that have not moved to bundles yet.
+
+    Args:
+        bundle (ArtifactBundle): The bundle to export.
+        output_dir (str or Path): Directory to write into.
+        prefix (str): Filename prefix, e.g. a date or a cache key.
+    """
+    import pandas as pd
+
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    marginalization_df, parent_child_df, exclusion_df = bundle.to_dataframes()
+    marginalization_df.to_csv(output_dir / f"{prefix}_marginalization_df.csv")
+    parent_child_df.to_csv(output_dir / f"{prefix}_parent_child_df.csv")
+    exclusion_df.to_csv(output_dir / f"{prefix}_exclusion_df.csv")
+    pd.DataFrame.from_dict(bundle.mapping_dict, orient='index').to_csv(output_dir / f"{prefix}_mapping_dict_df.csv")
+    with open(output_dir / f"{prefix}_leaf_values.pkl", "wb") as fp:
+        pickle.dump(list(bundle.leaf_values), fp)
+    with open(output_dir / f"{prefix}_internal_values.pkl", "wb") as fp:
+        pickle.dump(list(bundle.internal_values), fp)
@@ -0,0 +1,100 @@
+import hashlib
+import json
+from pathlib import Path
+
+from src.utils.paths import PROJECT_ROOT
+
+CACHE_DIR = PROJECT_ROOT / "data" / "processed" / "cache"
+
+
+def stage_key(params: dict) -> str:
+    """
+    Derives a stable cache key from a stage's inputs.
+
+    Args:
+        params (dict): JSON-serializable inputs of the stage (ontology release,
+            root_cl_id, min_cell_count, census version, obs filter, ...).
+
+    Returns:
+        str: The first 16 hex digits of the SHA-256 of the canonical JSON encoding.
+    """
+    encoded = json.dumps(params, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(encoded.encode()).hexdigest()[:16]
+
+
+def stage_dir(stage: str, params: dict, cache_dir=None) -> Path:
+    """Returns the cache directory for a stage's outputs, `{cache_dir}/{stage}/{key}`."""
+    return Path(cache_dir or CACHE_DIR) / stage / stage_key(params)
+
+
+def is_cached(path) -> bool:
+    """A cache entry is complete once its `params.json` has been written."""
+    return (Path(path) / "params.json").exists()
+
+
+def mark_cached(path, params: dict):
+    """Records a stage's inputs next to its outputs. Call this last, after all outputs are written."""
+    path = Path(path)
+    tmp_file = path / "params.json.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(params, f, indent=2, sort_keys=True, default=str)
+    tmp_file.replace(path / "params.json")
+
+
+def cell_metadata_params(ontology_release, root_cl_id, min_cell_count, census_version, obs_filter) -> dict:
+    """The inputs that determine the output of `load_filtered_cell_metadata`."""
+    return {
+        "ontology_release": ontology_release,
+        "root_cl_id": root_cl_id,
+        "min_cell_count": min_cell_count,
+        # min_cell_count is applied to the cells passing obs_filter, not to all cells
+        "min_count_scope": "obs_filter",
+        "census_version": census_version,
+        "obs_filter": obs_filter,
+    }
+
+
+def bundle_params(ontology_release, root_cl_id, min_cell_count, census_version, obs_filter,
+                  target_column="cell_type_ontology_term_id") -> dict:
+    """The inputs that determine the artifact bundle written by `run_preprocessing.py`."""
+    params = cell_metadata_params(ontology_release, root_cl_id, min_cell_count, census_version, obs_filter)
+    params["target_column"] = target_column
+    return params
+
+
+def resolve_bundle(root_cl_id="CL:0000988", min_cell_count=5000, census_version=None,
+                   ontology_release=None, obs_filter=None, cache_dir=None):
+    """
+    Finds the cached artifact bundle for a set of preprocessing parameters.
+
+    This replaces looking artifacts up by the date they were written on. Parameters
+    left as None default to the values `run_preprocessing.py` uses: the pinned
+    census version, the standard obs filter and the release of the cached ontology.
+
+    Returns:
+        ArtifactBundle: The memory-mapped bundle.
+
+    Raises:
+        FileNotFoundError: If no bundle has been built for these parameters yet.
+    """
+    from src.data_pipeline.artifacts import load_artifact_bundle
+    from src.data_pipeline.data_loader import CENSUS_VERSION, OBS_VALUE_FILTER
+    from src.utils.ontology_utils import load_ontology_index
+
+    if ontology_release is None:
+        index = load_ontology_index()
+        if index is None:
+            raise FileNotFoundError("Ontology index not found; run cache_ontology.py first.")
+        ontology_release = index.data_version
+
+    params = bundle_params(
+        ontology_release, root_cl_id, min_cell_count,
+        census_version or CENSUS_VERSION, obs_filter or OBS_VALUE_FILTER,
+    )
+    path = stage_dir("bundle", params, cache_dir)
+    if not (path / "manifest.json").exists():
+        raise FileNotFoundError(
+            f"No artifact bundle cached for {params} (expected {path}). "
+            "Run `mccell preprocess` (or `python3 run_preprocessing.py`) with these parameters first."
+        )
+    return load_artifact_bundle(path)
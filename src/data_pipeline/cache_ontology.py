@@ -1,15 +1,27 @@
-import pronto
 import pickle
 import os
+import shutil
 from src.utils.paths import PROJECT_ROOT
+from src.utils.ontology_index import OntologyIndex
+from src.data_pipeline.ontology_diff import diff_ontology_indexes, migrate_cached_bundles
 
-def main():
+def main(migrate=True):
     """
-    Main function to load the Cell Ontology and cache the pronto.Ontology object.
+    Main function to load the Cell Ontology, cache the pronto.Ontology object and
+    write the compact, memory-mappable ontology index next to it.
+
+    When the downloaded release differs from the cached one, the previous index is
+    kept as `ontology_index_previous/`, the differences between the two releases
+    are reported, and (if `migrate` is True) cached artifact bundles are patched
+    to the new release instead of being rebuilt from scratch.
     """
     output_dir = PROJECT_ROOT / "data" / "processed"
     os.makedirs(output_dir, exist_ok=True)
     ontology_cache_path = output_dir / "ontology.pkl"
+    ontology_index_path = output_dir / "ontology_index"
+    previous_index_path = output_dir / "ontology_index_previous"
+
+    import pronto
 
     print("Starting ontology caching process...")
 
@@ -29,5 +41,29 @@ def main():
         pickle.dump(cl_ontology, f)
     print("Ontology object cached successfully.")
 
+    # 3. Build and save the compact ontology index (CSR adjacency + packed closure)
+    print(f"Building ontology index at {ontology_index_path}...")
+    index = OntologyIndex.from_pronto(cl_ontology)
+
+    previous_index = None
+    if (ontology_index_path / "meta.json").exists():
+        cached_index = OntologyIndex.load(ontology_index_path)
+        if cached_index.data_version != index.data_version:
+            print(f"Keeping previous release {cached_index.data_version} at {previous_index_path}...")
+            shutil.rmtree(previous_index_path, ignore_errors=True)
+            os.replace(ontology_index_path, previous_index_path)
+            previous_index = OntologyIndex.load(previous_index_path)
+
+    index.save(ontology_index_path)
+    print(f"Ontology index with {len(index)} terms saved successfully.")
+
+    # 4. Report what changed since the previous release and patch cached artifacts
+    if previous_index is not None:
+        index = OntologyIndex.load(ontology_index_path)
+        diff = diff_ontology_indexes(previous_index, index)
+        print(f"Ontology changes: {diff.summary()}")
+        if migrate:
+            migrate_cached_bundles(previous_index, index)
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,277 @@
+import json
+from pathlib import Path
+
+import numpy as np
+
+from src.data_pipeline.cache import stage_dir, is_cached, mark_cached
+from src.data_pipeline.data_loader import CENSUS_VERSION, OBS_ASSAY
+
+CUBE_FORMAT_VERSION = 1
+
+# Breakdown dimensions of the cube, in the order of `ObsSnapshot.read_counts` columns
+DIMENSIONS = ["assay", "is_primary_data", "tissue_general", "dataset_id"]
+
+# The cells `load_filtered_cell_metadata` counts towards min_cell_count
+PIPELINE_FILTER = {"assay": OBS_ASSAY, "is_primary_data": True}
+
+_ARRAY_FILES = (
+    "cell_types",
+    "term_ids",
+    "fact_cell_type",
+    "fact_assay",
+    "fact_is_primary_data",
+    "fact_tissue_general",
+    "fact_dataset_id",
+    "fact_n_cells",
+    "rollup_term",
+    "rollup_cell_type",
+)
+
+
+class CountCube:
+    """
+    Cell counts per Cell Ontology term, broken down by assay, primary-data flag,
+    tissue and dataset, and rolled up through the is_a hierarchy.
+
+    The cube stores the direct counts as a sparse fact table (one row per observed
+    combination of cell type and breakdown values) plus the ancestor relation of
+    the observed cell types as (term, cell type) pairs taken from the ontology
+    closure. A query filters the facts, sums them per cell type with `np.bincount`
+    and rolls them up with a second `bincount` over the pairs, so a term's count
+    includes the cells of all its descendants.
+    """
+
+    def __init__(self, arrays, meta):
+        self.meta = meta
+        self.arrays = arrays
+        self.cell_types = arrays["cell_types"]
+        self.term_ids = arrays["term_ids"]
+        self._vocabularies = {dim: meta["vocabularies"][dim] for dim in DIMENSIONS if dim != "is_primary_data"}
+
+    # --- Construction and (de)serialization ---
+
+    @classmethod
+    def build(cls, counts, cl, source=None):
+        """
+        Builds a cube from a table of direct cell counts.
+
+        Args:
+            counts (pd.DataFrame): `n_cells` per (cell_type_ontology_term_id, assay,
+                is_primary_data, tissue_general, dataset_id), e.g. `ObsSnapshot.read_counts()`.
+            cl (OntologyIndex): The Cell Ontology index to roll the counts up with.
+            source (str, optional): Where the counts come from, recorded in the metadata.
+
+        Returns:
+            CountCube: An in-memory cube (call `save` to persist it).
+        """
+        import pandas as pd
+
+        cell_type_codes, cell_types = pd.factorize(counts["cell_type_ontology_term_id"], sort=True)
+        cell_types = np.asarray(cell_types, dtype=str)
+
+        arrays = {
+            "cell_types": cell_types,
+            "fact_cell_type": cell_type_codes.astype(np.int32),
+            "fact_is_primary_data": counts["is_primary_data"].to_numpy(dtype=bool),
+            "fact_n_cells": counts["n_cells"].to_numpy(dtype=np.int64),
+        }
+        vocabularies = {}
+        for dim in ["assay", "tissue_general", "dataset_id"]:
+            codes, values = pd.factorize(counts[dim], sort=True)
+            arrays[f"fact_{dim}"] = codes.astype(np.int32)
+            vocabularies[dim] = [str(v) for v in values]
+
+        # (ancestor term, cell type) pairs from the reflexive ancestor closure
+        positions = cl.indices_of(cell_types)
+        known = np.flatnonzero(positions >= 0)
+        if len(known) < len(cell_types):
+            print(f"Warning: {len(cell_types) - len(known)} cell types are not in the ontology and are not "
+                  f"rolled up (e.g. {cell_types[positions < 0][:5].tolist()}).")
+        closure = np.unpackbits(cl.ancestors_packed[positions[known]], axis=1, count=len(cl)).view(bool)
+        pair_cell_type, pair_term = np.nonzero(closure)
+        term_positions, rollup_term = np.unique(pair_term, return_inverse=True)
+        arrays["term_ids"] = np.asarray(cl.term_ids[term_positions], dtype=str)
+        arrays["rollup_term"] = rollup_term.astype(np.int32)
+        arrays["rollup_cell_type"] = known[pair_cell_type].astype(np.int32)
+
+        meta = {
+            "format_version": CUBE_FORMAT_VERSION,
+            "source": source,
+            "ontology_release": cl.data_version,
+            "n_cells": int(arrays["fact_n_cells"].sum()),
+            "vocabularies": vocabularies,
+        }
+        return cls(arrays, meta)
+
+    def save(self, path):
+        """Writes the cube as a directory of `.npy` arrays plus `meta.json`."""
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        for name in _ARRAY_FILES:
+            np.save(path / f"{name}.npy", np.asarray(self.arrays[name]))
+        with open(path / "meta.json", "w") as f:
+            json.dump(self.meta, f, indent=2)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Memory-maps a cube previously written by `save`.
+
+        Raises:
+            FileNotFoundError: If the cube directory or one of its files is missing.
+            ValueError: If the cube was written with an unsupported format version.
+        """
+        path = Path(path)
+        with open(path / "meta.json") as f:
+            meta = json.load(f)
+        if meta.get("format_version") != CUBE_FORMAT_VERSION:
+            raise ValueError(f"Unsupported count cube format {meta.get('format_version')} at {path}; rebuild it.")
+        arrays = {name: np.load(path / f"{name}.npy", mmap_mode="r") for name in _ARRAY_FILES}
+        return cls(arrays, meta)
+
+    # --- Queries ---
+
+    def _fact_mask(self, filters):
+        mask = np.ones(len(self.arrays["fact_n_cells"]), dtype=bool)
+        for dim, value in filters.items():
+            if dim not in DIMENSIONS:
+                raise ValueError(f"Unknown dimension {dim!r}; expected one of {DIMENSIONS}.")
+            if value is None:
+                continue
+            facts = self.arrays[f"fact_{dim}"]
+            if dim == "is_primary_data":
+                mask &= facts == bool(value)
+                continue
+            values = [value] if isinstance(value, str) else list(value)
+            vocabulary = self._vocabularies[dim]
+            codes = [vocabulary.index(v) for v in values if v in vocabulary]
+            mask &= np.isin(facts, codes)
+        return mask
+
+    def _direct_counts(self, filters):
+        mask = self._fact_mask(filters)
+        return np.bincount(self.arrays["fact_cell_type"][mask], weights=self.arrays["fact_n_cells"][mask],
+                           minlength=len(self.cell_types)).astype(np.int64)
+
+    def _rollup(self, per_cell_type):
+        return np.bincount(self.arrays["rollup_term"], weights=per_cell_type[self.arrays["rollup_cell_type"]],
+                           minlength=len(self.term_ids)).astype(np.int64)
+
+    def cell_type_counts(self, **filters):
+        """
+        Direct cell counts per cell type, i.e. what `select_cell_types` compares with
+        min_cell_count when called with the `PIPELINE_FILTER` breakdown.
+
+        Args:
+            **filters: Breakdown values to restrict to, per dimension in `DIMENSIONS`:
+                a value or a list of values (None for all).
+
+        Returns:
+            pd.Series: Cells per cell type, for the cell types with at least one cell.
+        """
+        import pandas as pd
+
+        counts = self._direct_counts(filters)
+        nonzero = counts > 0
+        return pd.Series(counts[nonzero], index=self.cell_types[nonzero], name="n_cells")
+
+    def rolled_up_counts(self, **filters):
+        """
+        Cell counts per ontology term including all descendants' cells.
+
+        Args:
+            **filters: As in `cell_type_counts`.
+
+        Returns:
+            pd.Series: Cells per term, for every ancestor of an observed cell type.
+        """
+        import pandas as pd
+
+        return pd.Series(self._rollup(self._direct_counts(filters)), index=self.term_ids, name="n_cells")
+
+    def subtree_summary(self, cl, root_cl_id, min_cells=0, min_cell_count=None, **filters):
+        """
+        Summarizes every subtree under `root_cl_id`, to choose the `root_cl_id` and
+        `min_cell_count` of a preprocessing run without querying Census.
+
+        Args:
+            cl (OntologyIndex): The Cell Ontology index the cube was built with.
+            root_cl_id (str): Only report `root_cl_id` and its descendants.
+            min_cells (int): Only report subtrees with more than this many cells.
+            min_cell_count (int, optional): Also report how many cell types (and
+                cells) of each subtree have more than this many cells, i.e. what a
+                preprocessing run rooted there would select.
+            **filters: As in `cell_type_counts`.
+
+        Returns:
+            pd.DataFrame: One row per subtree root, indexed by term ID and sorted by
+            `n_cells`, with its name, `n_cells` and `n_cell_types` (observed cell
+            types in the subtree), plus `n_selected_cell_types` and
+            `n_selected_cells` if `min_cell_count` is given.
+        """
+        import pandas as pd
+
+        direct = self._direct_counts(filters)
+        summary = pd.DataFrame({
+            "n_cells": self._rollup(direct),
+            "n_cell_types": self._rollup((direct > 0).astype(np.int64)),
+        }, index=self.term_ids)
+        if min_cell_count is not None:
+            selected = direct > min_cell_count
+            summary["n_selected_cell_types"] = self._rollup(selected.astype(np.int64))
+            summary["n_selected_cells"] = self._rollup(np.where(selected, direct, 0))
+
+        under_root = cl.ancestor_matrix(self.term_ids, [root_cl_id])[:, 0]
+        summary = summary[under_root & (summary["n_cells"].to_numpy() > min_cells)]
+        summary.insert(0, "name", [cl.name(term_id) for term_id in summary.index])
+        summary.index.name = "cl_id"
+        return summary.sort_values("n_cells", ascending=False)
+
+
+def count_cube_params(snapshot_manifest, ontology_release) -> dict:
+    """The inputs that determine a count cube."""
+    return {
+        "obs_snapshot": snapshot_manifest["source"],
+        "obs_snapshot_n_cells": snapshot_manifest["n_cells"],
+        "ontology_release": ontology_release,
+    }
+
+
+def load_count_cube(census_version=CENSUS_VERSION, snapshot=None, cl=None, cache_dir=None):
+    """
+    Returns the count cube of an obs snapshot, building and caching it on first use.
+
+    Args:
+        census_version (str): Use the snapshot of this Census release (see `mccell snapshot-obs`).
+        snapshot (str or Path, optional): Use this snapshot instead.
+        cl (OntologyIndex, optional): The ontology index. Defaults to the cached index.
+        cache_dir (Path, optional): Cache root. Defaults to `CACHE_DIR`.
+
+    Returns:
+        CountCube: The memory-mapped cube.
+
+    Raises:
+        FileNotFoundError: If there is no obs snapshot of `census_version`.
+    """
+    from src.data_pipeline.obs_snapshot import ObsSnapshot, find_obs_snapshot
+    from src.utils.ontology_utils import load_ontology_index
+
+    if snapshot is None:
+        snapshot = find_obs_snapshot(census_version)
+        if snapshot is None:
+            raise FileNotFoundError(f"No obs snapshot of Census {census_version}; run `mccell snapshot-obs` first.")
+    snapshot = ObsSnapshot(snapshot)
+    if cl is None:
+        cl = load_ontology_index()
+
+    params = count_cube_params(snapshot.manifest, cl.data_version)
+    path = stage_dir("count_cube", params, cache_dir)
+    if is_cached(path):
+        return CountCube.load(path)
+
+    print(f"Building the cell count cube from the obs snapshot at {snapshot.path}...")
+    cube = CountCube.build(snapshot.read_counts(), cl, source=snapshot.manifest["source"])
+    cube.save(path)
+    mark_cached(path, params)
+    print(f"Saved count cube ({len(cube.term_ids)} terms, {len(cube.arrays['fact_n_cells'])} facts) to {path}")
+    return CountCube.load(path)
@@ -1,19 +1,24 @@
-import cellxgene_census
-import pandas as pd
 from src.utils.ontology_utils import get_sub_DAG
 
-def load_filtered_cell_metadata(cl, root_cl_id: str, min_cell_count: int = 5000) -> pd.DataFrame:
+# Pinned Census release, so that cached preprocessing outputs stay valid
+CENSUS_VERSION = "2025-01-30"
+
+# Cells used for training: primary 10x 3' v3 data
+OBS_ASSAY = "10x 3' v3"
+OBS_VALUE_FILTER = f'''assay == "{OBS_ASSAY}" and is_primary_data == True'''
+
+def select_cell_types(cl, root_cl_id: str, cell_type_counts, min_cell_count: int) -> list:
     """
-    Loads cell metadata from the CellXGene Census, filters for descendants of a given
-    root CL ID with a minimum count, and returns the filtered metadata.
+    Selects the descendants of a root CL ID that have more than `min_cell_count` cells.
 
     Args:
-        cl (pronto.Ontology): The loaded Cell Ontology object.
+        cl (pronto.Ontology or OntologyIndex): The loaded Cell Ontology.
         root_cl_id (str): The root Cell Ontology ID (e.g., "CL:0000988") to define the subgraph.
+        cell_type_counts (pd.Series): Number of Census cells per cell type.
         min_cell_count (int): The minimum number of cells for a cell type to be included.
 
     Returns:
-        pd.DataFrame: A DataFrame containing the filtered cell metadata.
+        list: The selected CL IDs, empty if none match.
     """
     # Get all descendants of the root CL ID
     print(f"Fetching descendants of {root_cl_id}...")
@@ -24,38 +29,193 @@ def load_filtered_cell_metadata(cl, root_cl_id: str, min_cell_count: int = 5000)
 
     if not descendant_cell_types:
         print(f"No descendants found for {root_cl_id}. Aborting.")
-        return pd.DataFrame()
+        return []
+
+    # Filter for cell types with a minimum count
+    good_mask = cell_type_counts > min_cell_count
+    valid_cell_types = cell_type_counts[good_mask].keys().tolist()
+
+    # Find the intersection with our descendant cell list
+    intersection_cell_types = sorted(set(valid_cell_types) & descendant_cell_types)
+
+    print(f"Found {len(intersection_cell_types)} cell types under {root_cl_id} with > {min_cell_count} cells.")
+    return intersection_cell_types
+
+
+def scan_cell_types(obs, keep, value_filter: str = OBS_VALUE_FILTER, column: str = "cell_type_ontology_term_id"):
+    """
+    Streams the obs table once, with `value_filter` pushed down to TileDB, counting
+    the cells of every cell type and collecting the `soma_joinid`s of the cells whose
+    type is in `keep`.
+
+    Counting works on the dictionary codes of each Arrow batch (the categorical
+    column's dictionary holds a few hundred cell types), so no per-cell Python
+    strings are created; only the matching rows' join IDs and codes are kept.
+
+    Args:
+        obs (tiledbsoma.DataFrame): The experiment's obs table.
+        keep (set): Cell types whose cells to collect.
+        value_filter (str): The obs predicate applied by the SOMA reader.
+        column (str): The cell type column.
+
+    Returns:
+        tuple: (soma_joinids, codes, categories, counts) where `codes` index into
+        `categories` for each collected cell and `counts[i]` is the number of
+        cells of `categories[i]` passing `value_filter`.
+    """
+    import numpy as np
+    import pyarrow as pa
+
+    categories = []
+    code_of = {}
+    counts = np.zeros(0, dtype=np.int64)
+    joinid_chunks, code_chunks = [], []
+
+    for table in obs.read(value_filter=value_filter, column_names=["soma_joinid", column]):
+        joinids = table.column("soma_joinid")
+        offset = 0
+        for chunk in table.column(column).chunks:
+            if not pa.types.is_dictionary(chunk.type):
+                chunk = chunk.dictionary_encode()
+            dictionary = chunk.dictionary.to_pylist()
+            for term_id in dictionary:
+                if term_id not in code_of:
+                    code_of[term_id] = len(categories)
+                    categories.append(term_id)
+            # Batch-local dictionary index -> global code, and whether to keep it
+            lookup = np.array([code_of[term_id] for term_id in dictionary], dtype=np.int32)
+            keep_lookup = np.array([term_id in keep for term_id in dictionary], dtype=bool)
+
+            indices = chunk.indices.to_numpy(zero_copy_only=False)
+            codes = lookup[indices]
+            counts = np.concatenate([counts, np.zeros(len(categories) - len(counts), dtype=np.int64)])
+            counts += np.bincount(codes, minlength=len(categories))
+
+            mask = keep_lookup[indices]
+            if mask.any():
+                chunk_joinids = joinids.slice(offset, len(chunk)).to_numpy()
+                joinid_chunks.append(chunk_joinids[mask])
+                code_chunks.append(codes[mask])
+            offset += len(chunk)
+
+    soma_joinids = np.concatenate(joinid_chunks) if joinid_chunks else np.zeros(0, dtype=np.int64)
+    codes = np.concatenate(code_chunks) if code_chunks else np.zeros(0, dtype=np.int32)
+    return soma_joinids, codes, categories, counts
+
+
+def load_filtered_cell_metadata_batch(cl, root_cl_ids, min_cell_count: int = 5000,
+                                      census_version: str = CENSUS_VERSION, snapshot=None) -> dict:
+    """
+    Loads the filtered cell metadata of several ontology subtrees with a single
+    streaming pass over the Census obs table (see `scan_cell_types`): the assay /
+    primary-data filter is pushed down to the reader, cells are counted per cell
+    type on the fly, and only cells of a descendant of one of the roots are kept.
+    The roots' cell types are then selected from the counts and their cells split
+    out of the collected rows.
 
-    print("Connecting to CellXGene Census...")
-    with cellxgene_census.open_soma() as census:
+    With a local obs snapshot (see `src/data_pipeline/obs_snapshot.py`) the counts
+    come from its count table and only the selected cell types' partitions are
+    read, without network access.
+
+    Args:
+        cl (pronto.Ontology or OntologyIndex): The loaded Cell Ontology.
+        root_cl_ids (list): Root CL IDs of the subtrees.
+        min_cell_count (int): The minimum number of (filtered) cells for a cell type to be included.
+        census_version (str): The CellXGene Census release to read.
+        snapshot (str or Path, optional): Read this obs snapshot instead of Census.
+
+    Returns:
+        dict: Root CL ID -> DataFrame with the `soma_joinid` and (categorical)
+        `cell_type_ontology_term_id` of its cells, empty if nothing matched.
+    """
+    import numpy as np
+    import pandas as pd
+
+    descendants = {root_cl_id: {sub.id for sub in get_sub_DAG(cl, root_cl_id)} for root_cl_id in root_cl_ids}
+    keep = set().union(*descendants.values())
+    if not keep:
+        print("No descendants found for any root. Aborting.")
+        return {root_cl_id: pd.DataFrame() for root_cl_id in root_cl_ids}
+
+    if snapshot is not None:
+        return _load_from_snapshot(cl, root_cl_ids, min_cell_count, census_version, snapshot)
+
+    import cellxgene_census
+
+    print(f"Connecting to CellXGene Census ({census_version})...")
+    with cellxgene_census.open_soma(census_version=census_version) as census:
         experiment = census["census_data"]["homo_sapiens"]
 
-        print("Reading cell metadata to filter cell types...")
-        exp_pd = experiment.obs.read(column_names=["cell_type_ontology_term_id"]).concat().to_pandas()
-        cell_type_counts = exp_pd["cell_type_ontology_term_id"].value_counts()
+        print("Scanning cell metadata...")
+        soma_joinids, codes, categories, counts = scan_cell_types(experiment.obs, keep)
+
+    print(f"Collected {len(soma_joinids)} cells of {len(keep)} descendant cell types.")
+    cell_type_counts = pd.Series(counts, index=categories)
+    code_of = {term_id: i for i, term_id in enumerate(categories)}
 
-        # Filter for cell types with a minimum count
-        good_mask = cell_type_counts > min_cell_count
-        valid_cell_types = cell_type_counts[good_mask].keys().tolist()
+    results = {}
+    for root_cl_id in root_cl_ids:
+        selected = select_cell_types(cl, root_cl_id, cell_type_counts, min_cell_count)
+        if not selected:
+            print(f"No cell types matching the criteria under {root_cl_id}.")
+            results[root_cl_id] = pd.DataFrame()
+            continue
+        selected_codes = np.zeros(len(categories), dtype=bool)
+        selected_codes[[code_of[term_id] for term_id in selected]] = True
+        mask = selected_codes[codes]
+        results[root_cl_id] = pd.DataFrame({
+            "soma_joinid": soma_joinids[mask],
+            "cell_type_ontology_term_id": pd.Categorical.from_codes(codes[mask], categories=categories),
+        })
+
+    print("Finished loading and filtering cell metadata.")
+    return results
 
-        # Find the intersection with our descendant cell list
-        intersection_cell_types = list(set(valid_cell_types) & descendant_cell_types)
 
-        print(f"Found {len(intersection_cell_types)} cell types with > {min_cell_count} cells.")
+def _load_from_snapshot(cl, root_cl_ids, min_cell_count, census_version, snapshot):
+    import pandas as pd
+    from src.data_pipeline.obs_snapshot import ObsSnapshot
 
-        if not intersection_cell_types:
-            print("No cell types matching the criteria. Aborting.")
-            return pd.DataFrame()
+    snapshot = ObsSnapshot(snapshot)
+    if snapshot.census_version is not None and snapshot.census_version != census_version:
+        raise ValueError(f"The obs snapshot at {snapshot.path} was taken from Census {snapshot.census_version}, "
+                         f"not {census_version}.")
+    print(f"Reading cell metadata from the obs snapshot at {snapshot.path}...")
+    cell_type_counts = snapshot.cell_type_counts()
 
-        # Build the value filter for the final query
-        # Use .format() to handle quotes in the assay name safely
-        obs_val_filter = '''assay == "10x 3' v3" and is_primary_data == True and cell_type_ontology_term_id in {}'''.format(intersection_cell_types)
+    cell_types = {root_cl_id: select_cell_types(cl, root_cl_id, cell_type_counts, min_cell_count)
+                  for root_cl_id in root_cl_ids}
+    union_cell_types = sorted(set().union(*cell_types.values()))
+    cells = snapshot.read_cells(union_cell_types) if union_cell_types else None
 
-        print("Querying for final cell metadata...")
-        cell_obs_metadata = (
-            experiment.obs.read(value_filter=obs_val_filter,
-                                   column_names=['cell_type_ontology_term_id']).concat().to_pandas()
-        )
+    results = {}
+    for root_cl_id, selected in cell_types.items():
+        if not selected:
+            print(f"No cell types matching the criteria under {root_cl_id}.")
+            results[root_cl_id] = pd.DataFrame()
+            continue
+        mask = cells["cell_type_ontology_term_id"].isin(selected).to_numpy()
+        results[root_cl_id] = cells[mask].reset_index(drop=True)
 
     print("Finished loading and filtering cell metadata.")
-    return cell_obs_metadata
+    return results
+
+
+def load_filtered_cell_metadata(cl, root_cl_id: str, min_cell_count: int = 5000,
+                                census_version: str = CENSUS_VERSION, snapshot=None) -> "pd.DataFrame":
+    """
+    Loads cell metadata from the CellXGene Census, filters for descendants of a given
+    root CL ID with a minimum count, and returns the filtered metadata.
+
+    Args:
+        cl (pronto.Ontology or OntologyIndex): The loaded Cell Ontology.
+        root_cl_id (str): The root Cell Ontology ID (e.g., "CL:0000988") to define the subgraph.
+        min_cell_count (int): The minimum number of cells for a cell type to be included.
+        census_version (str): The CellXGene Census release to read.
+        snapshot (str or Path, optional): Read this local obs snapshot instead of Census.
+
+    Returns:
+        pd.DataFrame: A DataFrame containing the filtered cell metadata.
+    """
+    return load_filtered_cell_metadata_batch(cl, [root_cl_id], min_cell_count, census_version,
+                                             snapshot=snapshot)[root_cl_id]
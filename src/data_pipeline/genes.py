@@ -0,0 +1,101 @@
+import hashlib
+import pickle
+
+from src.utils.paths import PROJECT_ROOT
+from src.data_pipeline.cache import stage_dir, is_cached, mark_cached, resolve_bundle
+from src.data_pipeline.data_loader import CENSUS_VERSION
+
+BIOMART_FILE = PROJECT_ROOT / "hpc_workaround/data/mart_export.txt"
+
+
+def load_protein_coding_genes(biomart_path=BIOMART_FILE):
+    """
+    Returns the Ensembl IDs of all protein-coding genes in a BioMart export,
+    in file order (the gene panel used by the training notebook).
+    """
+    import pandas as pd
+
+    biomart = pd.read_csv(biomart_path)
+    coding_only = biomart[biomart['Gene type'] == 'protein_coding']
+    return coding_only['Gene stable ID'].tolist()
+
+
+def select_biomart_genes(num_genes=2000, biomart_path=BIOMART_FILE):
+    """
+    Selects the first `num_genes` protein-coding genes from a BioMart export.
+    Fast, works offline, no S3 dependencies.
+
+    The gene list is cached under the selection parameters and a hash of the
+    BioMart file.
+
+    Returns:
+        Path: The cached `gene_list.pkl`.
+    """
+    params = {"source": "biomart", "gene_type": "protein_coding", "num_genes": num_genes,
+              "biomart_sha256": hashlib.sha256(biomart_path.read_bytes()).hexdigest()}
+    gene_list_dir = stage_dir("gene_list", params)
+    gene_list_path = gene_list_dir / "gene_list.pkl"
+    if is_cached(gene_list_dir):
+        print(f"Using cached gene list from {gene_list_path}")
+        return gene_list_path
+
+    print(f"Reading BioMart gene list from: {biomart_path}")
+    gene_list = load_protein_coding_genes(biomart_path)[:num_genes]
+    print(f"Selected {len(gene_list)} protein-coding genes")
+
+    gene_list_dir.mkdir(parents=True, exist_ok=True)
+    with open(gene_list_path, "wb") as fp:
+        pickle.dump(gene_list, fp)
+    mark_cached(gene_list_dir, params)
+    print(f"Saved gene list to: {gene_list_path}")
+    return gene_list_path
+
+
+def compute_hvg_genes(root_cl_id='CL:0000988', min_cell_count=5000, census_version=CENSUS_VERSION,
+                      n_top_genes=2000):
+    """
+    Computes highly variable genes over the cell types of a preprocessed subtree,
+    reading expression data from CellXGene Census.
+
+    The outputs are cached under the artifact bundle they were computed for.
+
+    Returns:
+        Path: The cache directory holding `hvg.csv` and `gene_list.pkl`.
+    """
+    bundle = resolve_bundle(root_cl_id=root_cl_id, min_cell_count=min_cell_count, census_version=census_version)
+    all_cell_values = bundle.terms
+
+    params = {"bundle": bundle.content_hash, "census_version": census_version,
+              "n_top_genes": n_top_genes, "batch_key": "dataset_id"}
+    hvg_dir = stage_dir("hvg", params)
+    if is_cached(hvg_dir):
+        print(f"Using cached HVGs from {hvg_dir}")
+        return hvg_dir
+
+    import cellxgene_census
+    from cellxgene_census.experimental.pp import get_highly_variable_genes
+
+    from src.data_pipeline.obs_snapshot import find_obs_snapshot
+    from src.data_pipeline.query_coords import census_source, load_obs_coords
+
+    print(f"Computing HVGs for {len(all_cell_values)} cell types...")
+    with cellxgene_census.open_soma(census_version=census_version) as census:
+        obs_joinids, _ = load_obs_coords(census_source(census_version), census["census_data"]["homo_sapiens"].obs,
+                                         all_cell_values, snapshot=find_obs_snapshot(census_version))
+
+        hvg_df = get_highly_variable_genes(
+            census,
+            organism="Homo sapiens",
+            obs_coords=obs_joinids,
+            n_top_genes=n_top_genes,
+            batch_key="dataset_id"
+        )
+    print(f"Computed {len(hvg_df)} highly variable genes")
+
+    hvg_dir.mkdir(parents=True, exist_ok=True)
+    hvg_df.to_csv(hvg_dir / "hvg.csv")
+    with open(hvg_dir / "gene_list.pkl", "wb") as fp:
+        pickle.dump(hvg_df["feature_id"].tolist(), fp)
+    mark_cached(hvg_dir, params)
+    print(f"Saved HVG dataframe and gene list to: {hvg_dir}")
+    return hvg_dir
@@ -0,0 +1,340 @@
+import hashlib
+import http.client
+import json
+import os
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+from src.data_pipeline.data_loader import CENSUS_VERSION, OBS_VALUE_FILTER
+
+MANIFEST_FORMAT_VERSION = 1
+DEFAULT_WORKERS = 8  # concurrent connections
+DEFAULT_RETRIES = 5
+BLOCK_SIZE = 1 << 20
+
+CENSUS_BUCKET = "s3://cellxgene-census-public-us-west-2/"
+CENSUS_BUCKET_URL = "https://cellxgene-census-public-us-west-2.s3.us-west-2.amazonaws.com/"
+
+# Transient HTTP errors worth retrying
+_RETRY_STATUS = {408, 429, 500, 502, 503, 504}
+
+
+def s3_to_https(uri):
+    """Maps an `s3://` URI of the public Census bucket to its HTTPS URL (other URIs are returned unchanged)."""
+    if uri.startswith(CENSUS_BUCKET):
+        return CENSUS_BUCKET_URL + uri[len(CENSUS_BUCKET):]
+    return uri
+
+
+def with_backoff(fn, retries=DEFAULT_RETRIES, base_delay=1.0, max_delay=60.0, retry_on=(Exception,)):
+    """
+    Calls `fn()`, retrying failures with exponential backoff and jitter.
+
+    Args:
+        fn (callable): The call to make.
+        retries (int): Retries after the first attempt.
+        base_delay (float): Delay before the first retry in seconds; doubled on every retry.
+        max_delay (float): Upper bound of a single delay.
+        retry_on (tuple): Exception types to retry; others are raised immediately.
+
+    Returns:
+        The result of `fn()`.
+    """
+    for attempt in range(retries + 1):
+        try:
+            return fn()
+        except retry_on as e:
+            if attempt == retries or not _is_transient(e):
+                raise
+            delay = min(max_delay, base_delay * 2 ** attempt)
+            time.sleep(delay * random.uniform(0.5, 1.0))
+
+
+def _is_transient(error):
+    if isinstance(error, urllib.error.HTTPError):
+        return error.code in _RETRY_STATUS
+    return True
+
+
+class DownloadManifest:
+    """
+    JSON record of a download run, keyed by dataset ID.
+
+    Each entry has the dataset's source `uri`, its `url`, local `path`, and a
+    `status`: "resolved" (URI known, not downloaded yet), "complete" (downloaded,
+    with its verified `size` and `sha256`) or "failed" (with the last `error`).
+    Entries are updated from several threads and the file is rewritten
+    atomically on every change, so an interrupted run loses no finished work.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        if self.path.exists():
+            with open(self.path) as f:
+                manifest = json.load(f)
+            if manifest.get("format_version") != MANIFEST_FORMAT_VERSION:
+                raise ValueError(f"Unsupported download manifest format {manifest.get('format_version')} "
+                                 f"at {self.path}.")
+            self.entries = manifest["entries"]
+        else:
+            self.entries = {}
+
+    def get(self, dataset_id):
+        return self.entries.get(dataset_id, {})
+
+    def update(self, dataset_id, **fields):
+        with self._lock:
+            self.entries.setdefault(dataset_id, {}).update(fields)
+            self._save()
+
+    def _save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({"format_version": MANIFEST_FORMAT_VERSION, "entries": self.entries}, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def summary(self):
+        statuses = [entry.get("status") for entry in self.entries.values()]
+        return {status: statuses.count(status) for status in sorted(set(statuses), key=str)}
+
+
+def census_dataset_ids(census_version=CENSUS_VERSION, value_filter=OBS_VALUE_FILTER, snapshot=None):
+    """
+    Returns the IDs of the datasets with cells passing the obs filter.
+
+    Args:
+        census_version (str): The CellXGene Census release.
+        value_filter (str): Obs filter; only used when reading Census.
+        snapshot (str or Path, optional): Read the dataset IDs from this obs snapshot
+            (which applies the pipeline's obs filter) instead of scanning Census.
+            Defaults to the local snapshot of `census_version` when there is one.
+
+    Returns:
+        list[str]: Sorted dataset IDs.
+    """
+    from src.data_pipeline.obs_snapshot import find_obs_snapshot
+
+    snapshot = snapshot or (find_obs_snapshot(census_version) if value_filter == OBS_VALUE_FILTER else None)
+    if snapshot is not None:
+        from src.data_pipeline.count_cube import PIPELINE_FILTER
+        from src.data_pipeline.obs_snapshot import ObsSnapshot
+
+        counts = ObsSnapshot(snapshot).read_counts()
+        for column, value in PIPELINE_FILTER.items():
+            counts = counts[counts[column] == value]
+        return sorted(counts["dataset_id"].unique())
+
+    import cellxgene_census
+
+    print(f"Connecting to CellXGene Census ({census_version})...")
+    with cellxgene_census.open_soma(census_version=census_version) as census:
+        dataset_ids = set()
+        for table in census["census_data"]["homo_sapiens"].obs.read(value_filter=value_filter,
+                                                                   column_names=["dataset_id"]):
+            dataset_ids.update(table.column("dataset_id").unique().to_pylist())
+    return sorted(dataset_ids)
+
+
+def resolve_h5ad_uris(dataset_ids, manifest, census_version=CENSUS_VERSION, workers=DEFAULT_WORKERS,
+                      retries=DEFAULT_RETRIES, resolve=None):
+    """
+    Looks up the source H5AD URI of each dataset concurrently, skipping datasets
+    already resolved in the manifest.
+
+    Args:
+        dataset_ids (list[str]): Datasets to resolve.
+        manifest (DownloadManifest): Where the URIs are recorded.
+        census_version (str): The CellXGene Census release.
+        workers (int): Concurrent lookups.
+        retries (int): Retries per dataset, with exponential backoff.
+        resolve (callable, optional): `dataset_id -> uri`. Defaults to
+            `cellxgene_census.get_source_h5ad_uri`.
+
+    Returns:
+        list[str]: The datasets that could not be resolved.
+    """
+    if resolve is None:
+        import cellxgene_census
+
+        def resolve(dataset_id):
+            return cellxgene_census.get_source_h5ad_uri(dataset_id, census_version=census_version)["uri"]
+
+    todo = [d for d in dataset_ids if "uri" not in manifest.get(d)]
+    print(f"Resolving {len(todo)} H5AD URIs ({len(dataset_ids) - len(todo)} already resolved)...")
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(with_backoff, lambda d=d: resolve(d), retries): d for d in todo}
+        for i, future in enumerate(as_completed(futures), 1):
+            dataset_id = futures[future]
+            try:
+                uri = future.result()
+            except Exception as e:
+                manifest.update(dataset_id, status="failed", error=f"resolve: {e}")
+                failed.append(dataset_id)
+                print(f"  [{i}/{len(todo)}] {dataset_id}: failed ({e})")
+                continue
+            manifest.update(dataset_id, uri=uri, url=s3_to_https(uri), status="resolved", error=None)
+            print(f"  [{i}/{len(todo)}] {dataset_id}: {uri}")
+    return failed
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def download_file(url, path, timeout=60):
+    """
+    Downloads `url` to `path`, resuming a previous partial download.
+
+    Bytes go to `<path>.part`, which is continued with an HTTP range request and
+    renamed to `path` once its size matches the size the server reported.
+
+    Returns:
+        int: The size of the downloaded file in bytes.
+
+    Raises:
+        IOError: If the download ends before the reported size.
+        urllib.error.URLError: On connection or HTTP errors.
+    """
+    path = Path(path)
+    part_path = path.with_name(path.name + ".part")
+    offset = part_path.stat().st_size if part_path.exists() else 0
+
+    request = urllib.request.Request(url, headers={"Range": f"bytes={offset}-"} if offset else {})
+    try:
+        response = urllib.request.urlopen(request, timeout=timeout)
+    except urllib.error.HTTPError as e:
+        if e.code != 416:  # Range Not Satisfiable: the part file is at least as large as the file
+            raise
+        part_path.unlink()
+        return download_file(url, path, timeout)
+
+    with response:
+        if response.status == 206:
+            # Content-Range: bytes <offset>-<end>/<total>
+            total = int(response.headers["Content-Range"].rsplit("/", 1)[1])
+            mode = "ab"
+        else:
+            # The server ignored the range request; start over
+            total = int(response.headers["Content-Length"]) if response.headers["Content-Length"] else None
+            offset, mode = 0, "wb"
+        with open(part_path, mode) as f:
+            for block in iter(lambda: response.read(BLOCK_SIZE), b""):
+                f.write(block)
+
+    size = part_path.stat().st_size
+    if total is not None and size != total:
+        raise IOError(f"Incomplete download of {url}: {size} of {total} bytes.")
+    os.replace(part_path, path)
+    return size
+
+
+def download_h5ads(manifest, output_dir, dataset_ids=None, workers=DEFAULT_WORKERS, retries=DEFAULT_RETRIES,
+                   verify=False):
+    """
+    Downloads every resolved dataset of the manifest concurrently.
+
+    Datasets marked complete are skipped if their file still has the recorded
+    size (and, with `verify`, checksum). Interrupted downloads resume where they
+    stopped, and failures are retried with exponential backoff before being
+    marked failed, so re-running retries only what is missing.
+
+    Args:
+        manifest (DownloadManifest): Resolved datasets; updated as files complete.
+        output_dir (str or Path): Directory the H5AD files are saved to.
+        dataset_ids (list[str], optional): Only download these datasets.
+        workers (int): Concurrent downloads.
+        retries (int): Retries per file.
+        verify (bool): Re-hash completed files instead of only checking their size.
+
+    Returns:
+        list[str]: The datasets that failed to download.
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    def is_complete(entry):
+        if entry.get("status") != "complete" or not Path(entry["path"]).exists():
+            return False
+        path = Path(entry["path"])
+        return path.stat().st_size == entry["size"] and (not verify or _sha256(path) == entry["sha256"])
+
+    if dataset_ids is None:
+        dataset_ids = list(manifest.entries)
+    todo = [d for d in dataset_ids if "url" in manifest.get(d) and not is_complete(manifest.get(d))]
+    print(f"Downloading {len(todo)} H5AD files to {output_dir} "
+          f"({len(dataset_ids) - len(todo)} already complete or unresolved)...")
+
+    def download(dataset_id):
+        entry = manifest.get(dataset_id)
+        path = output_dir / entry["url"].rsplit("/", 1)[-1]
+        size = with_backoff(lambda: download_file(entry["url"], path), retries,
+                            retry_on=(OSError, http.client.HTTPException))
+        manifest.update(dataset_id, path=str(path), size=size, sha256=_sha256(path), status="complete", error=None)
+        return size
+
+    failed = []
+    n_bytes = 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(download, d): d for d in todo}
+        for i, future in enumerate(as_completed(futures), 1):
+            dataset_id = futures[future]
+            try:
+                n_bytes += future.result()
+            except Exception as e:
+                manifest.update(dataset_id, status="failed", error=f"download: {e}")
+                failed.append(dataset_id)
+                print(f"  [{i}/{len(todo)}] {dataset_id}: failed ({e})")
+                continue
+            elapsed = time.perf_counter() - start
+            print(f"  [{i}/{len(todo)}] {dataset_id}: done ({n_bytes / 1e9:.1f} GB, "
+                  f"{n_bytes / 1e6 / elapsed:.0f} MB/s)")
+    return failed
+
+
+def fetch_h5ads(output_dir, manifest_path=None, dataset_ids=None, census_version=CENSUS_VERSION,
+                workers=DEFAULT_WORKERS, retries=DEFAULT_RETRIES, resolve=True, download=True, verify=False):
+    """
+    Resolves and downloads the source H5AD files of the Census datasets used by the pipeline.
+
+    Args:
+        output_dir (str or Path): Directory the H5AD files are saved to.
+        manifest_path (str or Path, optional): The download manifest. Defaults to
+            `<output_dir>/manifest.json`.
+        dataset_ids (list[str], optional): Datasets to fetch. Defaults to those with
+            cells passing the pipeline's obs filter (see `census_dataset_ids`), or
+            to the datasets in the manifest if `resolve` is False.
+        census_version (str): The CellXGene Census release.
+        workers (int): Concurrent lookups/downloads.
+        retries (int): Retries per dataset.
+        resolve (bool): If False, only download the datasets already resolved in
+            the manifest, without accessing Census (e.g. on compute nodes).
+        download (bool): If False, only resolve the URIs.
+        verify (bool): Re-hash files already marked complete.
+
+    Returns:
+        DownloadManifest: The updated manifest.
+    """
+    output_dir = Path(output_dir)
+    manifest = DownloadManifest(manifest_path or output_dir / "manifest.json")
+    if resolve:
+        if dataset_ids is None:
+            dataset_ids = census_dataset_ids(census_version)
+            print(f"Found {len(dataset_ids)} matching datasets.")
+        resolve_h5ad_uris(dataset_ids, manifest, census_version, workers, retries)
+    if download:
+        download_h5ads(manifest, output_dir, dataset_ids, workers, retries, verify)
+    print(f"Manifest {manifest.path}: {manifest.summary()}")
+    return manifest
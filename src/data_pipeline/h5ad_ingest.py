@@ -0,0 +1,270 @@
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+
+from src.data_pipeline.cache import stage_dir, is_cached, mark_cached
+from src.data_pipeline.data_loader import OBS_ASSAY
+from src.data_pipeline.shards import (
+    DEFAULT_SHARD_SIZE,
+    SHARD_FORMAT_VERSION,
+    TARGET_COLUMN,
+    VALUE_DTYPES,
+    ShardStore,
+    _cast_values,
+    _coo_to_csr,
+    _write_shard,
+    concat_csr,
+)
+
+
+def find_h5ads(h5ad_dir):
+    """Returns the `.h5ad` files of a directory, sorted by name."""
+    return sorted(Path(h5ad_dir).glob("*.h5ad"))
+
+
+def h5ad_shard_params(bundle, h5ad_files, gene_list, value_dtype="uint16", shard_size=DEFAULT_SHARD_SIZE):
+    """The inputs that determine a shard store ingested from H5AD files."""
+    return {
+        "bundle": bundle.content_hash,
+        "h5ad_files": [{"name": Path(f).name, "size": Path(f).stat().st_size} for f in h5ad_files],
+        "genes_sha256": hashlib.sha256("\n".join(gene_list).encode()).hexdigest(),
+        "obs_filter": {"assay": OBS_ASSAY, "is_primary_data": True},
+        "value_dtype": value_dtype,
+        "shard_size": shard_size,
+    }
+
+
+def _select_cells(obs, mapping_dict):
+    """Positions and label codes of the cells passing the pipeline's obs filter and of the bundle's cell types."""
+    cell_types = obs[TARGET_COLUMN].astype(str)
+    keep = ((obs["assay"].astype(str) == OBS_ASSAY).to_numpy()
+            & obs["is_primary_data"].to_numpy(dtype=bool)
+            & cell_types.isin(list(mapping_dict)).to_numpy())
+    rows = np.flatnonzero(keep)
+    return rows, cell_types.iloc[rows].map(mapping_dict).to_numpy(dtype=np.int32)
+
+
+def _ingest_h5ad_worker(h5ad_path, out_path, mapping_dict, gene_list, value_dtype, shard_size, read_size):
+    """
+    Writes the selected cells of one H5AD file as shards under `out_path`.
+
+    The file is opened in backed mode: only obs and var are loaded, and the
+    expression matrix is read in blocks of `read_size` consecutive rows.
+
+    Returns:
+        dict: The file's entry in the store manifest.
+    """
+    import anndata
+    import scipy.sparse
+
+    h5ad_path = Path(h5ad_path)
+    adata = anndata.read_h5ad(h5ad_path, backed="r")
+    try:
+        rows, labels = _select_cells(adata.obs, mapping_dict)
+        # CELLxGENE files keep the raw counts in raw.X when X is normalized
+        if adata.raw is not None:
+            X, feature_ids = adata.raw.X, adata.raw.var_names
+        else:
+            X, feature_ids = adata.X, adata.var_names
+
+        # File gene column -> gene panel column (-1 for genes outside the panel)
+        panel_index = {gene: i for i, gene in enumerate(gene_list)}
+        column_map = np.array([panel_index.get(g, -1) for g in feature_ids], dtype=np.int64)
+        n_matched = int((column_map >= 0).sum())
+
+        tmp_path = out_path.with_name(out_path.name + ".tmp")
+        if tmp_path.exists():
+            shutil.rmtree(tmp_path)
+        tmp_path.mkdir(parents=True)
+
+        shards = []
+        pending = []  # CSR blocks of the shard being filled
+        n_pending = 0
+        n_clipped = 0
+
+        def flush():
+            indptr, indices, data = concat_csr([p[:3] for p in pending])
+            name = f"shard_{len(shards):05d}"
+            _write_shard(tmp_path / name, indptr, indices, data,
+                         np.concatenate([p[3] for p in pending]), np.concatenate([p[4] for p in pending]))
+            shards.append({"name": f"{out_path.name}/{name}", "n_cells": int(len(indptr) - 1),
+                           "nnz": int(indptr[-1])})
+            pending.clear()
+
+        n_rows = adata.n_obs
+        for start in range(0, n_rows, read_size):
+            stop = min(start + read_size, n_rows)
+            lo, hi = np.searchsorted(rows, [start, stop])
+            if lo == hi:
+                continue
+            # One contiguous read of the block, then keep the selected rows
+            block = X[start:stop]
+            block = scipy.sparse.csr_matrix(block)[rows[lo:hi] - start]
+            block_rows = np.repeat(np.arange(hi - lo), np.diff(block.indptr))
+            cols = column_map[block.indices]
+            in_panel = cols >= 0
+            values, clipped = _cast_values(block.data[in_panel], value_dtype)
+            n_clipped += clipped
+            indptr, indices, data = _coo_to_csr(block_rows[in_panel], cols[in_panel].astype(np.uint16), values,
+                                                hi - lo)
+
+            offset = 0
+            while offset < hi - lo:
+                take = min(shard_size - n_pending, hi - lo - offset)
+                a, b = indptr[offset], indptr[offset + take]
+                # `soma_joinids` holds the cell's row in its source file
+                pending.append((indptr[offset:offset + take + 1] - a, indices[a:b], data[a:b],
+                                labels[lo + offset:lo + offset + take],
+                                rows[lo + offset:lo + offset + take].astype(np.int64)))
+                n_pending += take
+                offset += take
+                if n_pending == shard_size:
+                    flush()
+                    n_pending = 0
+        if pending:
+            flush()
+    finally:
+        adata.file.close()
+
+    source = {
+        "source": h5ad_path.name,
+        "n_cells": int(len(rows)),
+        "n_cells_in_file": int(n_rows),
+        "n_genes_matched": n_matched,
+        "n_clipped": n_clipped,
+        "shards": shards,
+    }
+    with open(tmp_path / "source.json", "w") as f:
+        json.dump(source, f, indent=2)
+    if out_path.exists():
+        shutil.rmtree(out_path)
+    os.replace(tmp_path, out_path)
+    return source
+
+
+def ingest_h5ads(bundle, h5ad_files, gene_list, path, value_dtype="uint16", shard_size=DEFAULT_SHARD_SIZE,
+                 workers=None, read_size=1 << 14, metadata=None):
+    """
+    Writes the bundle's cells from downloaded H5AD files as CSR training shards,
+    without going through a SOMA experiment.
+
+    Cells are selected with the same filter as `load_filtered_cell_metadata`
+    (primary 10x 3' v3 cells) and restricted to the bundle's terms; genes are
+    aligned to `gene_list`, whose order becomes the column order of the store
+    (genes missing from a file are all-zero columns for its cells). Each file is
+    processed by its own worker process, reading the file in backed mode, and
+    gets its own shards (`<file stem>/shard_*`), so the store has the layout and
+    manifest of `export_shards` and is read with `ShardStore`/`ShardDataset`.
+    Since H5AD cells have no Census soma_joinid, the `soma_joinids` arrays hold
+    each cell's row in its source file; the manifest's `sources` list the files.
+
+    Finished files are kept in `<path>.tmp` until the store is complete, so
+    re-running after an interruption only processes the remaining files.
+
+    Args:
+        bundle (ArtifactBundle): Provides the cell types (`terms`) and label codes (`mapping_dict`).
+        h5ad_files (list): Paths of the H5AD files (e.g. `find_h5ads(directory)`).
+        gene_list (list): Ensembl IDs of the genes to keep.
+        path (str or Path): Output directory.
+        value_dtype (str): "uint16" for raw counts, "float16" for real-valued data.
+        shard_size (int): Maximum cells per shard.
+        workers (int, optional): Worker processes. Defaults to one per file, up to the CPU count.
+        read_size (int): Rows per read from a file.
+        metadata (dict, optional): Stored in the manifest (e.g. the cache params).
+
+    Returns:
+        ShardStore: The written store.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    if value_dtype not in VALUE_DTYPES:
+        raise ValueError(f"value_dtype must be one of {list(VALUE_DTYPES)}, got {value_dtype!r}")
+    if len(gene_list) > np.iinfo(np.uint16).max:
+        raise ValueError(f"Gene column indices are stored as uint16; got {len(gene_list)} genes.")
+    h5ad_files = [Path(f) for f in h5ad_files]
+    stems = [f.stem for f in h5ad_files]
+    if len(set(stems)) < len(stems):
+        raise ValueError("H5AD file names must be unique.")
+
+    path = Path(path)
+    tmp_path = path.with_name(path.name + ".tmp")
+    run_params = {"bundle": bundle.content_hash, "genes": list(gene_list), "value_dtype": value_dtype,
+                  "shard_size": shard_size}
+    if tmp_path.exists() and (not (tmp_path / "run.json").exists()
+                              or json.loads((tmp_path / "run.json").read_text()) != run_params):
+        shutil.rmtree(tmp_path)
+    tmp_path.mkdir(parents=True, exist_ok=True)
+    (tmp_path / "run.json").write_text(json.dumps(run_params))
+
+    sources = {}
+    todo = []
+    for h5ad_path in h5ad_files:
+        done = tmp_path / h5ad_path.stem / "source.json"
+        if done.exists():
+            sources[h5ad_path.stem] = json.loads(done.read_text())
+        else:
+            todo.append(h5ad_path)
+    print(f"Ingesting {len(todo)} H5AD files into {path} ({len(sources)} already done)...")
+
+    args = (bundle.mapping_dict, list(gene_list), value_dtype, shard_size, read_size)
+    if workers is None:
+        workers = min(len(todo), os.cpu_count() or 1)
+    if workers <= 1 or len(todo) <= 1:
+        for i, h5ad_path in enumerate(todo, 1):
+            sources[h5ad_path.stem] = _ingest_h5ad_worker(h5ad_path, tmp_path / h5ad_path.stem, *args)
+            print(f"  [{i}/{len(todo)}] {h5ad_path.name}: {sources[h5ad_path.stem]['n_cells']} cells")
+    elif todo:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {h5ad_path: executor.submit(_ingest_h5ad_worker, h5ad_path, tmp_path / h5ad_path.stem, *args)
+                       for h5ad_path in todo}
+            for i, (h5ad_path, future) in enumerate(futures.items(), 1):
+                sources[h5ad_path.stem] = future.result()
+                print(f"  [{i}/{len(todo)}] {h5ad_path.name}: {sources[h5ad_path.stem]['n_cells']} cells")
+
+    sources = [sources[stem] for stem in stems]
+    shards = [shard for source in sources for shard in source["shards"]]
+    n_clipped = sum(source["n_clipped"] for source in sources)
+    if n_clipped:
+        print(f"Warning: clipped {n_clipped} values above 65535 to fit uint16.")
+    manifest = {
+        "format_version": SHARD_FORMAT_VERSION,
+        "n_cells": sum(source["n_cells"] for source in sources),
+        "n_genes": len(gene_list),
+        "value_dtype": value_dtype,
+        "n_clipped": n_clipped,
+        "feature_ids": list(gene_list),
+        "bundle": bundle.content_hash,
+        "shards": shards,
+        "sources": [{k: v for k, v in source.items() if k != "shards"} for source in sources],
+        "metadata": metadata or {},
+    }
+    with open(tmp_path / "manifest.json", "w") as f:
+        json.dump(manifest, f, indent=2)
+    (tmp_path / "run.json").unlink()
+
+    if path.exists():
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+    print(f"Wrote {len(shards)} shards ({manifest['n_cells']} cells from {len(sources)} files) to {path}")
+    return ShardStore(path)
+
+
+def ingest_h5ads_cached(bundle, h5ad_files, gene_list, value_dtype="uint16", shard_size=DEFAULT_SHARD_SIZE,
+                        workers=None, force=False, cache_dir=None):
+    """
+    Returns the shard store for a bundle, gene panel and set of H5AD files,
+    ingesting it into the cache on first use (see `ingest_h5ads`).
+    """
+    params = h5ad_shard_params(bundle, h5ad_files, gene_list, value_dtype, shard_size)
+    path = stage_dir("shards", params, cache_dir)
+    if is_cached(path) and not force:
+        print(f"Using cached shards from {path}")
+        return ShardStore(path)
+    store = ingest_h5ads(bundle, h5ad_files, gene_list, path, value_dtype=value_dtype, shard_size=shard_size,
+                         workers=workers, metadata=params)
+    mark_cached(path, params)
+    return store
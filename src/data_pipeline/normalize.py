@@ -0,0 +1,175 @@
+import hashlib
+import time
+
+import numpy as np
+
+from src.data_pipeline.cache import stage_dir, is_cached, mark_cached
+
+DEFAULT_TARGET_SUM = 1e4
+
+
+class Normalizer:
+    """
+    Normalizes batches of counts: library-size normalization to `target_sum`,
+    log1p, then optionally division by each gene's standard deviation and
+    clipping at `clip`.
+
+    Every step maps zero to zero (genes are scaled but not centered), so the
+    normalization runs on the non-zero values of CSR data before anything is
+    densified: `normalize_csr` makes one float32 copy of the values and applies
+    all steps to it in place, with the per-cell and per-gene factors gathered
+    by index, instead of allocating a dense intermediate per step.
+
+    Args:
+        target_sum (float, optional): Scale each cell's counts to sum to this;
+            None skips library-size normalization.
+        log1p (bool): Apply log1p after library-size normalization.
+        gene_std (np.ndarray, optional): Per-gene standard deviations of the
+            values after the previous steps (see `load_gene_stats`); given, values
+            are divided by them. Genes with zero deviation are left unscaled.
+        clip (float, optional): Upper bound of the final values.
+    """
+
+    def __init__(self, target_sum=DEFAULT_TARGET_SUM, log1p=True, gene_std=None, clip=None):
+        self.target_sum = target_sum
+        self.log1p = log1p
+        self.clip = clip
+        self.gene_scale = None
+        if gene_std is not None:
+            gene_std = np.asarray(gene_std, dtype=np.float64)
+            self.gene_scale = np.divide(1.0, gene_std, out=np.ones_like(gene_std), where=gene_std > 0)
+            self.gene_scale = self.gene_scale.astype(np.float32)
+
+    def params(self) -> dict:
+        """The settings of the normalization, e.g. for a cache key."""
+        return {
+            "target_sum": self.target_sum,
+            "log1p": self.log1p,
+            "scaled": self.gene_scale is not None,
+            "clip": self.clip,
+        }
+
+    def normalize_csr(self, indptr, indices, data):
+        """
+        Returns the normalized float32 values of CSR rows (same indptr and indices).
+
+        Args:
+            indptr, indices, data: CSR arrays of the cells (any numeric value dtype).
+        """
+        values = np.array(data, dtype=np.float32)
+        if self.target_sum is not None:
+            # Row sums from the running sum of the values, in float64 to keep long rows exact
+            cumsum = np.concatenate([[0.0], np.cumsum(values, dtype=np.float64)])
+            row_sums = cumsum[indptr[1:]] - cumsum[indptr[:-1]]
+            factors = np.divide(self.target_sum, row_sums, out=np.zeros_like(row_sums), where=row_sums > 0)
+            values *= np.repeat(factors.astype(np.float32), np.diff(indptr))
+        self._finish(values, indices)
+        return values
+
+    def normalize_dense(self, X):
+        """Returns the normalized float32 copy of a dense (cells x genes) array."""
+        X = np.array(X, dtype=np.float32)
+        if self.target_sum is not None:
+            row_sums = X.sum(axis=1, dtype=np.float64)
+            factors = np.divide(self.target_sum, row_sums, out=np.zeros_like(row_sums), where=row_sums > 0)
+            X *= factors.astype(np.float32)[:, None]
+        self._finish(X, None)
+        return X
+
+    def _finish(self, values, indices):
+        """log1p, gene scaling and clipping, in place."""
+        if self.log1p:
+            np.log1p(values, out=values)
+        if self.gene_scale is not None:
+            values *= self.gene_scale[indices] if indices is not None else self.gene_scale
+        if self.clip is not None:
+            np.minimum(values, self.clip, out=values)
+
+    def __call__(self, X):
+        """
+        Normalizes a batch given as a torch tensor (dense or sparse CSR, on the
+        CPU) or a dense NumPy array, returning the same kind.
+        """
+        import torch
+
+        if not isinstance(X, torch.Tensor):
+            return self.normalize_dense(X)
+        if X.layout == torch.sparse_csr:
+            values = self.normalize_csr(X.crow_indices().numpy(), X.col_indices().numpy(), X.values().numpy())
+            return torch.sparse_csr_tensor(X.crow_indices(), X.col_indices(), torch.from_numpy(values), size=X.shape)
+        return torch.from_numpy(self.normalize_dense(X.numpy()))
+
+
+def gene_stats_params(store, target_sum=DEFAULT_TARGET_SUM, log1p=True) -> dict:
+    """The inputs that determine the gene statistics of a shard store."""
+    manifest = (store.path / "manifest.json").read_bytes()
+    return {
+        "shards_manifest_sha256": hashlib.sha256(manifest).hexdigest(),
+        "target_sum": target_sum,
+        "log1p": log1p,
+    }
+
+
+def compute_gene_stats(store, target_sum=DEFAULT_TARGET_SUM, log1p=True, block_size=1 << 16):
+    """
+    Computes per-gene statistics of the library-size normalized (and log1p)
+    values of all cells of a shard store, in one streaming pass over blocks of
+    `block_size` cells.
+
+    Returns:
+        dict: "mean", "std" (float64, over all cells, zeros included) and
+        "n_cells_expressed" (int64) per gene, and "n_cells".
+    """
+    normalizer = Normalizer(target_sum=target_sum, log1p=log1p)
+    sums = np.zeros(store.n_genes)
+    sums_sq = np.zeros(store.n_genes)
+    n_expressed = np.zeros(store.n_genes, dtype=np.int64)
+    started = time.perf_counter()
+    for shard_index, n_cells in enumerate(store.shard_sizes):
+        for start in range(0, int(n_cells), block_size):
+            indptr, indices, data, _ = store.read_block(shard_index, start, min(start + block_size, int(n_cells)))
+            values = normalizer.normalize_csr(indptr, indices, data).astype(np.float64)
+            sums += np.bincount(indices, weights=values, minlength=store.n_genes)
+            sums_sq += np.bincount(indices, weights=values * values, minlength=store.n_genes)
+            n_expressed += np.bincount(indices, minlength=store.n_genes)
+    n = len(store)
+    mean = sums / max(n, 1)
+    std = np.sqrt(np.maximum(sums_sq / max(n, 1) - mean * mean, 0.0))
+    print(f"Computed statistics of {store.n_genes} genes over {n} cells in {time.perf_counter() - started:.1f}s")
+    return {"mean": mean, "std": std, "n_cells_expressed": n_expressed, "n_cells": n}
+
+
+def load_gene_stats(store, target_sum=DEFAULT_TARGET_SUM, log1p=True, force=False, cache_dir=None):
+    """
+    Returns the gene statistics of a shard store (see `compute_gene_stats`),
+    computing them on first use and caching them keyed by the store's manifest
+    and the normalization settings.
+    """
+    params = gene_stats_params(store, target_sum, log1p)
+    path = stage_dir("gene_stats", params, cache_dir)
+    names = ("mean", "std", "n_cells_expressed")
+    if is_cached(path) and not force:
+        stats = {name: np.load(path / f"{name}.npy") for name in names}
+        stats["n_cells"] = len(store)
+        return stats
+    stats = compute_gene_stats(store, target_sum, log1p)
+    path.mkdir(parents=True, exist_ok=True)
+    for name in names:
+        np.save(path / f"{name}.npy", stats[name])
+    mark_cached(path, params)
+    return stats
+
+
+def build_normalizer(store=None, target_sum=DEFAULT_TARGET_SUM, log1p=True, scale=False, clip=None, cache_dir=None):
+    """
+    Creates a `Normalizer`, loading the gene statistics of `store` when genes are scaled.
+
+    Raises:
+        ValueError: If `scale` is requested without a shard store to compute the statistics from.
+    """
+    gene_std = None
+    if scale:
+        if store is None:
+            raise ValueError("Gene scaling needs a shard store to compute the gene statistics from.")
+        gene_std = load_gene_stats(store, target_sum, log1p, cache_dir=cache_dir)["std"]
+    return Normalizer(target_sum=target_sum, log1p=log1p, gene_std=gene_std, clip=clip)
@@ -0,0 +1,206 @@
+import json
+import os
+import shutil
+from pathlib import Path
+
+from src.utils.paths import PROJECT_ROOT
+from src.data_pipeline.data_loader import CENSUS_VERSION, OBS_ASSAY
+
+SNAPSHOT_FORMAT_VERSION = 2
+SNAPSHOT_DIR = PROJECT_ROOT / "data" / "processed" / "obs_snapshot"
+
+# The obs columns the pipeline filters or groups on
+SNAPSHOT_COLUMNS = ["soma_joinid", "cell_type_ontology_term_id", "assay", "is_primary_data", "tissue_general",
+                    "dataset_id"]
+PARTITION_COLUMNS = ["cell_type_ontology_term_id", "assay"]
+COUNT_COLUMNS = ["cell_type_ontology_term_id", "assay", "is_primary_data", "tissue_general", "dataset_id"]
+
+
+def _snapshot_schema():
+    import pyarrow as pa
+
+    return pa.schema([
+        ("soma_joinid", pa.int64()),
+        ("cell_type_ontology_term_id", pa.string()),
+        ("assay", pa.string()),
+        ("is_primary_data", pa.bool_()),
+        ("tissue_general", pa.string()),
+        ("dataset_id", pa.string()),
+    ])
+
+
+def default_snapshot_path(census_version=CENSUS_VERSION):
+    """Where `snapshot_obs` writes (and `find_obs_snapshot` looks for) the snapshot of a Census release."""
+    return SNAPSHOT_DIR / census_version
+
+
+def find_obs_snapshot(census_version=CENSUS_VERSION):
+    """
+    Returns the local obs snapshot of a Census release, or None if it has not been taken.
+    """
+    path = default_snapshot_path(census_version)
+    return path if (path / "manifest.json").exists() else None
+
+
+def snapshot_obs(census_version=CENSUS_VERSION, soma_uri=None, path=None):
+    """
+    Copies the obs columns used by the pipeline into a local Parquet dataset, so
+    that cell filtering works offline.
+
+    The cells are written as a hive-partitioned dataset (`obs/cell_type_ontology_term_id=.../assay=.../`),
+    so reading the cells of a set of cell types only opens their partitions, next to
+    `counts.parquet` with the number of cells per (cell type, assay, is_primary_data,
+    tissue_general, dataset_id), from which `CountCube` is built.
+    The obs table is streamed in a single pass and the snapshot is written to a
+    temporary directory first, so an interrupted run leaves no partial snapshot.
+
+    Args:
+        census_version (str): The CellXGene Census release to read. When `soma_uri`
+            is given, this only labels the snapshot (pass None if unknown).
+        soma_uri (str, optional): Read a local SOMA experiment (e.g. the
+            homo_sapiens experiment downloaded to the cluster) instead of Census.
+        path (str or Path, optional): Output directory. Defaults to
+            `default_snapshot_path(census_version)`, where the pipeline finds it.
+
+    Returns:
+        Path: The snapshot directory.
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    if path is None:
+        if census_version is None:
+            raise ValueError("Pass an output path or a census_version to label the snapshot with.")
+        path = default_snapshot_path(census_version)
+    path = Path(path)
+    tmp_path = path.with_name(path.name + ".tmp")
+    if tmp_path.exists():
+        shutil.rmtree(tmp_path)
+    tmp_path.mkdir(parents=True)
+
+    schema = _snapshot_schema()
+    count_tables = []
+    n_cells = 0
+
+    def batches(obs):
+        nonlocal n_cells
+        for table in obs.read(column_names=SNAPSHOT_COLUMNS):
+            table = table.select(SNAPSHOT_COLUMNS).cast(schema)
+            n_cells += table.num_rows
+            count_tables.append(table.group_by(COUNT_COLUMNS).aggregate([("soma_joinid", "count")]))
+            yield from table.to_batches()
+            print(f"  {n_cells} cells", end="\r")
+
+    def write(obs):
+        ds.write_dataset(
+            batches(obs), tmp_path / "obs", schema=schema, format="parquet",
+            partitioning=ds.partitioning(schema=pa.schema([schema.field(c) for c in PARTITION_COLUMNS]),
+                                         flavor="hive"),
+            max_partitions=1 << 16, existing_data_behavior="error",
+            # Buffer small partitions instead of writing a row group per input batch
+            min_rows_per_group=1 << 16, max_rows_per_group=1 << 20,
+        )
+
+    if soma_uri is not None:
+        import tiledbsoma as soma
+
+        print(f"Snapshotting obs of the local SOMA experiment at {soma_uri}...")
+        with soma.Experiment.open(soma_uri) as experiment:
+            write(experiment.obs)
+        source = str(soma_uri)
+    else:
+        import cellxgene_census
+
+        print(f"Connecting to CellXGene Census ({census_version})...")
+        with cellxgene_census.open_soma(census_version=census_version) as census:
+            print("Snapshotting obs...")
+            write(census["census_data"]["homo_sapiens"].obs)
+        source = f"census:{census_version}"
+    print()
+
+    counts = (pa.concat_tables(count_tables).to_pandas()
+              .groupby(COUNT_COLUMNS, observed=True)["soma_joinid_count"].sum()
+              .rename("n_cells").reset_index())
+    counts.to_parquet(tmp_path / "counts.parquet", index=False)
+
+    manifest = {
+        "format_version": SNAPSHOT_FORMAT_VERSION,
+        "source": source,
+        "census_version": census_version,
+        "columns": SNAPSHOT_COLUMNS,
+        "partitioning": PARTITION_COLUMNS,
+        "n_cells": n_cells,
+    }
+    with open(tmp_path / "manifest.json", "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    if path.exists():
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+    print(f"Saved obs snapshot of {n_cells} cells ({len(counts)} count groups) to {path}")
+    return path
+
+
+class ObsSnapshot:
+    """
+    A local obs snapshot written by `snapshot_obs`.
+
+    Queries apply the pipeline's obs filter (primary 10x 3' v3 cells, see
+    `OBS_VALUE_FILTER`) on the snapshot's columns instead of in TileDB.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path / "manifest.json") as f:
+            self.manifest = json.load(f)
+        if self.manifest["format_version"] != SNAPSHOT_FORMAT_VERSION:
+            raise ValueError(
+                f"Unsupported obs snapshot format {self.manifest['format_version']} at {self.path}; "
+                "take the snapshot again."
+            )
+
+    @property
+    def census_version(self):
+        return self.manifest["census_version"]
+
+    def read_counts(self):
+        """
+        Returns:
+            pd.DataFrame: The number of cells (`n_cells`) per combination of `COUNT_COLUMNS`.
+        """
+        import pandas as pd
+
+        return pd.read_parquet(self.path / "counts.parquet")
+
+    def cell_type_counts(self):
+        """
+        Returns:
+            pd.Series: Number of cells passing the obs filter per cell type.
+        """
+        counts = self.read_counts()
+        counts = counts[(counts["assay"] == OBS_ASSAY) & counts["is_primary_data"]]
+        return counts.groupby("cell_type_ontology_term_id")["n_cells"].sum()
+
+    def read_cells(self, cell_types, columns=("soma_joinid", "cell_type_ontology_term_id")):
+        """
+        Reads the cells of the given types that pass the obs filter, ordered by soma_joinid.
+
+        Only the partitions of the requested cell types (and the filtered assay) are read.
+
+        Returns:
+            pd.DataFrame: The requested columns, with a categorical cell type column.
+        """
+        import pyarrow.dataset as ds
+
+        dataset = ds.dataset(self.path / "obs", schema=_snapshot_schema(), format="parquet",
+                             partitioning="hive")
+        expression = (
+            ds.field("cell_type_ontology_term_id").isin(list(cell_types))
+            & (ds.field("assay") == OBS_ASSAY)
+            & (ds.field("is_primary_data") == True)  # noqa: E712
+        )
+        table = dataset.to_table(columns=list(columns), filter=expression).sort_by("soma_joinid")
+        cells = table.to_pandas()
+        if "cell_type_ontology_term_id" in cells:
+            cells["cell_type_ontology_term_id"] = cells["cell_type_ontology_term_id"].astype("category")
+        return cells
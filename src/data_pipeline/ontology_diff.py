@@ -0,0 +1,237 @@
+import json
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from src.data_pipeline.artifacts import save_artifact_bundle, load_artifact_bundle
+from src.data_pipeline.cache import CACHE_DIR, stage_dir
+
+
+@dataclass
+class OntologyDiff:
+    """
+    The differences between two Cell Ontology releases, optionally restricted to a
+    set of terms (e.g. the terms of one artifact bundle).
+
+    `changed_ancestors` / `changed_descendants` list the terms present in both
+    releases whose (reflexive) ancestor / descendant sets differ, compared by term ID.
+    """
+    old_release: str
+    new_release: str
+    added: list = field(default_factory=list)
+    removed: list = field(default_factory=list)
+    changed_ancestors: list = field(default_factory=list)
+    changed_descendants: list = field(default_factory=list)
+    moved_to_leaf: list = field(default_factory=list)
+    moved_to_internal: list = field(default_factory=list)
+
+    @property
+    def is_empty(self):
+        return not (self.added or self.removed or self.changed_ancestors or self.changed_descendants)
+
+    def summary(self):
+        return (
+            f"{self.old_release} -> {self.new_release}: "
+            f"{len(self.added)} added, {len(self.removed)} removed, "
+            f"{len(self.changed_ancestors)} with changed ancestors, "
+            f"{len(self.changed_descendants)} with changed descendants, "
+            f"{len(self.moved_to_leaf)} became leaves, {len(self.moved_to_internal)} became internal"
+        )
+
+
+def _changed_rows(old_packed, new_packed, old_rows, new_rows, old_cols, new_cols, n_old, n_new, chunk_size):
+    """
+    Compares closure rows of the same terms in two indexes, column by column over a
+    shared term universe. `old_cols` / `new_cols` give each universe term's position
+    in the respective index (-1 if absent there, so the term never matches).
+    """
+    changed = np.zeros(len(old_rows), dtype=bool)
+    old_ok = old_cols >= 0
+    new_ok = new_cols >= 0
+    for start in range(0, len(old_rows), chunk_size):
+        stop = start + chunk_size
+        old_block = np.unpackbits(old_packed[old_rows[start:stop]], axis=1, count=n_old).view(bool)
+        new_block = np.unpackbits(new_packed[new_rows[start:stop]], axis=1, count=n_new).view(bool)
+        old_sets = np.zeros((len(old_block), len(old_cols)), dtype=bool)
+        new_sets = np.zeros((len(new_block), len(new_cols)), dtype=bool)
+        old_sets[:, old_ok] = old_block[:, old_cols[old_ok]]
+        new_sets[:, new_ok] = new_block[:, new_cols[new_ok]]
+        changed[start:stop] = (old_sets != new_sets).any(axis=1)
+    return changed
+
+
+def diff_ontology_indexes(old_index, new_index, term_ids=None, chunk_size=2048):
+    """
+    Finds the terms whose position in the is_a hierarchy changed between two releases.
+
+    Args:
+        old_index (OntologyIndex): The previous release.
+        new_index (OntologyIndex): The new release.
+        term_ids (list, optional): Restrict the comparison to these terms, i.e. only
+            report terms among them and only compare ancestor/descendant sets within
+            them. Defaults to every term in either release.
+        chunk_size (int): Number of closure rows unpacked at a time.
+
+    Returns:
+        OntologyDiff: The added, removed and changed terms.
+    """
+    if term_ids is None:
+        universe = np.union1d(np.asarray(old_index.term_ids), np.asarray(new_index.term_ids))
+    else:
+        universe = np.asarray(list(dict.fromkeys(term_ids)), dtype=str)
+
+    old_pos = old_index.indices_of(universe)
+    new_pos = new_index.indices_of(universe)
+    in_old = old_pos >= 0
+    in_new = new_pos >= 0
+    common = in_old & in_new
+
+    diff = OntologyDiff(
+        old_release=old_index.data_version,
+        new_release=new_index.data_version,
+        added=universe[in_new & ~in_old].tolist(),
+        removed=universe[in_old & ~in_new].tolist(),
+    )
+
+    common_ids = universe[common]
+    if len(common_ids) == 0:
+        return diff
+    old_rows, new_rows = old_pos[common], new_pos[common]
+    n_old, n_new = len(old_index), len(new_index)
+
+    changed = _changed_rows(old_index.ancestors_packed, new_index.ancestors_packed,
+                            old_rows, new_rows, old_pos, new_pos, n_old, n_new, chunk_size)
+    diff.changed_ancestors = common_ids[changed].tolist()
+    changed = _changed_rows(old_index.descendants_packed, new_index.descendants_packed,
+                            old_rows, new_rows, old_pos, new_pos, n_old, n_new, chunk_size)
+    diff.changed_descendants = common_ids[changed].tolist()
+
+    old_leaf = old_index.leaf_mask(common_ids)
+    new_leaf = new_index.leaf_mask(common_ids)
+    diff.moved_to_leaf = common_ids[~old_leaf & new_leaf].tolist()
+    diff.moved_to_internal = common_ids[old_leaf & ~new_leaf].tolist()
+    return diff
+
+
+def _bundle_closure(bundle):
+    """
+    Recovers the ancestor relation restricted to a bundle's terms, in bundle order.
+
+    Leaf nodes have no subclasses, so a leaf is only ever its own ancestor; every
+    other ancestor is an internal node and is recorded in the parent-child matrix
+    (built with include_self=True).
+    """
+    n_leaf = bundle.manifest["n_leaf"]
+    parent_child = bundle.parent_child
+    if not parent_child[np.arange(n_leaf, len(bundle.terms)), np.arange(len(bundle.internal_values))].all():
+        raise ValueError(f"Bundle at {bundle.path} was not built with include_self=True; rebuild it instead.")
+    closure = np.zeros((len(bundle.terms), len(bundle.terms)), dtype=bool)
+    closure[np.arange(n_leaf), np.arange(n_leaf)] = True
+    closure[:, n_leaf:] = parent_child
+    return closure
+
+
+def patch_artifact_bundle(bundle, old_index, new_index, path, metadata=None):
+    """
+    Updates an artifact bundle built against `old_index` to the `new_index` release
+    without rebuilding it.
+
+    Only the closure rows of terms whose ancestor set changed are read from the new
+    index; every other entry is carried over from the existing bundle. The leaf /
+    internal split is recomputed, so terms can move between the two groups (which
+    changes `mapping_dict` and therefore the model's output layer).
+
+    Args:
+        bundle (ArtifactBundle): The bundle for the old release.
+        old_index (OntologyIndex): The release the bundle was built against.
+        new_index (OntologyIndex): The new release.
+        path (str or Path): Where to write the patched bundle.
+        metadata (dict, optional): Manifest metadata for the patched bundle.
+            Defaults to the old bundle's metadata with the new ontology release.
+
+    Returns:
+        tuple: (ArtifactBundle, OntologyDiff) the patched bundle and the diff
+        restricted to the bundle's terms.
+
+    Raises:
+        ValueError: If some of the bundle's terms no longer exist in the new release.
+    """
+    from src.data_pipeline.preprocess_ontology import ontology_matrices_from_closure
+
+    terms = list(bundle.terms)
+    diff = diff_ontology_indexes(old_index, new_index, terms)
+    if diff.removed:
+        raise ValueError(f"{len(diff.removed)} bundle terms are missing from the new release "
+                         f"(e.g. {diff.removed[:5]}); a full rebuild is required.")
+
+    closure = _bundle_closure(bundle)
+    if diff.changed_ancestors:
+        position = {term_id: i for i, term_id in enumerate(terms)}
+        rows = np.array([position[t] for t in diff.changed_ancestors], dtype=np.int64)
+        closure[rows] = new_index.ancestor_matrix(diff.changed_ancestors, terms)
+
+    is_leaf = new_index.leaf_mask(terms)
+    leaf_values = sorted(t for t, leaf in zip(terms, is_leaf) if leaf)
+    internal_values = sorted(t for t, leaf in zip(terms, is_leaf) if not leaf)
+    all_cell_values = leaf_values + internal_values
+    mapping_dict = {term_id: i for i, term_id in enumerate(all_cell_values)}
+
+    marginalization_df, parent_child_df, exclusion_df = ontology_matrices_from_closure(
+        closure, terms, all_cell_values, leaf_values, internal_values, include_self=True
+    )
+    if metadata is None:
+        metadata = dict(bundle.metadata, ontology_release=new_index.data_version)
+    patched = save_artifact_bundle(
+        path, mapping_dict, leaf_values, internal_values,
+        marginalization_df, parent_child_df, exclusion_df, metadata=metadata
+    )
+    return patched, diff
+
+
+def migrate_cached_bundles(old_index, new_index, cache_dir=None):
+    """
+    Patches every cached artifact bundle built against `old_index` into the cache
+    entry for the same parameters under `new_index`'s release.
+
+    The patched bundles keep their term sets: a new release can move cell types in
+    or out of a root's subtree, which only a fresh Census scan can pick up, so
+    terms that are no longer descendants of the bundle's root are reported.
+
+    Returns:
+        dict: Cache key of each migrated bundle -> its restricted OntologyDiff.
+    """
+    bundle_root = (cache_dir or CACHE_DIR) / "bundle"
+    reports = {}
+    if old_index.data_version is None or old_index.data_version == new_index.data_version:
+        return reports
+
+    for manifest_path in sorted(bundle_root.glob("*/manifest.json")):
+        with open(manifest_path) as f:
+            metadata = json.load(f).get("metadata", {})
+        if metadata.get("ontology_release") != old_index.data_version:
+            continue
+        new_metadata = dict(metadata, ontology_release=new_index.data_version)
+        new_path = stage_dir("bundle", new_metadata, cache_dir)
+        if (new_path / "manifest.json").exists():
+            continue
+
+        bundle = load_artifact_bundle(manifest_path.parent)
+        print(f"Patching cached bundle {manifest_path.parent.name} -> {new_path.name}...")
+        try:
+            _, diff = patch_artifact_bundle(bundle, old_index, new_index, new_path, metadata=new_metadata)
+        except ValueError as e:
+            print(f"  Skipped: {e}")
+            continue
+        print(f"  {diff.summary()}")
+        for term_id in diff.moved_to_leaf:
+            print(f"  {term_id} is now a leaf node")
+        for term_id in diff.moved_to_internal:
+            print(f"  {term_id} is now an internal node")
+
+        root_cl_id = metadata.get("root_cl_id")
+        if root_cl_id in new_index:
+            outside = [t for t in bundle.terms if not new_index.is_ancestor(root_cl_id, t)]
+            if outside:
+                print(f"  Warning: {len(outside)} terms are no longer under {root_cl_id}: {outside[:5]}")
+        reports[new_path.name] = diff
+    return reports
@@ -0,0 +1,240 @@
+from src.utils.ontology_utils import load_ontology_index
+from src.data_pipeline.data_loader import (
+    load_filtered_cell_metadata, load_filtered_cell_metadata_batch, CENSUS_VERSION, OBS_VALUE_FILTER
+)
+from src.data_pipeline.preprocess_ontology import preprocess_data_ontology
+from src.data_pipeline.artifacts import save_artifact_bundle, load_artifact_bundle
+from src.data_pipeline.cache import stage_dir, is_cached, mark_cached, cell_metadata_params, bundle_params
+from src.data_pipeline.obs_snapshot import find_obs_snapshot
+
+TARGET_COLUMN = 'cell_type_ontology_term_id'
+
+
+def load_cell_metadata_cached(cl, root_cl_id, min_cell_count, census_version, force=False, snapshot=None):
+    """
+    Returns the filtered cell metadata for a subtree, reading it from the cache when
+    the same inputs (ontology release, root, min count, census version, obs filter)
+    have been queried before, and otherwise from the obs snapshot of the census
+    version if one has been taken (see `mccell snapshot-obs`) or from CellXGene Census.
+    """
+    params = cell_metadata_params(cl.data_version, root_cl_id, min_cell_count, census_version, OBS_VALUE_FILTER)
+    entry = stage_dir("cell_metadata", params)
+    metadata_path = entry / "cell_metadata.parquet"
+
+    if is_cached(entry) and not force:
+        import pandas as pd
+
+        print(f"Using cached cell metadata from {entry}")
+        return pd.read_parquet(metadata_path)
+
+    cell_obs_metadata = load_filtered_cell_metadata(
+        cl, root_cl_id=root_cl_id, min_cell_count=min_cell_count, census_version=census_version,
+        snapshot=snapshot or find_obs_snapshot(census_version)
+    )
+    _cache_cell_metadata(entry, params, cell_obs_metadata)
+    return cell_obs_metadata
+
+
+def _cache_cell_metadata(entry, params, cell_obs_metadata):
+    if not cell_obs_metadata.empty:
+        entry.mkdir(parents=True, exist_ok=True)
+        cell_obs_metadata.to_parquet(entry / "cell_metadata.parquet")
+        mark_cached(entry, params)
+
+
+def run_preprocessing(root_cl_id='CL:0000988', min_cell_count=5000, census_version=CENSUS_VERSION, force=False,
+                      snapshot=None):
+    """
+    Runs the full data preprocessing pipeline.
+
+    Every stage's outputs are cached under a key derived from its inputs (see
+    `src/data_pipeline/cache.py`), so a rerun with unchanged parameters returns the
+    existing artifact bundle without touching Census. Consumers locate the bundle
+    with `resolve_bundle(root_cl_id=..., min_cell_count=...)`.
+
+    Args:
+        root_cl_id (str): Root of the ontology subgraph to process (default: hematopoietic cell).
+        min_cell_count (int): Minimum number of cells for a cell type to be included.
+        census_version (str): The CellXGene Census release to read.
+        force (bool): Rebuild every stage even if it is cached.
+        snapshot (str or Path, optional): Local obs snapshot to read instead of Census.
+            Defaults to the snapshot of `census_version` in `data/processed/obs_snapshot/`, if any.
+
+    Returns:
+        ArtifactBundle: The preprocessed artifacts, or None if the pipeline aborted.
+    """
+    print("Starting data preprocessing pipeline...")
+
+    # 1. Load the memory-mapped ontology index
+    cl = load_ontology_index()
+    if cl is None:
+        return None
+
+    params = bundle_params(cl.data_version, root_cl_id, min_cell_count, census_version, OBS_VALUE_FILTER, TARGET_COLUMN)
+    bundle_path = stage_dir("bundle", params)
+    if (bundle_path / "manifest.json").exists() and not force:
+        print(f"Artifacts for these parameters are already cached at {bundle_path}.")
+        return load_artifact_bundle(bundle_path)
+
+    # 2. Load filtered cell metadata from CellXGene Census (or the cache, or a local obs snapshot)
+    cell_obs_metadata = load_cell_metadata_cached(cl, root_cl_id, min_cell_count, census_version, force=force,
+                                                  snapshot=snapshot)
+
+    if cell_obs_metadata.empty:
+        print("No cell metadata loaded. Aborting pipeline.")
+        return None
+
+    # 3. Preprocess the ontology and cell data, and save the artifacts as a single bundle in the cache
+    bundle = build_bundle(cl, cell_obs_metadata, root_cl_id, bundle_path, params)
+
+    print("Pipeline finished successfully.")
+    return bundle
+
+
+def build_bundle(cl, cell_obs_metadata, root_cl_id, bundle_path, params):
+    """
+    Builds the mapping, the leaf/internal split and the ontology matrices of one
+    subtree from its cell metadata, and writes them as an artifact bundle.
+
+    Args:
+        cl (OntologyIndex): The Cell Ontology index.
+        cell_obs_metadata (pd.DataFrame): The subtree's cells (only the distinct
+            values of TARGET_COLUMN are used).
+        root_cl_id (str): Root of the ontology subgraph.
+        bundle_path (Path): Where to write the bundle.
+        params (dict): The bundle's parameters, stored as manifest metadata.
+
+    Returns:
+        ArtifactBundle: The written bundle.
+    """
+    print(f"Starting ontology preprocessing for {root_cl_id}...")
+    mapping_dict, leaf_values, internal_values, \
+        marginalization_df, parent_child_df, exclusion_df = preprocess_data_ontology(
+            cl, cell_obs_metadata, TARGET_COLUMN,
+            upper_limit=root_cl_id,
+            cl_only=True, include_leafs=False
+        )
+
+    print(f"Preprocessing complete. Found {len(leaf_values)} leaf values and {len(internal_values)} internal values.")
+
+    print(f"Saving preprocessed artifact bundle to {bundle_path}...")
+    bundle = save_artifact_bundle(
+        bundle_path, mapping_dict, leaf_values, internal_values,
+        marginalization_df, parent_child_df, exclusion_df,
+        metadata=params
+    )
+    print(f"Bundle content hash: {bundle.content_hash}")
+    return bundle
+
+
+def _build_bundle_worker(root_cl_id, cell_types, bundle_path, params):
+    """
+    Process-pool task: builds one root's bundle. Workers open the ontology index
+    themselves; it is memory-mapped, so every process shares the same pages of the
+    closure instead of receiving a pickled copy. Only the root's distinct cell
+    types are sent over, not its per-cell metadata.
+    """
+    import pandas as pd
+
+    cl = load_ontology_index()
+    labels = pd.DataFrame({TARGET_COLUMN: cell_types})
+    return build_bundle(cl, labels, root_cl_id, bundle_path, params).path
+
+
+def run_batch_preprocessing(root_cl_ids, min_cell_count=5000, census_version=CENSUS_VERSION, force=False,
+                            workers=None, snapshot=None):
+    """
+    Runs the preprocessing pipeline for several ontology subtrees at once, writing
+    one artifact bundle per root.
+
+    The ontology index is loaded once, the Census obs table is scanned once for
+    every root whose cell metadata is not cached yet (see
+    `load_filtered_cell_metadata_batch`), and the per-root bundles are then built
+    in a process pool. Roots whose bundle is already cached are skipped.
+
+    Args:
+        root_cl_ids (list): Roots of the ontology subgraphs to process.
+        min_cell_count (int): Minimum number of cells for a cell type to be included.
+        census_version (str): The CellXGene Census release to read.
+        force (bool): Rebuild every stage even if it is cached.
+        workers (int, optional): Number of worker processes. Defaults to one per
+            root, capped at the number of CPUs; 1 builds the bundles in this process.
+        snapshot (str or Path, optional): Local obs snapshot to read instead of Census
+            (defaults as in `run_preprocessing`).
+
+    Returns:
+        dict: Root CL ID -> ArtifactBundle, or None for roots that had no matching cells.
+    """
+    import os
+    from concurrent.futures import ProcessPoolExecutor
+
+    import pandas as pd
+
+    root_cl_ids = list(dict.fromkeys(root_cl_ids))
+    print(f"Starting batch preprocessing of {len(root_cl_ids)} roots...")
+
+    # 1. Load the memory-mapped ontology index once
+    cl = load_ontology_index()
+    if cl is None:
+        return None
+
+    results = {}
+    pending = {}
+    for root_cl_id in root_cl_ids:
+        params = bundle_params(cl.data_version, root_cl_id, min_cell_count, census_version, OBS_VALUE_FILTER,
+                               TARGET_COLUMN)
+        bundle_path = stage_dir("bundle", params)
+        if (bundle_path / "manifest.json").exists() and not force:
+            print(f"Artifacts for {root_cl_id} are already cached at {bundle_path}.")
+            results[root_cl_id] = load_artifact_bundle(bundle_path)
+        else:
+            pending[root_cl_id] = (bundle_path, params)
+
+    # 2. Collect cell metadata: from the cache where possible, with one Census scan for the rest
+    cell_types = {}
+    to_query = []
+    for root_cl_id in pending:
+        entry = stage_dir("cell_metadata", cell_metadata_params(
+            cl.data_version, root_cl_id, min_cell_count, census_version, OBS_VALUE_FILTER))
+        if is_cached(entry) and not force:
+            print(f"Using cached cell metadata for {root_cl_id} from {entry}")
+            metadata = pd.read_parquet(entry / "cell_metadata.parquet", columns=[TARGET_COLUMN])
+            cell_types[root_cl_id] = metadata[TARGET_COLUMN].unique().tolist()
+        else:
+            to_query.append(root_cl_id)
+
+    if to_query:
+        queried = load_filtered_cell_metadata_batch(cl, to_query, min_cell_count, census_version,
+                                                    snapshot=snapshot or find_obs_snapshot(census_version))
+        for root_cl_id, metadata in queried.items():
+            params = cell_metadata_params(cl.data_version, root_cl_id, min_cell_count, census_version,
+                                          OBS_VALUE_FILTER)
+            _cache_cell_metadata(stage_dir("cell_metadata", params), params, metadata)
+            cell_types[root_cl_id] = [] if metadata.empty else metadata[TARGET_COLUMN].unique().tolist()
+
+    for root_cl_id in list(pending):
+        if not cell_types[root_cl_id]:
+            print(f"No cell metadata for {root_cl_id}. Skipping.")
+            results[root_cl_id] = None
+            del pending[root_cl_id]
+
+    # 3. Build the per-root bundles in parallel
+    if workers is None:
+        workers = min(len(pending), os.cpu_count() or 1)
+    if workers <= 1 or len(pending) <= 1:
+        for root_cl_id, (bundle_path, params) in pending.items():
+            labels = pd.DataFrame({TARGET_COLUMN: cell_types[root_cl_id]})
+            results[root_cl_id] = build_bundle(cl, labels, root_cl_id, bundle_path, params)
+    elif pending:
+        print(f"Building {len(pending)} bundles with {workers} worker processes...")
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                root_cl_id: executor.submit(_build_bundle_worker, root_cl_id, cell_types[root_cl_id],
+                                            bundle_path, params)
+                for root_cl_id, (bundle_path, params) in pending.items()
+            }
+            for root_cl_id, future in futures.items():
+                results[root_cl_id] = load_artifact_bundle(future.result())
+
+    print("Batch pipeline finished successfully.")
+    return {root_cl_id: results[root_cl_id] for root_cl_id in root_cl_ids}
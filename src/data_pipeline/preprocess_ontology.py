@@ -1,7 +1,6 @@
+import numpy as np
 import pandas as pd
-import torch
-import pronto
-from src.utils.paths import PROJECT_ROOT
+from src.utils.ontology_index import OntologyIndex
 
 
 def create_mapping_dicts(all_cell_values, cl):
@@ -118,6 +117,85 @@ def build_exclusion_df(all_cell_values, internal_values, cl):
     return exclusion_df
 
 
+def build_ancestor_matrix(term_ids, cl):
+    """
+    Computes the ancestor relation restricted to a set of terms, once.
+
+    Works with either a pronto.Ontology (one `superclasses()` walk per term) or an
+    OntologyIndex (a slice of the precomputed, bit-packed closure).
+
+    Shape: (len(term_ids), len(term_ids))
+    Values: closure[i, j] = True if term_ids[j] is term_ids[i] or one of its
+            ancestors. Terms missing from the ontology have no relations at all,
+            not even to themselves, matching the KeyError handling of the
+            per-term builders above.
+    """
+    if isinstance(cl, OntologyIndex):
+        return cl.ancestor_matrix(term_ids, term_ids)
+
+    position = {term_id: i for i, term_id in enumerate(term_ids)}
+    closure = np.zeros((len(term_ids), len(term_ids)), dtype=bool)
+    for i, term_id in enumerate(term_ids):
+        try:
+            ancestors = cl[term_id].superclasses(with_self=True)
+        except KeyError:
+            continue
+        cols = [position[a.id] for a in ancestors if a.id in position]
+        closure[i, cols] = True
+    return closure
+
+
+def build_ontology_matrices(all_cell_values, leaf_values, internal_values, cl, include_self=True):
+    """
+    Builds the marginalization, parent-child and exclusion DataFrames from a single
+    ancestor-closure computation.
+
+    All three matrices are slices of the same ancestor/descendant relation, so they
+    are produced with NumPy boolean indexing instead of per-term ontology walks and
+    cell-by-cell `.loc` writes. The output is identical to `build_marginalization_df`,
+    `build_parent_child_mask(..., include_self=include_self)` and `build_exclusion_df`.
+
+    Returns:
+        marginalization_df (pd.DataFrame): (internal_values x leaf_values).
+        parent_child_df (pd.DataFrame): (all_cell_values x internal_values).
+        exclusion_df (pd.DataFrame): (all_cell_values x internal_values).
+    """
+    terms = list(dict.fromkeys([*all_cell_values, *leaf_values, *internal_values]))
+    closure = build_ancestor_matrix(terms, cl)
+    return ontology_matrices_from_closure(closure, terms, all_cell_values, leaf_values, internal_values, include_self)
+
+
+def ontology_matrices_from_closure(closure, terms, all_cell_values, leaf_values, internal_values, include_self=True):
+    """
+    Slices the marginalization, parent-child and exclusion DataFrames out of a
+    precomputed ancestor matrix, as returned by `build_ancestor_matrix(terms, cl)`.
+    """
+    position = {term_id: i for i, term_id in enumerate(terms)}
+    all_idx = np.array([position[t] for t in all_cell_values], dtype=np.int64)
+    leaf_idx = np.array([position[t] for t in leaf_values], dtype=np.int64)
+    internal_idx = np.array([position[t] for t in internal_values], dtype=np.int64)
+
+    # closure[i, j]: terms[j] is terms[i] or one of its ancestors
+    is_self = all_idx[:, None] == internal_idx[None, :]
+
+    # Internal node is an ancestor (or self) of the leaf
+    marginalization = closure[np.ix_(leaf_idx, internal_idx)].T
+
+    # Internal node is an ancestor of the cell (optionally counting the cell itself)
+    parent_child = closure[np.ix_(all_idx, internal_idx)]
+    if not include_self:
+        parent_child = parent_child & ~is_self
+
+    # Internal node is a strict descendant of the true label
+    strict_descendant = closure[np.ix_(internal_idx, all_idx)].T & ~is_self
+    exclusion = ~strict_descendant
+
+    marginalization_df = pd.DataFrame(marginalization.astype(np.int64), index=internal_values, columns=leaf_values)
+    parent_child_df = pd.DataFrame(parent_child.astype(np.int64), index=all_cell_values, columns=internal_values)
+    exclusion_df = pd.DataFrame(exclusion.astype(np.int64), index=all_cell_values, columns=internal_values)
+    return marginalization_df, parent_child_df, exclusion_df
+
+
 def preprocess_data_ontology(cl, labels, target_column, upper_limit=None, cl_only=False, include_leafs=False):
     """
     This function performs preprocessing on an AnnData object to prepare it for modelling.
@@ -154,12 +232,12 @@ def preprocess_data_ontology(cl, labels, target_column, upper_limit=None, cl_onl
 
     labels['encoded_labels'] = labels[target_column].map(mapping_dict)
 
-    # Build the ontology dataframe for marginalization (internal nodes x leaf nodes)
-    marginalization_df = build_marginalization_df(internal_values, leaf_values, cl)
     print(len(all_cell_values), "cell types in the dataset", len(leaf_values), "leaf types,", len(internal_values), "internal types")
 
-    # Build the optimized (all_cells x internal_nodes) matrices directly
-    parent_child_df = build_parent_child_mask(all_cell_values, internal_values, cl, include_self=True)
-    exclusion_df = build_exclusion_df(all_cell_values, internal_values, cl)
+    # Build the marginalization (internal x leaf) and the (all_cells x internal_nodes)
+    # matrices from one closure computation over the selected terms
+    marginalization_df, parent_child_df, exclusion_df = build_ontology_matrices(
+        all_cell_values, leaf_values, internal_values, cl, include_self=True
+    )
 
     return mapping_dict, leaf_values, internal_values, marginalization_df, parent_child_df, exclusion_df
@@ -0,0 +1,161 @@
+import hashlib
+import os
+from urllib.parse import urlparse
+
+import numpy as np
+
+from src.data_pipeline.cache import stage_dir, is_cached, mark_cached
+from src.data_pipeline.data_loader import OBS_VALUE_FILTER, scan_cell_types
+
+TARGET_COLUMN = "cell_type_ontology_term_id"
+
+
+def census_source(census_version):
+    """The `source` of coordinates resolved against a Census release (see `load_obs_coords`)."""
+    return f"census:{census_version}"
+
+
+def array_identity(array):
+    """
+    Identifies the contents of a local SOMA array: its number of rows and the time
+    of its last write, the newest modification time of its TileDB fragment, commit
+    and schema folders. Both change when the experiment is rebuilt in place (e.g.
+    by `mccell filter-soma` with another filter) or written to.
+    """
+    uri = urlparse(str(array.uri))
+    path = uri.path if uri.scheme in ("", "file") else None
+    mtimes = []
+    if path is not None:
+        for name in ("__fragments", "__commits", "__schema"):
+            folder = os.path.join(path, name)
+            if os.path.exists(folder):
+                mtimes.append(os.stat(folder).st_mtime_ns)
+    return {"count": int(array.count), "modified_ns": max(mtimes, default=None)}
+
+
+def coords_params(source, axis, values, value_filter=None, column=None, identity=None) -> dict:
+    """
+    The inputs that determine the coordinates of an obs or var selection. Census
+    releases are immutable, so their `source` identifies them; a local experiment
+    also needs the `identity` of the array (see `array_identity`).
+    """
+    params = {
+        "source": str(source),
+        "axis": axis,
+        "value_filter": value_filter,
+        "column": column,
+        "n_values": len(values),
+        "values_sha256": hashlib.sha256("\n".join(values).encode()).hexdigest(),
+    }
+    if identity is not None:
+        params["identity"] = identity
+    return params
+
+
+def _identity(source, array):
+    """The identity of `array` for a local `source`, None for a Census release."""
+    return None if str(source).startswith(census_source("")) else array_identity(array)
+
+
+def _load_or_resolve(params, resolve, cache_dir):
+    path = stage_dir("coords", params, cache_dir)
+    if is_cached(path):
+        return np.load(path / "soma_joinids.npy"), np.load(path / "codes.npy")
+    soma_joinids, codes = resolve()
+    path.mkdir(parents=True, exist_ok=True)
+    np.save(path / "soma_joinids.npy", soma_joinids)
+    np.save(path / "codes.npy", codes)
+    mark_cached(path, params)
+    return soma_joinids, codes
+
+
+def resolve_obs_coords(obs, values, value_filter=OBS_VALUE_FILTER, column=TARGET_COLUMN):
+    """
+    Finds the cells passing `value_filter` whose `column` is one of `values`.
+
+    Only `value_filter` (a short predicate) is pushed down to TileDB; membership
+    in `values` is tested on the column's dictionary codes (see `scan_cell_types`)
+    rather than with an `in [...]` literal the reader parses and evaluates per
+    fragment.
+
+    Returns:
+        tuple: (soma_joinids, codes), sorted by soma_joinid, with `codes` the
+        position in `values` of each cell's `column` value.
+    """
+    position = {value: i for i, value in enumerate(values)}
+    soma_joinids, codes, categories, _ = scan_cell_types(obs, set(values), value_filter, column)
+    category_position = np.array([position.get(c, -1) for c in categories], dtype=np.int32)
+    order = np.argsort(soma_joinids, kind="stable")
+    return soma_joinids[order], category_position[codes[order]]
+
+
+def resolve_var_coords(var, feature_ids):
+    """
+    Finds the genes whose `feature_id` is one of `feature_ids`.
+
+    Returns:
+        tuple: (soma_joinids, codes), sorted by soma_joinid, with `codes` the
+        position of each gene in `feature_ids`.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    table = var.read(column_names=["soma_joinid", "feature_id"]).concat()
+    codes = pc.index_in(table.column("feature_id"), value_set=pa.array(list(feature_ids), type=pa.string()))
+    keep = pc.is_valid(codes)
+    soma_joinids = table.column("soma_joinid").filter(keep).to_numpy()
+    codes = codes.filter(keep).to_numpy().astype(np.int32)
+    order = np.argsort(soma_joinids, kind="stable")
+    return soma_joinids[order], codes[order]
+
+
+def load_obs_coords(source, obs, values, value_filter=OBS_VALUE_FILTER, column=TARGET_COLUMN, snapshot=None,
+                    cache_dir=None):
+    """
+    Returns the obs coordinates of a cell selection, resolving them on first use
+    and caching them keyed by `source`, filter and values (see `resolve_obs_coords`).
+    For a local experiment the key also holds the obs array's row count and last
+    write time, so coordinates of an experiment that was rebuilt are resolved again.
+
+    Args:
+        source (str): Identifies the experiment the joinids belong to:
+            `census_source(census_version)` or the path of a local SOMA experiment.
+        obs (tiledbsoma.DataFrame): The experiment's obs table (only read on a cache miss).
+        values (list): Accepted values of `column`, e.g. a bundle's terms.
+        value_filter (str): Obs predicate pushed down to the reader.
+        column (str): The column `values` apply to.
+        snapshot (str or Path, optional): Resolve from this obs snapshot of the same
+            Census release instead of reading `obs` (pipeline filter only).
+        cache_dir (Path, optional): Cache root. Defaults to `CACHE_DIR`.
+
+    Returns:
+        tuple: (soma_joinids, codes) as in `resolve_obs_coords`.
+    """
+    params = coords_params(source, "obs", list(values), value_filter, column, identity=_identity(source, obs))
+
+    def resolve():
+        if snapshot is not None and value_filter == OBS_VALUE_FILTER and column == TARGET_COLUMN:
+            from src.data_pipeline.obs_snapshot import ObsSnapshot
+
+            print(f"Resolving obs coordinates of {len(values)} cell types from the obs snapshot...")
+            cells = ObsSnapshot(snapshot).read_cells(values)
+            position = {value: i for i, value in enumerate(values)}
+            codes = cells[column].cat.categories.map(position).to_numpy()[cells[column].cat.codes.to_numpy()]
+            return cells["soma_joinid"].to_numpy(dtype=np.int64), codes.astype(np.int32)
+        print(f"Resolving obs coordinates of {len(values)} {column} values...")
+        return resolve_obs_coords(obs, values, value_filter, column)
+
+    return _load_or_resolve(params, resolve, cache_dir)
+
+
+def load_var_coords(source, var, feature_ids, cache_dir=None):
+    """
+    Returns the var coordinates of a gene panel, resolving them on first use and
+    caching them keyed by `source` and panel (see `resolve_var_coords`), and for a
+    local experiment by the var array's identity as in `load_obs_coords`.
+
+    Returns:
+        tuple: (soma_joinids, codes) as in `resolve_var_coords`.
+    """
+    params = coords_params(source, "var", list(feature_ids), column="feature_id", identity=_identity(source, var))
+    return _load_or_resolve(params, lambda: resolve_var_coords(var, feature_ids), cache_dir)
@@ -0,0 +1,300 @@
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+
+from src.data_pipeline.cache import stage_dir, is_cached, mark_cached
+from src.data_pipeline.query_coords import load_obs_coords, load_var_coords
+
+SHARD_FORMAT_VERSION = 1
+DEFAULT_SHARD_SIZE = 1 << 18  # cells per shard
+VALUE_DTYPES = {"uint16": np.uint16, "float16": np.float16}
+
+TARGET_COLUMN = "cell_type_ontology_term_id"
+
+_SHARD_FILES = ("indptr", "indices", "data", "labels", "soma_joinids")
+
+
+def shard_params(bundle, soma_uri, gene_list, obs_filter, value_dtype="uint16", shard_size=DEFAULT_SHARD_SIZE):
+    """The inputs that determine a shard store."""
+    return {
+        "bundle": bundle.content_hash,
+        "soma_uri": str(soma_uri),
+        "genes_sha256": hashlib.sha256("\n".join(gene_list).encode()).hexdigest(),
+        "obs_filter": obs_filter,
+        "value_dtype": value_dtype,
+        "shard_size": shard_size,
+    }
+
+
+def _coo_to_csr(rows, cols, values, n_rows):
+    """Sorts COO triplets by (row, column) and returns CSR indptr, indices and data."""
+    order = np.lexsort((cols, rows))
+    indptr = np.zeros(n_rows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=n_rows), out=indptr[1:])
+    return indptr, cols[order], values[order]
+
+
+def _cast_values(values, value_dtype):
+    """Casts expression values to the shard dtype, returning the number of clipped uint16 values."""
+    if value_dtype == "uint16":
+        limit = np.iinfo(np.uint16).max
+        n_clipped = int((values > limit).sum())
+        return np.minimum(np.rint(values), limit).astype(np.uint16), n_clipped
+    return values.astype(np.float16), 0
+
+
+def take_csr_rows(indptr, indices, data, rows):
+    """Returns the CSR arrays of the given rows, in that order."""
+    starts = indptr[rows]
+    lengths = indptr[np.asarray(rows) + 1] - starts
+    new_indptr = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=new_indptr[1:])
+    # Position of every selected entry in the original indices/data
+    positions = np.repeat(starts - new_indptr[:-1], lengths) + np.arange(new_indptr[-1])
+    return new_indptr, indices[positions], data[positions]
+
+
+def concat_csr(blocks):
+    """Stacks (indptr, indices, data) CSR blocks vertically."""
+    indptrs, indices, data = zip(*blocks)
+    offsets = np.cumsum([0] + [p[-1] for p in indptrs[:-1]])
+    indptr = np.concatenate([[0]] + [p[1:] + o for p, o in zip(indptrs, offsets)]).astype(np.int64)
+    return indptr, np.concatenate(indices), np.concatenate(data)
+
+
+def _write_shard(path, indptr, indices, data, labels, soma_joinids):
+    path.mkdir(parents=True)
+    for name, array in zip(_SHARD_FILES, (indptr, indices, data, labels, soma_joinids)):
+        np.save(path / f"{name}.npy", array)
+
+
+def export_shards(bundle, soma_uri, gene_list, path, obs_filter, value_dtype="uint16",
+                  shard_size=DEFAULT_SHARD_SIZE, read_size=1 << 16, metadata=None):
+    """
+    Writes the expression of a bundle's cells, restricted to a gene panel, as CSR shards.
+
+    Cells are read from a local SOMA experiment in blocks of `read_size` (sorted by
+    soma_joinid), so the export never holds more than one block of the X matrix in
+    memory. Each shard directory holds memory-mappable `.npy` arrays:
+
+      - `indptr` (int64), `indices` (uint16, gene columns) and `data` (uint16 raw
+        counts, clipped at 65535, or float16): the CSR expression matrix.
+      - `labels` (int32): each cell's `mapping_dict` index in the bundle.
+      - `soma_joinids` (int64): each cell's obs soma_joinid.
+
+    Gene columns follow the var soma_joinid order of the experiment, as in the
+    tiledbsoma_ml ExperimentDataset. Cells and genes are selected by coordinates
+    (see `load_obs_coords`). The store is written to a temporary directory first
+    and moved into place when complete.
+
+    Args:
+        bundle (ArtifactBundle): Provides the cell types (`terms`) and label codes (`mapping_dict`).
+        soma_uri (str): Path to the local SOMA experiment.
+        gene_list (list): Ensembl IDs of the genes to keep.
+        path (str or Path): Output directory.
+        obs_filter (str): Obs value filter; cells are further restricted to the bundle's terms.
+        value_dtype (str): "uint16" for raw counts, "float16" for real-valued data.
+        shard_size (int): Cells per shard.
+        read_size (int): Cells per SOMA read.
+        metadata (dict, optional): Stored in the manifest (e.g. the cache params).
+
+    Returns:
+        ShardStore: The written store.
+    """
+    import tiledbsoma as soma
+
+    if value_dtype not in VALUE_DTYPES:
+        raise ValueError(f"value_dtype must be one of {list(VALUE_DTYPES)}, got {value_dtype!r}")
+    if len(gene_list) > np.iinfo(np.uint16).max:
+        raise ValueError(f"Gene column indices are stored as uint16; got {len(gene_list)} genes.")
+
+    path = Path(path)
+    tmp_path = path.with_name(path.name + ".tmp")
+    if tmp_path.exists():
+        shutil.rmtree(tmp_path)
+    tmp_path.mkdir(parents=True)
+
+    terms = list(bundle.terms)
+    mapping_dict = bundle.mapping_dict
+
+    print(f"Opening local SOMA database at: {soma_uri}")
+    with soma.Experiment.open(soma_uri) as experiment:
+        obs_joinids, term_codes = load_obs_coords(str(soma_uri), experiment.obs, terms, obs_filter)
+        var_joinids, gene_codes = load_var_coords(str(soma_uri), experiment.ms["RNA"].var, gene_list)
+        labels = np.array([mapping_dict[term] for term in terms], dtype=np.int32)[term_codes]
+        feature_ids = [gene_list[i] for i in gene_codes]
+        print(f"Exporting {len(obs_joinids)} cells x {len(var_joinids)} genes to {path}...")
+
+        X = experiment.ms["RNA"].X["raw"]
+        shards = []
+        pending = []  # CSR blocks of the shard being filled
+        n_clipped = 0
+
+        def flush():
+            indptr, indices, data = concat_csr([p[:3] for p in pending])
+            name = f"shard_{len(shards):05d}"
+            _write_shard(tmp_path / name, indptr, indices, data,
+                         np.concatenate([p[3] for p in pending]), np.concatenate([p[4] for p in pending]))
+            shards.append({"name": name, "n_cells": int(len(indptr) - 1), "nnz": int(indptr[-1])})
+            pending.clear()
+
+        n_pending = 0
+        for start in range(0, len(obs_joinids), read_size):
+            block = obs_joinids[start:start + read_size]
+            table = X.read(coords=(block, var_joinids)).tables().concat()
+            rows = np.searchsorted(block, table.column("soma_dim_0").to_numpy())
+            cols = np.searchsorted(var_joinids, table.column("soma_dim_1").to_numpy()).astype(np.uint16)
+            values, clipped = _cast_values(table.column("soma_data").to_numpy(), value_dtype)
+            n_clipped += clipped
+            indptr, indices, data = _coo_to_csr(rows, cols, values, len(block))
+
+            # Split the block at shard boundaries
+            offset = 0
+            while offset < len(block):
+                take = min(shard_size - n_pending, len(block) - offset)
+                lo, hi = indptr[offset], indptr[offset + take]
+                pending.append((indptr[offset:offset + take + 1] - lo, indices[lo:hi], data[lo:hi],
+                                labels[start + offset:start + offset + take], block[offset:offset + take]))
+                n_pending += take
+                offset += take
+                if n_pending == shard_size:
+                    flush()
+                    n_pending = 0
+            print(f"  {min(start + read_size, len(obs_joinids))}/{len(obs_joinids)} cells", end="\r")
+        if pending:
+            flush()
+        print()
+
+    if n_clipped:
+        print(f"Warning: clipped {n_clipped} values above 65535 to fit uint16.")
+    manifest = {
+        "format_version": SHARD_FORMAT_VERSION,
+        "n_cells": int(len(obs_joinids)),
+        "n_genes": int(len(var_joinids)),
+        "value_dtype": value_dtype,
+        "n_clipped": n_clipped,
+        "feature_ids": feature_ids,
+        "bundle": bundle.content_hash,
+        "shards": shards,
+        "metadata": metadata or {},
+    }
+    with open(tmp_path / "manifest.json", "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    if path.exists():
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+    print(f"Wrote {len(shards)} shards to {path}")
+    return ShardStore(path)
+
+
+def export_shards_cached(bundle, soma_uri, gene_list, obs_filter, value_dtype="uint16",
+                         shard_size=DEFAULT_SHARD_SIZE, force=False, cache_dir=None):
+    """
+    Returns the shard store for a bundle, gene panel and SOMA experiment, exporting
+    it into the cache on first use (see `export_shards`).
+    """
+    params = shard_params(bundle, soma_uri, gene_list, obs_filter, value_dtype, shard_size)
+    path = stage_dir("shards", params, cache_dir)
+    if is_cached(path) and not force:
+        print(f"Using cached shards from {path}")
+        return ShardStore(path)
+    store = export_shards(bundle, soma_uri, gene_list, path, obs_filter, value_dtype=value_dtype,
+                          shard_size=shard_size, metadata=params)
+    mark_cached(path, params)
+    return store
+
+
+class ShardStore:
+    """
+    Read access to the CSR shards written by `export_shards`.
+
+    Every array is opened with `np.load(..., mmap_mode="r")`, so reading a block of
+    consecutive cells touches one contiguous range of each file and several
+    DataLoader workers share the page cache.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path / "manifest.json") as f:
+            self.manifest = json.load(f)
+        if self.manifest["format_version"] != SHARD_FORMAT_VERSION:
+            raise ValueError(f"Unsupported shard format {self.manifest['format_version']} at {self.path}; "
+                             "export the shards again.")
+        self.n_genes = self.manifest["n_genes"]
+        self.shard_sizes = np.array([s["n_cells"] for s in self.manifest["shards"]], dtype=np.int64)
+        self.shard_offsets = np.concatenate([[0], np.cumsum(self.shard_sizes)])
+        self._shards = {}
+
+    def __len__(self):
+        return int(self.shard_offsets[-1])
+
+    @property
+    def feature_ids(self):
+        return self.manifest["feature_ids"]
+
+    def shard(self, i):
+        """Returns the memory-mapped arrays of shard `i` as a dict."""
+        if i not in self._shards:
+            shard_path = self.path / self.manifest["shards"][i]["name"]
+            self._shards[i] = {name: np.load(shard_path / f"{name}.npy", mmap_mode="r") for name in _SHARD_FILES}
+        return self._shards[i]
+
+    @property
+    def labels(self):
+        """The label codes of all cells, in store order."""
+        return np.concatenate([self.shard(i)["labels"] for i in range(len(self.shard_sizes))])
+
+    def read_block(self, shard_index, start, stop):
+        """
+        Reads cells `[start, stop)` of a shard as CSR arrays.
+
+        Returns:
+            tuple: (indptr, indices, data, labels) with `indptr` starting at 0.
+        """
+        shard = self.shard(shard_index)
+        lo, hi = shard["indptr"][start], shard["indptr"][stop]
+        indptr = np.asarray(shard["indptr"][start:stop + 1]) - lo
+        return indptr, np.asarray(shard["indices"][lo:hi]), np.asarray(shard["data"][lo:hi]), \
+            np.asarray(shard["labels"][start:stop])
+
+    def read_rows(self, positions):
+        """
+        Reads the cells at sorted, unique store positions as CSR arrays, with one
+        `read_block` per run of consecutive positions.
+
+        Returns:
+            tuple: (indptr, indices, data, labels) of the cells, in `positions` order.
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        shard_index = np.searchsorted(self.shard_offsets, positions, side="right") - 1
+        breaks = np.flatnonzero((np.diff(positions) != 1) | (np.diff(shard_index) != 0)) + 1
+        blocks, labels = [], []
+        for first, last in zip(np.concatenate([[0], breaks]), np.concatenate([breaks, [len(positions)]]) - 1):
+            i = shard_index[first]
+            offset = self.shard_offsets[i]
+            indptr, indices, data, block_labels = self.read_block(i, positions[first] - offset,
+                                                                  positions[last] - offset + 1)
+            blocks.append((indptr, indices, data))
+            labels.append(block_labels)
+        return (*concat_csr(blocks), np.concatenate(labels))
+
+    def densify(self, indptr, indices, data, rows=None, dtype=np.float32):
+        """
+        Expands CSR rows to a dense (cells x genes) array.
+
+        Args:
+            indptr, indices, data: CSR arrays as returned by `read_block`.
+            rows (np.ndarray, optional): Only expand these rows, in this order.
+            dtype: Output dtype.
+        """
+        if rows is not None:
+            indptr, indices, data = take_csr_rows(indptr, indices, data, rows)
+        n_rows = len(indptr) - 1
+        out = np.zeros((n_rows, self.n_genes), dtype=dtype)
+        out[np.repeat(np.arange(n_rows), np.diff(indptr)), indices] = data
+        return out
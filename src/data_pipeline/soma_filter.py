@@ -0,0 +1,189 @@
+import json
+import os
+import resource
+import shutil
+import time
+from pathlib import Path
+
+import numpy as np
+
+from src.data_pipeline.data_loader import OBS_VALUE_FILTER
+
+DEFAULT_CHUNK_SIZE = 100_000  # cells per committed chunk
+
+
+def _peak_memory_gb():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 ** 2
+
+
+class _Progress:
+    """
+    Restart state of a streaming filter, kept next to the destination experiment
+    in `<dest_uri>.progress/`: the sorted source soma_joinids of the selected cells,
+    whether the destination has been created, and the number of chunks committed
+    so far.
+    """
+
+    def __init__(self, dest_uri):
+        self.path = Path(f"{dest_uri}.progress")
+        self.state_file = self.path / "progress.json"
+
+    def exists(self):
+        return self.state_file.exists()
+
+    def start(self, source_joinids, params):
+        self.path.mkdir(parents=True, exist_ok=True)
+        np.save(self.path / "source_joinids.npy", source_joinids)
+        self.save(dict(params, created=False, chunks_done=0, complete=False))
+
+    def load(self):
+        with open(self.state_file) as f:
+            state = json.load(f)
+        return state, np.load(self.path / "source_joinids.npy", mmap_mode="r")
+
+    def save(self, state):
+        tmp_file = self.state_file.with_suffix(".json.tmp")
+        with open(tmp_file, "w") as f:
+            json.dump(state, f, indent=2)
+        os.replace(tmp_file, self.state_file)
+
+
+def _create_destination(soma, source, dest_uri, n_obs, layer):
+    """Creates an empty experiment with the source's obs/var schemas and an X layer for `n_obs` cells."""
+    import pyarrow as pa
+
+    source_rna = source.ms["RNA"]
+    n_var = source_rna.var.count
+    with soma.Experiment.create(dest_uri) as experiment:
+        experiment.add_new_dataframe(
+            "obs", schema=source.obs.schema, index_column_names=["soma_joinid"], domain=[(0, max(n_obs - 1, 0))]
+        )
+        ms = experiment.add_new_collection("ms")
+        rna = ms.add_new_collection("RNA", soma.Measurement)
+        var = rna.add_new_dataframe(
+            "var", schema=source_rna.var.schema, index_column_names=["soma_joinid"], domain=[(0, max(n_var - 1, 0))]
+        )
+        # All genes are kept, so var (and the X column joinids) are copied unchanged
+        for table in source_rna.var.read():
+            var.write(table)
+        X = rna.add_new_collection("X")
+        X.add_new_sparse_ndarray(layer, type=pa.float32(), shape=(n_obs, n_var))
+
+
+def filter_experiment(source_uri, dest_uri, value_filter=OBS_VALUE_FILTER, chunk_size=DEFAULT_CHUNK_SIZE,
+                      layer="raw"):
+    """
+    Copies the cells of a local SOMA experiment matching `value_filter` into a new
+    experiment, one chunk of cells at a time.
+
+    Unlike `query.to_anndata(...)` followed by `tiledbsoma.io.from_anndata`, the
+    filtered matrix is never held in memory: the destination experiment is created
+    up front, and each chunk's obs rows and X entries are read, given new contiguous
+    soma_joinids (the cell's position among the selected cells) and appended. Peak
+    memory is bounded by one chunk (plus the selected joinids), so `chunk_size`
+    sets the memory budget.
+
+    A chunk counts as committed once `<dest_uri>.progress/progress.json` records it.
+    Re-running after an interruption resumes after the last committed chunk; the
+    joinid mapping is deterministic, so a partially written chunk is simply
+    rewritten with the same coordinates. The restart state is written before the
+    destination is created; on resuming, a destination that was not recorded as
+    created is removed and created again. A fresh run (without a progress file)
+    never overwrites an existing `dest_uri`.
+
+    Args:
+        source_uri (str): Path to the local source SOMA experiment.
+        dest_uri (str): Path of the filtered experiment to create (or resume).
+        value_filter (str): Obs value filter selecting the cells. Defaults to the
+            pipeline's filter (primary 10x 3' v3 cells).
+        chunk_size (int): Cells per chunk.
+        layer (str): The X layer to copy.
+
+    Returns:
+        int: The number of cells in the filtered experiment.
+
+    Raises:
+        ValueError: If `dest_uri` exists without a progress file, or was
+            started with different settings.
+    """
+    import tiledbsoma as soma
+
+    progress = _Progress(dest_uri)
+    params = {"source_uri": str(source_uri), "value_filter": value_filter, "chunk_size": chunk_size, "layer": layer}
+
+    with soma.Experiment.open(source_uri) as source:
+        if progress.exists():
+            state, source_joinids = progress.load()
+            changed = {k: (state.get(k), v) for k, v in params.items() if state.get(k) != v}
+            if changed:
+                raise ValueError(f"{dest_uri} was started with different settings {changed}; "
+                                 f"remove it and {progress.path} to start over.")
+            if state["complete"]:
+                print(f"{dest_uri} is already complete ({len(source_joinids)} cells).")
+                return len(source_joinids)
+            if state.get("created", True):
+                print(f"Resuming after chunk {state['chunks_done']} of {dest_uri}")
+        else:
+            if Path(dest_uri).exists():
+                raise ValueError(f"{dest_uri} already exists and has no {progress.path} to resume from; "
+                                 f"remove it or choose another destination.")
+            print(f"Selecting cells with filter: '{value_filter}'")
+            source_joinids = np.concatenate([
+                t.column("soma_joinid").to_numpy()
+                for t in source.obs.read(value_filter=value_filter, column_names=["soma_joinid"])
+            ] or [np.zeros(0, dtype=np.int64)])
+            source_joinids.sort()
+            progress.start(source_joinids, params)
+            state, source_joinids = progress.load()
+
+        if not state.get("created", True):
+            # Only a resumed run gets here with a destination: one stopped while creating it
+            if Path(dest_uri).exists():
+                shutil.rmtree(dest_uri)
+            print(f"Creating filtered experiment for {len(source_joinids)} cells at {dest_uri}")
+            _create_destination(soma, source, dest_uri, len(source_joinids), layer)
+            state["created"] = True
+            progress.save(state)
+
+        n_obs = len(source_joinids)
+        n_chunks = -(-n_obs // chunk_size)
+
+        source_X = source.ms["RNA"].X[layer]
+        first_chunk = state["chunks_done"]
+        started = time.perf_counter()
+        with soma.Experiment.open(dest_uri, mode="w") as dest:
+            dest_X = dest.ms["RNA"].X[layer]
+            for chunk in range(first_chunk, n_chunks):
+                start = chunk * chunk_size
+                joinids = np.asarray(source_joinids[start:start + chunk_size])
+
+                for table in source.obs.read(coords=(joinids,)):
+                    new_ids = start + np.searchsorted(joinids, table.column("soma_joinid").to_numpy())
+                    index = table.schema.get_field_index("soma_joinid")
+                    dest.obs.write(table.set_column(index, "soma_joinid", _int64_array(new_ids)))
+
+                nnz = 0
+                for table in source_X.read(coords=(joinids, slice(None))).tables():
+                    new_rows = start + np.searchsorted(joinids, table.column("soma_dim_0").to_numpy())
+                    dest_X.write(table.set_column(0, "soma_dim_0", _int64_array(new_rows)))
+                    nnz += table.num_rows
+
+                state["chunks_done"] = chunk + 1
+                progress.save(state)
+                done = min(start + chunk_size, n_obs)
+                rate = (done - first_chunk * chunk_size) / (time.perf_counter() - started)
+                print(f"  chunk {chunk + 1}/{n_chunks}: {done}/{n_obs} cells ({rate:.0f} cells/s), "
+                      f"{nnz} values, peak memory {_peak_memory_gb():.1f} GB")
+
+        state["complete"] = True
+        progress.save(state)
+    print(f"Filtered experiment complete: {n_obs} cells at {dest_uri} "
+          f"(peak memory {_peak_memory_gb():.1f} GB)")
+    return n_obs
+
+
+def _int64_array(values):
+    import pyarrow as pa
+
+    return pa.array(np.asarray(values, dtype=np.int64))
@@ -0,0 +1,312 @@
+TARGET_COLUMN = "cell_type_ontology_term_id"
+
+
+def log1p(X):
+    """
+    Log-transforms a batch of counts, dense or sparse CSR.
+
+    For a CSR tensor only the stored (non-zero) values are transformed, since
+    log1p(0) = 0; the sparsity structure is shared with the input.
+    """
+    import torch
+
+    if X.layout == torch.sparse_csr:
+        return torch.sparse_csr_tensor(X.crow_indices(), X.col_indices(), torch.log1p(X.values()), size=X.shape)
+    return torch.log1p(X)
+
+
+class LabelEncoder:
+    """
+    Converts batches of cell type labels into `mapping_dict` indices.
+
+    Label columns arrive dictionary-encoded (pandas categoricals or Arrow
+    dictionary arrays, with the same few hundred categories in every batch), so
+    the categories are mapped through `mapping_dict` once into a lookup table and
+    each batch is encoded with a single `np.take` over its codes. The table is
+    rebuilt only when the categories change. Categories outside `mapping_dict`
+    are allowed (the label column's categories span all of Census), but a batch
+    with a label outside `mapping_dict`, or a missing label, raises a ValueError.
+
+    Args:
+        mapping_dict (dict): CL ID -> integer index.
+        pin_memory (bool): Return page-locked tensors, for asynchronous copies to the GPU.
+    """
+
+    def __init__(self, mapping_dict, pin_memory=False):
+        self.mapping_dict = mapping_dict
+        self.pin_memory = pin_memory
+        self._categories = None
+        self._lookup = None
+
+    def _encode(self, categories, category_codes):
+        """Looks up the `mapping_dict` index of each category code (-1 for a missing label)."""
+        import numpy as np
+
+        categories = list(categories)
+        if categories != self._categories:
+            # -1 marks categories outside mapping_dict; the trailing entry is what missing values (code -1) look up
+            self._lookup = np.array([self.mapping_dict.get(c, -1) for c in categories] + [-1], dtype=np.int64)
+            self._categories = categories
+        codes = self._lookup.take(category_codes)
+        unknown = codes < 0
+        if unknown.any():
+            names = sorted({"<missing>" if i < 0 else str(categories[i]) for i in np.unique(category_codes[unknown])})
+            raise ValueError(f"{int(unknown.sum())} labels are missing or not in mapping_dict: "
+                             f"{', '.join(names[:10])}{', ...' if len(names) > 10 else ''}")
+        return codes
+
+    def codes(self, labels):
+        """
+        Args:
+            labels: A pandas Series (categorical or not), Arrow (chunked) array or sequence of CL IDs.
+
+        Returns:
+            np.ndarray: int64 `mapping_dict` indices.
+
+        Raises:
+            ValueError: If a label is missing or not in `mapping_dict`, naming the offending IDs.
+        """
+        import numpy as np
+        import pandas as pd
+        import pyarrow as pa
+
+        if isinstance(labels, pa.ChunkedArray):
+            return np.concatenate([self.codes(chunk) for chunk in labels.chunks] or [np.zeros(0, np.int64)])
+        if isinstance(labels, pa.Array):
+            if not pa.types.is_dictionary(labels.type):
+                labels = labels.dictionary_encode()
+            indices = labels.indices.fill_null(-1).to_numpy(zero_copy_only=False)
+            return self._encode(labels.dictionary.to_pylist(), indices)
+        if not isinstance(labels, pd.Series) or not isinstance(labels.dtype, pd.CategoricalDtype):
+            labels = pd.Series(labels, dtype="category")
+        return self._encode(labels.cat.categories, labels.cat.codes.to_numpy())
+
+    def __call__(self, labels):
+        """Encodes a batch of labels as an int64 tensor (see `codes`)."""
+        import torch
+
+        y = torch.from_numpy(self.codes(labels))
+        return y.pin_memory() if self.pin_memory else y
+
+
+def build_experiment_dataloaders(soma_uri, all_cell_values, gene_list, batch_size=256, seed=111,
+                                 split=(0.8, 0.2), split_seed=42, sparse=False, num_workers=0):
+    """
+    Opens a local SOMA experiment and creates shuffled train/validation dataloaders
+    over the selected cells and genes, as in `train_blood_cell.ipynb`. The query
+    selects cells and genes by coordinates (see `load_obs_coords`). In a
+    data-parallel run (see `init_distributed`), `ExperimentDataset` itself gives
+    each rank an equal, disjoint partition of the shuffled cells.
+
+    Args:
+        soma_uri (str): Path to the local SOMA experiment (e.g. the homo_sapiens experiment).
+        all_cell_values (list): CL IDs of the cell types to train on.
+        gene_list (list): Ensembl IDs of the genes to use as features.
+        batch_size (int): Cells per batch.
+        seed (int): Shuffle seed of the ExperimentDataset.
+        split (tuple): Train/validation fractions.
+        split_seed (int): Seed of the random train/validation split.
+        sparse (bool): Yield X batches as scipy CSR matrices instead of dense arrays.
+        num_workers (int): DataLoader worker processes.
+
+    Returns:
+        tuple: (train_dataloader, val_dataloader, n_genes)
+    """
+    import tiledbsoma as soma
+    from tiledbsoma_ml import ExperimentDataset, experiment_dataloader
+    from src.data_pipeline.data_loader import OBS_VALUE_FILTER
+    from src.data_pipeline.query_coords import load_obs_coords, load_var_coords
+
+    print(f"Opening local SOMA database at: {soma_uri}")
+    experiment = soma.open(soma_uri, mode="r")
+
+    # Resolved once and cached, instead of `in [...]` value filters over ~20k genes
+    obs_joinids, _ = load_obs_coords(str(soma_uri), experiment.obs, list(all_cell_values), OBS_VALUE_FILTER)
+    var_joinids, _ = load_var_coords(str(soma_uri), experiment.ms["RNA"].var, list(gene_list))
+
+    with experiment.axis_query(
+        measurement_name="RNA",
+        obs_query=soma.AxisQuery(coords=(obs_joinids,)),
+        var_query=soma.AxisQuery(coords=(var_joinids,)),
+    ) as query:
+        experiment_dataset = ExperimentDataset(
+            query,
+            obs_column_names=[TARGET_COLUMN],
+            layer_name="raw",
+            batch_size=batch_size,
+            shuffle=True,
+            seed=seed,
+            return_sparse_X=sparse,
+        )
+        train_dataset, val_dataset = experiment_dataset.random_split(list(split), seed=split_seed)
+
+        print(f'Total matching cells: {len(experiment_dataset)}')
+        print(f'Training set size: {len(train_dataset)}')
+        print(f'Validation set size: {len(val_dataset)}')
+
+        train_dataloader = experiment_dataloader(train_dataset, num_workers=num_workers)
+        val_dataloader = experiment_dataloader(val_dataset, num_workers=num_workers)
+
+    return train_dataloader, val_dataloader, train_dataset.shape[1]
+
+
+def build_shard_dataloaders(shard_path, batch_size=256, seed=111, split=(0.8, 0.2), split_seed=42,
+                            num_workers=0, rank=0, world_size=1, **dataset_kwargs):
+    """
+    Creates train/validation dataloaders over an exported shard store (see
+    `src/data_pipeline/shards.py`), with a random per-cell split like
+    `build_experiment_dataloaders`.
+
+    Args:
+        shard_path (str or Path): The shard store directory.
+        batch_size (int): Cells per batch.
+        seed (int): Shuffle seed of the datasets.
+        split (tuple): Train/validation fractions.
+        split_seed (int): Seed of the random train/validation split.
+        num_workers (int): DataLoader worker processes.
+        rank (int): Rank of this process in a data-parallel run; it reads only its
+            share of the store's blocks.
+        world_size (int): Number of ranks.
+        **dataset_kwargs: Passed on to `ShardDataset` (block_size, blocks_per_buffer, sparse, ...).
+
+    Returns:
+        tuple: (train_dataloader, val_dataloader, n_genes)
+    """
+    import numpy as np
+    from torch.utils.data import DataLoader
+    from src.data_pipeline.shards import ShardStore
+    from src.train.shard_dataset import ShardDataset
+
+    store = ShardStore(shard_path)
+    train_mask = np.random.default_rng(split_seed).random(len(store)) < split[0] / sum(split)
+    train_dataset = ShardDataset(store, batch_size=batch_size, cell_mask=train_mask, seed=seed, rank=rank,
+                                 world_size=world_size, **dataset_kwargs)
+    val_dataset = ShardDataset(store, batch_size=batch_size, cell_mask=~train_mask, seed=seed, rank=rank,
+                               world_size=world_size, **dataset_kwargs)
+
+    print(f'Total cells: {len(store)}')
+    print(f'Training set size: {int(train_mask.sum())}')
+    print(f'Validation set size: {int((~train_mask).sum())}')
+
+    train_dataloader = DataLoader(train_dataset, batch_size=None, num_workers=num_workers)
+    val_dataloader = DataLoader(val_dataset, batch_size=None, num_workers=num_workers)
+    return train_dataloader, val_dataloader, store.n_genes
+
+
+def _stratified_sampler(ids, labels, bundle, batch_size, batches_per_epoch, block_cells, alpha, seed, rank=0,
+                        world_size=1):
+    from src.train.distributed import rank_cells
+    from src.train.sampler import StratifiedBlockSampler, count_runs
+
+    # Each rank draws from its own blocks of every label, with its own draws
+    mask = rank_cells(labels, rank, world_size, block_cells)
+    sampler = StratifiedBlockSampler(ids[mask], labels[mask], bundle, batch_size=batch_size, block_cells=block_cells,
+                                     alpha=alpha, n_batches=batches_per_epoch, seed=seed + rank)
+    n_labels = int((sampler.weights > 0).sum())
+    first = next(iter(sampler))
+    print(f"Stratified sampling over {n_labels} labels: {count_runs(first)} reads per batch of {len(first)} cells")
+    return sampler
+
+
+def build_stratified_shard_dataloaders(shard_path, bundle, batch_size=256, batches_per_epoch=1000,
+                                       block_cells=32, alpha=0.0, seed=111, split=(0.8, 0.2), split_seed=42,
+                                       num_workers=0, sparse=False, normalize=None, rank=0, world_size=1):
+    """
+    Creates train/validation dataloaders over a shard store like
+    `build_shard_dataloaders` (same split), but with training batches drawn by a
+    `StratifiedBlockSampler`: stratified over the bundle's ontology and read as
+    blocks of `block_cells` consecutive cells of one label. Validation batches
+    are read in store order.
+
+    Args:
+        shard_path (str or Path): The shard store directory.
+        bundle (ArtifactBundle): The bundle the store was exported for.
+        batches_per_epoch (int): Training batches drawn per epoch.
+        block_cells (int): Consecutive cells of one label per read.
+        alpha (float): Within-node smoothing exponent (see `stratum_weights`).
+        sparse (bool): Yield X as sparse CSR tensors.
+        normalize (Normalizer, optional): Applied to the CSR values of each batch.
+        rank (int): Rank of this process in a data-parallel run. The cells are
+            dealt to the ranks in blocks (see `rank_cells`), so ranks never read
+            the same cells.
+        world_size (int): Number of ranks.
+
+    Returns:
+        tuple: (train_dataloader, val_dataloader, n_genes)
+    """
+    import numpy as np
+    from torch.utils.data import DataLoader
+    from src.data_pipeline.shards import ShardStore
+    from src.train.distributed import rank_cells
+    from src.train.sampler import SampledShardDataset, SequentialBatchSampler
+
+    store = ShardStore(shard_path)
+    train_mask = np.random.default_rng(split_seed).random(len(store)) < split[0] / sum(split)
+    train_positions = np.flatnonzero(train_mask)
+    print(f'Total cells: {len(store)}')
+    print(f'Training set size: {len(train_positions)}')
+    print(f'Validation set size: {int((~train_mask).sum())}')
+
+    sampler = _stratified_sampler(train_positions, store.labels[train_positions], bundle, batch_size,
+                                  batches_per_epoch, block_cells, alpha, seed, rank, world_size)
+    val_positions = np.flatnonzero(~train_mask)
+    val_positions = val_positions[rank_cells(store.labels[val_positions], rank, world_size, batch_size)]
+    train_dataset = SampledShardDataset(store, sampler, sparse=sparse, normalize=normalize)
+    val_dataset = SampledShardDataset(store, SequentialBatchSampler(val_positions, batch_size),
+                                      sparse=sparse, normalize=normalize)
+    train_dataloader = DataLoader(train_dataset, batch_size=None, num_workers=num_workers)
+    val_dataloader = DataLoader(val_dataset, batch_size=None, num_workers=num_workers)
+    return train_dataloader, val_dataloader, store.n_genes
+
+
+def build_stratified_experiment_dataloaders(soma_uri, bundle, gene_list, batch_size=256, batches_per_epoch=1000,
+                                            block_cells=32, alpha=0.0, seed=111, split=(0.8, 0.2),
+                                            split_seed=42, num_workers=0, sparse=False, normalize=None, rank=0,
+                                            world_size=1):
+    """
+    Creates train/validation dataloaders over a local SOMA experiment with
+    training batches drawn by a `StratifiedBlockSampler` over the cells'
+    soma_joinids, instead of the global shuffle of `build_experiment_dataloaders`.
+
+    The per-label soma_joinid index comes from the cached obs coordinates (see
+    `load_obs_coords`). Each batch is one X read of sorted coordinates made of
+    runs of nearby joinids; validation batches are read in joinid order. In a
+    data-parallel run, each rank keeps its blocks of this index (see `rank_cells`).
+
+    Args: as `build_stratified_shard_dataloaders`, with `soma_uri` and
+        `gene_list` as in `build_experiment_dataloaders`.
+
+    Returns:
+        tuple: (train_dataloader, val_dataloader, n_genes)
+    """
+    import numpy as np
+    import tiledbsoma as soma
+    from torch.utils.data import DataLoader
+    from src.data_pipeline.data_loader import OBS_VALUE_FILTER
+    from src.data_pipeline.query_coords import load_obs_coords, load_var_coords
+    from src.train.distributed import rank_cells
+    from src.train.sampler import SampledExperimentDataset, SequentialBatchSampler
+
+    print(f"Opening local SOMA database at: {soma_uri}")
+    with soma.open(soma_uri, mode="r") as experiment:
+        # codes are positions in bundle.terms, i.e. mapping_dict indices
+        obs_joinids, labels = load_obs_coords(str(soma_uri), experiment.obs, list(bundle.terms), OBS_VALUE_FILTER)
+        var_joinids, _ = load_var_coords(str(soma_uri), experiment.ms["RNA"].var, list(gene_list))
+
+    train_mask = np.random.default_rng(split_seed).random(len(obs_joinids)) < split[0] / sum(split)
+    print(f'Total matching cells: {len(obs_joinids)}')
+    print(f'Training set size: {int(train_mask.sum())}')
+    print(f'Validation set size: {int((~train_mask).sum())}')
+
+    sampler = _stratified_sampler(obs_joinids[train_mask], labels[train_mask], bundle, batch_size,
+                                  batches_per_epoch, block_cells, alpha, seed, rank, world_size)
+    val_joinids = obs_joinids[~train_mask]
+    val_joinids = val_joinids[rank_cells(labels[~train_mask], rank, world_size, batch_size)]
+    train_dataset = SampledExperimentDataset(soma_uri, obs_joinids, labels, var_joinids, sampler, sparse=sparse,
+                                             normalize=normalize)
+    val_dataset = SampledExperimentDataset(soma_uri, obs_joinids, labels, var_joinids,
+                                           SequentialBatchSampler(val_joinids, batch_size),
+                                           sparse=sparse, normalize=normalize)
+    train_dataloader = DataLoader(train_dataset, batch_size=None, num_workers=num_workers)
+    val_dataloader = DataLoader(val_dataset, batch_size=None, num_workers=num_workers)
+    return train_dataloader, val_dataloader, len(var_joinids)
@@ -0,0 +1,189 @@
+import os
+import subprocess
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+import torch.distributed as dist
+
+
+def _slurm_master_addr():
+    """The first host of the SLURM job's node list, where rank 0 runs."""
+    nodelist = os.environ.get("SLURM_JOB_NODELIST") or os.environ.get("SLURM_NODELIST", "127.0.0.1")
+    try:
+        hosts = subprocess.run(["scontrol", "show", "hostnames", nodelist], capture_output=True, text=True,
+                               check=True).stdout.split()
+    except (OSError, subprocess.CalledProcessError):
+        # Without scontrol, only plain host lists ("node1,node2") can be expanded
+        hosts = nodelist.split(",")
+    return hosts[0] if hosts else "127.0.0.1"
+
+
+def distributed_env():
+    """
+    Returns (rank, world_size, local_rank, local_world_size) of this process, from
+    the variables set by `torchrun` (RANK, WORLD_SIZE, LOCAL_RANK, ...) or, for
+    tasks started by SLURM `srun`, from SLURM_PROCID, SLURM_NTASKS and
+    SLURM_LOCALID. A process started by neither is rank 0 of 1.
+    """
+    if "RANK" in os.environ and "WORLD_SIZE" in os.environ:
+        rank, world_size = int(os.environ["RANK"]), int(os.environ["WORLD_SIZE"])
+        local_rank = int(os.environ.get("LOCAL_RANK", 0))
+        local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", world_size))
+    elif "SLURM_PROCID" in os.environ and "SLURM_NTASKS" in os.environ:
+        rank, world_size = int(os.environ["SLURM_PROCID"]), int(os.environ["SLURM_NTASKS"])
+        local_rank = int(os.environ.get("SLURM_LOCALID", 0))
+        # e.g. "4(x2)" or "4,3"; the tasks on this node are counted on the first form
+        tasks_per_node = os.environ.get("SLURM_NTASKS_PER_NODE") or os.environ.get("SLURM_TASKS_PER_NODE", "")
+        local_world_size = int(tasks_per_node.split("(")[0].split(",")[0] or world_size)
+    else:
+        rank, world_size, local_rank, local_world_size = 0, 1, 0, 1
+    return rank, world_size, local_rank, local_world_size
+
+
+def is_main_rank():
+    """Whether this process is rank 0 of a data-parallel run, or not part of one."""
+    return not dist.is_initialized() or dist.get_rank() == 0
+
+
+def log(*args, **kwargs):
+    """`print` on rank 0 only, for progress messages that every rank would repeat."""
+    if is_main_rank():
+        print(*args, **kwargs)
+
+
+def init_distributed(device=None, backend=None):
+    """
+    Joins the process group of a data-parallel run and picks this rank's device.
+
+    Launch one process per device (or per share of a node's CPU cores), e.g.
+
+        torchrun --standalone --nproc_per_node=4 -m src.cli train --distributed ...
+        torchrun --nnodes=2 --nproc_per_node=4 --rdzv_backend=c10d --rdzv_endpoint=node1 -m src.cli train --distributed
+        srun --ntasks-per-node=4 python -m src.cli train --distributed ...
+
+    Under `srun`, MASTER_ADDR defaults to the first node of the job and
+    MASTER_PORT to 29500. With CUDA, each rank takes the GPU of its local rank
+    and the NCCL backend; otherwise ranks train on the CPU with gloo, and each
+    uses its share of the node's cores (the cores it is bound to, or an equal
+    split of the node between its local ranks) as torch threads.
+
+    Args:
+        device (str, optional): Torch device type ("cuda" or "cpu"); the
+            default is CUDA if available.
+        backend (str, optional): Overrides the process group backend.
+
+    Returns:
+        tuple: (rank, world_size, device)
+    """
+    rank, world_size, local_rank, local_world_size = distributed_env()
+    device_type = torch.device(device or ("cuda" if torch.cuda.is_available() else "cpu")).type
+    if device_type == "cuda":
+        device = torch.device("cuda", local_rank)
+        torch.cuda.set_device(device)
+    else:
+        device = torch.device("cpu")
+        cores = len(os.sched_getaffinity(0))
+        # Ranks bound to their own cores (e.g. srun --cpus-per-task) use them all; others split the node
+        if cores == os.cpu_count():
+            cores //= max(local_world_size, 1)
+        torch.set_num_threads(max(cores, 1))
+
+    os.environ.setdefault("MASTER_ADDR", _slurm_master_addr() if "SLURM_PROCID" in os.environ else "127.0.0.1")
+    os.environ.setdefault("MASTER_PORT", "29500")
+    if not dist.is_initialized():
+        dist.init_process_group(backend or ("nccl" if device_type == "cuda" else "gloo"), rank=rank,
+                                world_size=world_size)
+    per_rank = f"{torch.get_num_threads()} CPU threads" if device.type == "cpu" else "one GPU"
+    log(f"Joined a process group of {world_size} ranks ({dist.get_backend()}), {per_rank} per rank")
+    return rank, world_size, device
+
+
+def destroy_distributed():
+    """Leaves the process group joined by `init_distributed`."""
+    if dist.is_initialized():
+        dist.destroy_process_group()
+
+
+def _share_failure(failed, src=None):
+    """Shares a failure flag over the ranks: rank `src`'s (broadcast), or whether any rank failed."""
+    device = torch.device("cuda", torch.cuda.current_device()) if dist.get_backend() == "nccl" else "cpu"
+    flag = torch.tensor([int(failed)], device=device)
+    if src is None:
+        dist.all_reduce(flag, op=dist.ReduceOp.MAX)
+    else:
+        dist.broadcast(flag, src)
+    return bool(flag.item())
+
+
+@contextmanager
+def main_rank_first():
+    """
+    Runs the block on rank 0 before the other ranks enter it, e.g. so that caches
+    (the artifact bundle, obs coordinates, gene statistics) are built once and
+    then read by every rank.
+
+    Rank 0 tells the other ranks whether its block succeeded before they start
+    theirs, and all ranks share whether theirs did afterwards, so an error on
+    one rank stops every rank (with a RuntimeError on the ranks where the block
+    did not fail) instead of leaving them waiting on it.
+
+    Raises:
+        RuntimeError: If the block failed on another rank.
+    """
+    if not dist.is_initialized():
+        yield
+        return
+    main = dist.get_rank() == 0
+    if not main and _share_failure(False, src=0):
+        raise RuntimeError("Stopping: rank 0 failed before this rank could start (see the error of rank 0).")
+    failed = True
+    try:
+        yield
+        failed = False
+    finally:
+        if main:
+            _share_failure(failed, src=0)
+        # Unless rank 0 failed, in which case the other ranks stopped before their block
+        if not (main and failed) and _share_failure(failed) and not failed:
+            raise RuntimeError("Stopping: another rank failed (see its error).")
+
+
+def rank_cells(labels, rank, world_size, block_cells):
+    """
+    Assigns the cells of an index sorted by obs soma_joinid (or shard store
+    position) to the ranks of a data-parallel run, so that ranks never read the
+    same cells.
+
+    Within each label, the cells are cut into blocks of `block_cells`
+    consecutive ids, and the blocks are dealt to the ranks in turn (starting at
+    a different rank for each label, so labels of a single block are spread
+    too). Each rank thus keeps runs of nearby ids, and every label with at least
+    `world_size` blocks is present on every rank.
+
+    Args:
+        labels (np.ndarray): `mapping_dict` index of each cell, in id order.
+        rank (int): This process's rank.
+        world_size (int): Number of ranks.
+        block_cells (int): Consecutive cells of one label per block.
+
+    Returns:
+        np.ndarray: bool mask of the cells of `rank`.
+    """
+    labels = np.asarray(labels, dtype=np.int64)
+    if world_size == 1:
+        return np.ones(len(labels), dtype=bool)
+    order = np.argsort(labels, kind="stable")
+    counts = np.bincount(labels)
+    starts = np.cumsum(counts) - counts
+    # Position of each cell among the cells of its label
+    position = np.empty(len(labels), dtype=np.int64)
+    position[order] = np.arange(len(labels)) - np.repeat(starts, counts)
+    return (position // block_cells + labels) % world_size == rank
+
+
+def all_reduce(values, op=None):
+    """Sums (or reduces with `op`) a tensor over the ranks in place, if a process group is running."""
+    if dist.is_initialized():
+        dist.all_reduce(values, op=op or dist.ReduceOp.SUM)
+    return values
@@ -1,49 +1,204 @@
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import pandas as pd
 
 
+def _sparse_csr(matrix, device):
+    """A 2D array as a float32 sparse CSR tensor on `device`."""
+    return torch.as_tensor(np.asarray(matrix), dtype=torch.float32).to_sparse_csr().to(device)
+
+
+def _shifted_log(x, shift):
+    """shift + log(x) where x > 0, else -100 (the bound of F.binary_cross_entropy's log terms)."""
+    log_x = torch.log(x.clamp(min=torch.finfo(x.dtype).tiny))
+    return torch.where(x > 0, shift + log_x, torch.full_like(x, -100.0))
+
+
+class _LabelRows:
+    """
+    The non-zeros of each label's row of a (labels x columns) matrix, as CSR index lists
+    on the device, so that per-label tables cost their non-zeros rather than a dense row
+    per label.
+
+    `gather(y_batch)` returns the columns and values of the batch's rows padded to the
+    longest row (shape: batch_size, max_row), with `pad_column` and value 0, using only
+    fixed-size gathers (no host-device synchronization).
+    """
+
+    def __init__(self, matrix, device, dtype=torch.float32, pad_column=0):
+        matrix = np.asarray(matrix)
+        rows, columns = np.nonzero(matrix)
+        row_nnz = np.bincount(rows, minlength=matrix.shape[0])
+        self.offsets = torch.as_tensor(np.concatenate([[0], np.cumsum(row_nnz)]), dtype=torch.long, device=device)
+        # A last (padding) entry, which every slot past the end of its row reads
+        self.columns = torch.as_tensor(np.append(columns, pad_column), dtype=torch.long, device=device)
+        self.values = torch.as_tensor(np.append(matrix[rows, columns], 0), device=device).to(dtype)
+        self.max_row = int(row_nnz.max(initial=0))
+
+    def gather(self, y_batch):
+        starts = self.offsets[y_batch]
+        slots = torch.arange(self.max_row, device=y_batch.device)
+        index = starts[:, None] + slots
+        index = torch.where(index < self.offsets[y_batch + 1][:, None], index, len(self.columns) - 1)
+        return self.columns[index], self.values[index]
+
+
+# Target codes of the internal nodes in the fused parent loss
+TARGET_0, TARGET_1, EXCLUDED = 0, 1, 2
+
+
+def _batch_codes(y_batch, target_codes, num_internal):
+    """The target codes of the labels `y_batch` (shape: batch_size, num_internal_nodes)."""
+    columns, codes = target_codes.gather(y_batch)
+    # One spare column takes the padding entries
+    batch_codes = torch.full((len(y_batch), num_internal + 1), TARGET_0, dtype=torch.uint8, device=y_batch.device)
+    return batch_codes.scatter_(1, columns, codes)[:, :num_internal]
+
+
+class _ParentLoss(torch.autograd.Function):
+    """
+    The parent loss of `MarginalizationLoss` as one autograd node: marginalization, masked
+    BCE and its analytic gradient, from the leaf probabilities and the label indices only.
+
+    Nothing of shape (batch_size, num_internal_nodes) is kept for backward: it saves the
+    leaf probabilities (which softmax keeps anyway) and recomputes the node probabilities,
+    and the targets and weights are expanded again from the labels' sparse target codes.
+    """
+
+    @staticmethod
+    def forward(ctx, output_probs, y_batch, marginalization, marginalization_t, target_codes):
+        # (internal, leaf) @ (leaf, batch) -> (batch, internal)
+        output_internal_prob = (marginalization @ output_probs.t()).t().clamp(0, 1)
+        codes = _batch_codes(y_batch, target_codes, output_internal_prob.shape[1])
+        # Element-wise BCE with the log terms bounded at -100, like F.binary_cross_entropy
+        bce = torch.where(codes == TARGET_1, -torch.log(output_internal_prob).clamp(min=-100),
+                          -torch.log(1 - output_internal_prob).clamp(min=-100))
+        bce = torch.where(codes == EXCLUDED, torch.zeros_like(bce), bce)
+        ctx.save_for_backward(output_probs, y_batch)
+        ctx.marginalization, ctx.marginalization_t, ctx.target_codes = marginalization, marginalization_t, target_codes
+        return bce.sum() / bce.numel()
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        output_probs, y_batch = ctx.saved_tensors
+        output_internal_prob = (ctx.marginalization @ output_probs.t()).t()
+        p = output_internal_prob.clamp(0, 1)
+        codes = _batch_codes(y_batch, ctx.target_codes, p.shape[1])
+        # d BCE / d p as computed by F.binary_cross_entropy, with its 1e-12 floor on p(1 - p)
+        grad = (p - (codes == TARGET_1).to(p.dtype)) / (p * (1 - p)).clamp(min=1e-12)
+        # No gradient at excluded nodes, or where the clamp to [0, 1] is active (as torch.clamp, at the bounds too)
+        keep = (codes != EXCLUDED) & (output_internal_prob > 0) & (output_internal_prob < 1)
+        grad = torch.where(keep, grad, torch.zeros_like(grad)) * (grad_output / grad.numel())
+        # (leaf, internal) @ (internal, batch) -> (batch, leaf)
+        return (ctx.marginalization_t @ grad.t()).t(), None, None, None, None
+
+
 class MarginalizationLoss(nn.Module):
     """
     Calculates a hierarchical loss by combining a weighted leaf loss (for leaf-labeled data)
     and a parent loss (for all data).
+
+    The ontology matrices are kept as sparse CSR tensors, so memory and FLOPs
+    scale with their non-zeros (the DAG's ancestor pairs) rather than with
+    internal x leaf or all x internal, and `forward` runs without host-device
+    synchronization (see `src/train/README.md`).
+
+    With `log_space=True`, the leaf and parent losses share one `log_softmax`:
+    internal-node log-probabilities are the `logsumexp` of their descendant leaves'
+    log-probabilities (and 1 - p of the other leaves', from a dense internal x leaf
+    mask), and the BCE is evaluated from them, which stays accurate for probabilities
+    close to 0 or 1. In both modes the loss is computed in float32, also under autocast.
+
+    With `fused=True` (the default, probability mode only), the parent loss is one
+    autograd node (`_ParentLoss`) that keeps no (batch_size, num_internal_nodes)
+    intermediates for backward.
     """
-    def __init__(self, marginalization_df, parent_child_df, exclusion_df, 
-                 leaf_values, internal_values, mapping_dict, leaf_weight=8.0, device='cpu'):
+    def __init__(self, marginalization_df, parent_child_df, exclusion_df,
+                 leaf_values, internal_values, mapping_dict, leaf_weight=8.0, device='cpu', log_space=False,
+                 fused=True):
         super().__init__()
         self.leaf_weight = leaf_weight
         self.device = device
+        self.log_space = log_space
+        self.fused = fused and not log_space
+
+        # --- Leaf flag of every label, looked up per batch on the device ---
+        is_leaf = torch.zeros(len(mapping_dict), dtype=torch.bool)
+        is_leaf[[mapping_dict[cid] for cid in leaf_values]] = True
+        self.is_leaf = is_leaf.to(device)
+
+        if isinstance(marginalization_df, pd.DataFrame):
+            # --- Sort DataFrame columns/index to match mapping_dict order ---
+            all_cell_values_sorted = sorted(mapping_dict.keys(), key=lambda k: mapping_dict[k])
+            leaf_values_sorted = sorted(leaf_values, key=lambda k: mapping_dict[k])
+            internal_values_sorted = sorted(internal_values, key=lambda k: mapping_dict[k])
 
-        # --- Store integer indices for slicing ---
-        self.leaf_indices_set = {mapping_dict[cid] for cid in leaf_values}
+            marginalization_df = marginalization_df.loc[internal_values_sorted, leaf_values_sorted].values
+            parent_child_df = parent_child_df.loc[all_cell_values_sorted, internal_values_sorted].values
+            exclusion_df = exclusion_df.loc[all_cell_values_sorted, internal_values_sorted].values
+        # Otherwise the matrices are arrays already in mapping_dict order (e.g. from an ArtifactBundle)
 
-        # --- Sort DataFrame columns/index to match mapping_dict order ---
-        all_cell_values_sorted = sorted(mapping_dict.keys(), key=lambda k: mapping_dict[k])
-        leaf_values_sorted = sorted(leaf_values, key=lambda k: mapping_dict[k])
-        internal_values_sorted = sorted(internal_values, key=lambda k: mapping_dict[k])
+        parent_child = np.asarray(parent_child_df, dtype=np.float32)
+        exclusion = np.asarray(exclusion_df, dtype=np.float32)
 
-        # --- Re-index and convert to performant tensors once at initialization ---
+        # --- Convert to sparse tensors once at initialization ---
         # Marginalization tensor (internal x leaf)
-        marginalization_tensor = torch.FloatTensor(
-            marginalization_df.loc[internal_values_sorted, leaf_values_sorted].values
-        ).to(device)
+        self.marginalization_tensor = _sparse_csr(marginalization_df, device)
 
-        # Parent-child tensor (all_cells x internal_nodes)
-        parent_child_tensor = torch.FloatTensor(
-            parent_child_df.loc[all_cell_values_sorted, internal_values_sorted].values
-        ).to(device)
+        self.num_internal = parent_child.shape[1]
 
-        # Exclusion tensor (all_cells x internal_nodes)
-        exclusion_tensor = torch.FloatTensor(
-            exclusion_df.loc[all_cell_values_sorted, internal_values_sorted].values
-        ).to(device)
+        if self.fused:
+            # Transposed copy for the backward pass (leaf x internal)
+            self.marginalization_t = _sparse_csr(np.asarray(marginalization_df).T, device)
+            # Target codes of each label: TARGET_1 or EXCLUDED at its ancestors and excluded
+            # nodes (TARGET_0 elsewhere), padded into the spare column of `_batch_codes`
+            codes = np.where(exclusion == 0, EXCLUDED, parent_child).astype(np.uint8)
+            self.target_codes = _LabelRows(codes, device, dtype=torch.uint8, pad_column=self.num_internal)
+        else:
+            # Correction rows (all_cells x 2 * internal_nodes): per label, the weight of the
+            # target-1 term ([:, :internal]) and minus the excluded internal nodes ([:, internal:])
+            self.corrections = _LabelRows(np.hstack([parent_child * exclusion, exclusion - 1]), device)
 
-        self.marginalization_tensor = marginalization_tensor
-        self.parent_child_tensor = parent_child_tensor
-        self.exclusion_tensor = exclusion_tensor
+        # Leaves outside each internal node (internal x leaf), for log(1 - p) in log space.
+        # Dense, as it holds most of the pairs
+        self.complement_tensor = None
+        if log_space:
+            complement = ~np.asarray(marginalization_df, dtype=bool)
+            self.complement_tensor = torch.as_tensor(complement, dtype=torch.float32, device=device)
 
-        self.criterion_leafs = nn.CrossEntropyLoss(reduction='mean')
+        self.criterion_leafs = nn.CrossEntropyLoss(reduction='none')
+
+    @classmethod
+    def from_bundle(cls, bundle, leaf_weight=8.0, device='cpu', log_space=False, fused=True):
+        """
+        Builds the loss straight from an ArtifactBundle. The bundle's matrices are
+        already in mapping_dict order, so they are unpacked into tensors without
+        any pandas re-indexing.
+        """
+        return cls(
+            bundle.marginalization, bundle.parent_child, bundle.exclusion,
+            bundle.leaf_values, bundle.internal_values, bundle.mapping_dict,
+            leaf_weight=leaf_weight, device=device, log_space=log_space, fused=fused
+        )
+
+    def _internal_log_probs(self, log_probs):
+        """
+        Log-probabilities log p and log(1 - p) of each internal node (shapes: batch_size,
+        num_internal_nodes): the logsumexp of the log-probabilities of the leaves under the
+        node and of the other leaves.
+
+        Both logsumexps are shifted by each sample's most likely leaf, so they are matmuls
+        over relative probabilities. Computing 1 - p from the other leaves rather than as a
+        difference keeps it accurate when p is close to 1. Empty sums, and sums that underflow
+        (below ~e^-87 of the most likely leaf), give -100.
+        """
+        row_max = log_probs.max(dim=1, keepdim=True).values.detach()
+        relative = torch.exp(log_probs - row_max)
+        log_p = _shifted_log((self.marginalization_tensor @ relative.t()).t(), row_max)
+        log_1mp = _shifted_log(relative @ self.complement_tensor.t(), row_max)
+        return log_p, log_1mp
 
     def forward(self, outputs, y_batch):
         """The main forward pass for the loss function.
@@ -51,46 +206,61 @@ class MarginalizationLoss(nn.Module):
         NOTE: outputs should be LOGITS (raw scores), not probabilities.
         - CrossEntropyLoss expects logits and applies softmax internally
         - For parent loss, we convert to probabilities via softmax first
+          (or to log-probabilities via log_softmax, with `log_space`)
         """
+        # The loss runs in float32 even inside an autocast region
+        with torch.autocast(outputs.device.type, enabled=False):
+            return self._forward(outputs.float(), y_batch)
 
-        # --- 1. Leaf Loss (for leaf-labeled samples only) ---
-        is_leaf_mask = torch.tensor([y.item() in self.leaf_indices_set for y in y_batch], device=self.device)
-        leaf_outputs = outputs[is_leaf_mask]
-        leaf_y_batch = y_batch[is_leaf_mask]
-
-        loss_leafs = torch.tensor(0.0, device=self.device)
-        if leaf_outputs.shape[0] > 0:
-            # CrossEntropyLoss expects logits (raw scores), not probabilities
-            # It applies softmax internally for numerical stability
-            loss_leafs = self.criterion_leafs(leaf_outputs, leaf_y_batch) * self.leaf_weight
+    def _forward(self, outputs, y_batch):
+        # Masked instead of filtered, so no sample count has to come back to the host
+        is_leaf_mask = self.is_leaf[y_batch]
+        leaf_y_batch = torch.where(is_leaf_mask, y_batch, torch.zeros_like(y_batch))
 
-        # --- 2. Parent Loss (for all samples) ---
+        if self.log_space:
+            # One log_softmax shared by the leaf CE and the parent BCE
+            log_probs = F.log_softmax(outputs, dim=1)
+            leaf_losses = F.nll_loss(log_probs, leaf_y_batch, reduction='none')
+        else:
+            leaf_losses = self.criterion_leafs(outputs, leaf_y_batch)
 
-        # Convert logits to probabilities for marginalization
-        # Shape stays the same: (batch_size, num_leaf_nodes)
-        output_probs = F.softmax(outputs, dim=1)
+        # --- 1. Leaf Loss (for leaf-labeled samples only) ---
+        leaf_losses = torch.where(is_leaf_mask, leaf_losses, torch.zeros_like(leaf_losses))
+        # Mean over the leaf samples; 0 if there are none
+        loss_leafs = leaf_losses.sum() / is_leaf_mask.sum().clamp(min=1) * self.leaf_weight
 
-        # Predicted parent probabilities (shape: batch_size, num_internal_nodes)
-        # einsum('ij,kj->ki'): (internal, leaf) @ (batch, leaf) -> (batch, internal)
-        output_internal_prob = torch.einsum('ij,kj->ki', self.marginalization_tensor, output_probs)
-        output_internal_prob = torch.clamp(output_internal_prob, 0, 1) # Clamp to valid probability range
+        # --- 2. Parent Loss (for all samples) ---
+        if self.fused:
+            loss_parents = _ParentLoss.apply(F.softmax(outputs, dim=1), y_batch, self.marginalization_tensor,
+                                             self.marginalization_t, self.target_codes)
+        else:
+            if self.log_space:
+                # BCE against target 1 and target 0 from log p and log(1 - p), bounded at 100
+                # like F.binary_cross_entropy (shape: batch_size, num_internal_nodes)
+                log_p, log_1mp = self._internal_log_probs(log_probs)
+                bce_1 = -log_p.clamp(min=-100, max=0)
+                bce_0 = -log_1mp.clamp(min=-100, max=0)
+            else:
+                # Convert logits to probabilities for marginalization
+                # Shape stays the same: (batch_size, num_leaf_nodes)
+                output_probs = F.softmax(outputs, dim=1)
 
-        # True parent labels (shape: batch_size, num_internal_nodes)
-        # Tensors are already pre-sliced, so we can directly index them
-        target_internal_prob = self.parent_child_tensor[y_batch] # Fast integer indexing
+                # Predicted parent probabilities (shape: batch_size, num_internal_nodes)
+                # (internal, leaf) @ (leaf, batch) -> (internal, batch), one term per ancestor pair
+                output_internal_prob = (self.marginalization_tensor @ output_probs.t()).t()
+                output_internal_prob = torch.clamp(output_internal_prob, 0, 1) # Clamp to valid probability range
 
-        # Exclusion mask (shape: batch_size, num_internal_nodes)
-        exclusion_mask = self.exclusion_tensor[y_batch] # Fast integer indexing
+                # Element-wise BCE against target 0 and target 1 (shape: batch_size, num_internal_nodes)
+                bce_0 = F.binary_cross_entropy(output_internal_prob, torch.zeros_like(output_internal_prob), reduction='none')
+                bce_1 = F.binary_cross_entropy(output_internal_prob, torch.ones_like(output_internal_prob), reduction='none')
 
-        # Weighted BCE Loss for internal nodes
-        loss_parents = F.binary_cross_entropy(
-            output_internal_prob, 
-            target_internal_prob, 
-            weight=exclusion_mask, 
-            reduction='mean'
-        )
+            # Weighted BCE = bce_0 everywhere, + (bce_1 - bce_0) on the true parents, - bce_0 on the
+            # excluded nodes; each sample's sum runs over the non-zeros of its label's correction row
+            columns, weights = self.corrections.gather(y_batch)
+            corrections = torch.gather(torch.cat([bce_1 - bce_0, bce_0], dim=1), 1, columns) * weights
+            loss_parents = (bce_0.sum() + corrections.sum()) / bce_0.numel()
 
         # --- Total Loss ---
         total_loss = loss_leafs + loss_parents
-        
-        return total_loss, loss_leafs, loss_parents
\ No newline at end of file
+
+        return total_loss, loss_leafs, loss_parents
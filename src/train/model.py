@@ -1,3 +1,4 @@
+import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
@@ -5,6 +6,13 @@ class SimpleNN(nn.Module):
     """
     A simple feed-forward neural network based on the architecture
     from the old_reference notebooks.
+
+    The input may be a dense (batch x genes) tensor or a sparse CSR tensor (see
+    `ShardDataset(sparse=True)`); sparse input goes through the first layer as a
+    sparse-dense matmul, so the batch is never densified.
+
+    Under autocast, that first sparse layer is computed in float32 and the
+    dense layers in the autocast dtype.
     """
     def __init__(self, input_dim, output_dim):
         super(SimpleNN, self).__init__()
@@ -35,7 +43,14 @@ class SimpleNN(nn.Module):
         self.output_layer = nn.Linear(hidden_dim_3, output_dim)
         
     def forward(self, x):
-        x = self.input_layer(x)
+        if x.layout == torch.sparse_csr:
+            first = self.input_layer[0]
+            # Sparse matmuls have no reduced-precision CPU kernels, so this one stays float32 under autocast
+            with torch.autocast(x.device.type, enabled=False):
+                x = torch.addmm(first.bias, x, first.weight.t())
+            x = self.input_layer[1:](x)
+        else:
+            x = self.input_layer(x)
         x = self.hidden_layer_1(x)
         x = self.hidden_layer_2(x)
         x = self.output_layer(x)
@@ -0,0 +1,149 @@
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from src.train.data import log1p
+
+_DONE = object()
+
+
+def pin_batch(batch):
+    """Copies the tensors of a batch into page-locked memory (sparse CSR tensors component-wise)."""
+    def pin(x):
+        if not isinstance(x, torch.Tensor):
+            return x
+        if x.layout == torch.sparse_csr:
+            return torch.sparse_csr_tensor(x.crow_indices().pin_memory(), x.col_indices().pin_memory(),
+                                           x.values().pin_memory(), size=x.shape)
+        return x.pin_memory()
+
+    return tuple(pin(x) for x in batch)
+
+
+def prepare_batch(batch, normalize=log1p):
+    """
+    The host side of a training step's data preparation: normalizes X with
+    `normalize` (default `log1p`; a `Normalizer`, or None if the loader already did).
+    """
+    X, y = batch
+    return (X if normalize is None else normalize(X)), y
+
+
+class Prefetcher:
+    """
+    Iterates over `batches` ahead of the consumer on background threads.
+
+    A fetch thread pulls batches from `batches` (a DataLoader, or a generator
+    such as `_soma_batches` that also encodes the labels) while the training
+    step runs, and hands each to `transform` (e.g. `prepare_batch`), run on
+    `workers` threads so that the transforms of consecutive batches overlap.
+    At most `depth` batches are in flight; they are yielded in order. With
+    `pin_memory`, transformed batches are staged in page-locked memory, so the
+    consumer's `.to(device, non_blocking=True)` copies run asynchronously.
+
+    Worker processes are the source's business (`num_workers` of the
+    DataLoader); the threads here overlap what happens between the source and
+    the model, and the fetch of the next batch with the current step.
+
+    `wait_seconds` accumulates the time the consumer spent blocked waiting for
+    a batch, i.e. how long training was stalled on data.
+
+    Args:
+        batches (iterable): Yields the batches.
+        transform (callable, optional): Applied to each batch off the main thread.
+        depth (int): Maximum number of batches fetched ahead.
+        workers (int): Threads running `transform`; 0 runs it on the fetch thread.
+        pin_memory (bool): Pin the tensors of the transformed batches.
+    """
+
+    def __init__(self, batches, transform=None, depth=2, workers=1, pin_memory=False):
+        if depth < 1:
+            raise ValueError(f"depth must be at least 1, got {depth}")
+        self.batches = batches
+        self.transform = transform
+        self.depth = depth
+        self.workers = workers
+        self.pin_memory = pin_memory
+        self.wait_seconds = 0.0
+        self.n_batches = 0
+        self._queue = None
+        self._stop = None
+        self._thread = None
+        self._executor = None
+
+    def _process(self, batch):
+        if self.transform is not None:
+            batch = self.transform(batch)
+        if self.pin_memory:
+            batch = pin_batch(batch)
+        return batch
+
+    def _fetch(self, items, stop):
+        try:
+            for batch in self.batches:
+                if stop.is_set():
+                    return
+                if self._executor is not None:
+                    item = self._executor.submit(self._process, batch)
+                else:
+                    item = self._process(batch)
+                # Blocks while `depth` batches are waiting, checking for close()
+                while not stop.is_set():
+                    try:
+                        items.put(item, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+        except BaseException as e:
+            items.put(e)
+        finally:
+            items.put(_DONE)
+
+    def __iter__(self):
+        self.close()
+        self._queue = queue.Queue(maxsize=self.depth)
+        self._stop = threading.Event()
+        if self.workers > 0:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="prefetch")
+        self._thread = threading.Thread(target=self._fetch, args=(self._queue, self._stop), daemon=True,
+                                        name="prefetch-fetch")
+        self._thread.start()
+        try:
+            while True:
+                start = time.perf_counter()
+                item = self._queue.get()
+                if item is _DONE:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                if self._executor is not None:
+                    item = item.result()
+                self.wait_seconds += time.perf_counter() - start
+                self.n_batches += 1
+                yield item
+        finally:
+            self.close()
+
+    def close(self):
+        """Stops the background threads; called when iteration ends or is abandoned."""
+        if self._thread is None:
+            return
+        self._stop.set()
+        # Unblock a fetch thread waiting on a full queue
+        while self._thread.is_alive():
+            try:
+                self._queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self._thread.join()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+        self._thread = self._executor = None
+
+    def reset_stats(self):
+        """Zeroes `wait_seconds` and `n_batches`, e.g. at the start of an epoch."""
+        self.wait_seconds = 0.0
+        self.n_batches = 0
@@ -0,0 +1,219 @@
+import inspect
+from functools import partial
+
+import torch
+import torch.optim as optim
+from torch.nn.parallel import DistributedDataParallel
+
+from src.data_pipeline.cache import resolve_bundle
+from src.data_pipeline.genes import load_protein_coding_genes
+from src.data_pipeline.normalize import build_normalizer
+from src.train.data import (
+    LabelEncoder,
+    build_experiment_dataloaders,
+    build_shard_dataloaders,
+    build_stratified_experiment_dataloaders,
+    build_stratified_shard_dataloaders,
+    log1p,
+    TARGET_COLUMN,
+)
+from src.train.distributed import all_reduce, destroy_distributed, init_distributed, log, main_rank_first
+from src.train.loss import MarginalizationLoss
+from src.train.model import SimpleNN
+from src.train.prefetch import Prefetcher, prepare_batch
+from src.train.sampler import DEFAULT_BLOCK_CELLS
+from src.train.trainer import Trainer, load_config
+
+
+def _csr_tensor(X):
+    """Converts a scipy CSR matrix into a float32 torch sparse CSR tensor."""
+    return torch.sparse_csr_tensor(torch.from_numpy(X.indptr).long(), torch.from_numpy(X.indices).long(),
+                                   torch.from_numpy(X.data).float(), size=X.shape)
+
+
+def _soma_batches(dataloader, label_encoder):
+    """Converts tiledbsoma_ml batches (X array or CSR matrix, obs DataFrame) into (X, label code) tensors."""
+    for X_batch, obs_batch in dataloader:
+        if hasattr(X_batch, "indptr"):
+            X_batch = _csr_tensor(X_batch)
+        else:
+            X_batch = torch.from_numpy(X_batch).float()
+        yield X_batch, label_encoder(obs_batch[TARGET_COLUMN])
+
+
+def train(soma_uri=None, root_cl_id='CL:0000988', min_cell_count=5000, num_epochs=10, batches_per_epoch=200,
+          batch_size=256, lr=5e-4, device=None, output_path=None, shard_path=None, sparse=False, prefetch=2,
+          prefetch_workers=1, num_workers=0, target_sum=None, scale=False, clip=None, stratified=False,
+          block_cells=DEFAULT_BLOCK_CELLS, alpha=0.0, log_space=False, amp=None, grad_accum_steps=1,
+          log_every=50, val_every=1, val_batches=50, distributed=False):
+    """
+    Trains a SimpleNN with the MarginalizationLoss on a local SOMA experiment or an
+    exported shard store, following the training loop of `train_blood_cell.ipynb`.
+
+    Args:
+        soma_uri (str): Path to the local SOMA experiment.
+        root_cl_id (str): Root CL ID of the preprocessed artifact bundle to use.
+        min_cell_count (int): min_cell_count of the preprocessed artifact bundle to use.
+        num_epochs (int): Number of epochs.
+        batches_per_epoch (int): Number of batches per epoch.
+        batch_size (int): Cells per batch.
+        lr (float): Adam learning rate.
+        device (str, optional): Torch device. Defaults to the first GPU if available.
+        output_path (str, optional): Where to save the trained model's state dict.
+        shard_path (str, optional): Read the cells from this shard store (see
+            `mccell export --format shards`) instead of `soma_uri`.
+        sparse (bool): Feed batches to the model as sparse CSR tensors instead of
+            densifying them (see `SimpleNN`).
+        prefetch (int): Batches fetched and prepared ahead of the training step on
+            background threads (see `Prefetcher`); 0 prepares each batch inline.
+        prefetch_workers (int): Threads preparing prefetched batches.
+        num_workers (int): DataLoader worker processes reading the batches.
+        target_sum (float, optional): Normalize each cell's counts to this total
+            before log1p (see `Normalizer`). By default counts are only log1p'd.
+        scale (bool): Divide each gene by its standard deviation, computed once
+            over the shard store and cached (shard stores only).
+        clip (float, optional): Clip the normalized values at this maximum.
+        stratified (bool): Draw training batches stratified over the ontology's
+            leaf and internal nodes, read as blocks of `block_cells` consecutive
+            cells of one label (see `StratifiedBlockSampler`), instead of
+            shuffling globally.
+        block_cells (int): Consecutive cells of one label per read, with `stratified`.
+        alpha (float): Within-node smoothing exponent, with `stratified` (see `stratum_weights`).
+        log_space (bool): Compute the parent loss from log-probabilities (see
+            `MarginalizationLoss`), which stays accurate for confident predictions.
+        amp (str, optional): Run the model under autocast in "bf16" or "fp16"
+            (with gradient scaling). The loss itself is always computed in float32.
+        grad_accum_steps (int): Batches whose gradients are accumulated per optimizer step.
+        log_every (int): Batches between progress messages (loss and cells/s).
+        val_every (int): Epochs between validation passes; 0 disables validation.
+        val_batches (int): Batches per validation pass.
+        distributed (bool): Train data-parallel with `DistributedDataParallel`, one
+            process per rank as started by `torchrun` or SLURM `srun` (see
+            `init_distributed`). Each rank reads its own cells, and batch_size and
+            batches_per_epoch are per rank; only rank 0 saves the model.
+
+    Returns:
+        tuple: (model, batch_loss_history)
+    """
+    rank, world_size = 0, 1
+    if distributed:
+        rank, world_size, device = init_distributed(device)
+    else:
+        device = torch.device(device or ("cuda:0" if torch.cuda.is_available() else "cpu"))
+    log(f"Using device: {device}")
+
+    # Rank 0 builds the caches (bundle, coordinates, gene statistics) that the other ranks then read
+    with main_rank_first():
+        bundle = resolve_bundle(root_cl_id=root_cl_id, min_cell_count=min_cell_count)
+        mapping_dict = bundle.mapping_dict
+        # By default batches are only log1p'd, when they are prepared for the step
+        normalizer = None
+        normalize_counts = target_sum is not None or scale or clip is not None
+
+        if shard_path is not None:
+            from src.data_pipeline.shards import ShardStore
+
+            store = ShardStore(shard_path)
+            if store.manifest["bundle"] != bundle.content_hash:
+                raise ValueError(f"The shards at {shard_path} were exported for a different artifact bundle.")
+            log(f"Training on {len(mapping_dict)} cell types and {store.n_genes} genes from {shard_path}.")
+            if normalize_counts:
+                # Normalized in the dataset, on the CSR values before densifying
+                normalizer = build_normalizer(store, target_sum=target_sum, scale=scale, clip=clip)
+            prepare = partial(prepare_batch, normalize=log1p if normalizer is None else None)
+            if stratified:
+                train_dataloader, val_dataloader, input_dim = build_stratified_shard_dataloaders(
+                    shard_path, bundle, batch_size=batch_size, batches_per_epoch=batches_per_epoch,
+                    block_cells=block_cells, alpha=alpha, num_workers=num_workers, sparse=sparse,
+                    normalize=normalizer, rank=rank, world_size=world_size
+                )
+            else:
+                train_dataloader, val_dataloader, input_dim = build_shard_dataloaders(
+                    shard_path, batch_size=batch_size, sparse=sparse, num_workers=num_workers,
+                    normalize=normalizer, rank=rank, world_size=world_size
+                )
+        elif stratified:
+            gene_list = load_protein_coding_genes()
+            log(f"Training on {len(mapping_dict)} cell types and {len(gene_list)} protein-coding genes.")
+            if normalize_counts:
+                normalizer = build_normalizer(target_sum=target_sum, scale=scale, clip=clip)
+            prepare = partial(prepare_batch, normalize=log1p if normalizer is None else None)
+            train_dataloader, val_dataloader, input_dim = build_stratified_experiment_dataloaders(
+                soma_uri, bundle, gene_list, batch_size=batch_size, batches_per_epoch=batches_per_epoch,
+                block_cells=block_cells, alpha=alpha, num_workers=num_workers, sparse=sparse, normalize=normalizer,
+                rank=rank, world_size=world_size
+            )
+        else:
+            gene_list = load_protein_coding_genes()
+            log(f"Training on {len(mapping_dict)} cell types and {len(gene_list)} protein-coding genes.")
+            experiment_dataloader, val_dataloader, input_dim = build_experiment_dataloaders(
+                soma_uri, bundle.terms, gene_list, batch_size=batch_size, sparse=sparse, num_workers=num_workers
+            )
+            train_dataloader = None
+            if normalize_counts:
+                normalizer = build_normalizer(target_sum=target_sum, scale=scale, clip=clip)
+            prepare = partial(prepare_batch, normalize=log1p if normalizer is None else normalizer)
+            # Prefetched batches are pinned by the Prefetcher
+            label_encoder = LabelEncoder(mapping_dict, pin_memory=device.type == "cuda" and prefetch == 0)
+
+    model = SimpleNN(input_dim=input_dim, output_dim=len(bundle.leaf_values)).to(device)
+    if distributed:
+        model = DistributedDataParallel(model, device_ids=[device] if device.type == "cuda" else None)
+        # A rank that runs out of batches would leave the others waiting in the gradient all-reduce,
+        # so every rank runs as many batches as the rank with the fewest
+        n_batches = min(batches_per_epoch, len(experiment_dataloader if train_dataloader is None else train_dataloader))
+        n_batches = int(all_reduce(torch.tensor(n_batches, device=device), torch.distributed.ReduceOp.MIN).item())
+        if n_batches < batches_per_epoch:
+            log(f"Training on {n_batches} batches per epoch and rank, as much as every rank has.")
+            batches_per_epoch = n_batches
+    optimizer = optim.Adam(model.parameters(), lr=lr)
+    loss_fn = MarginalizationLoss.from_bundle(bundle, device=device, log_space=log_space)
+    trainer = Trainer(model, loss_fn, optimizer, device, amp=amp, grad_accum_steps=grad_accum_steps,
+                      log_every=log_every)
+
+    def prepared(batches):
+        # Fetch, log1p and label encoding of the next batches overlap the current step
+        if prefetch > 0:
+            return Prefetcher(batches, prepare, depth=prefetch, workers=prefetch_workers,
+                              pin_memory=device.type == "cuda")
+        return map(prepare, batches)
+
+    def train_batches(epoch):
+        if train_dataloader is None:
+            return prepared(_soma_batches(experiment_dataloader, label_encoder))
+        train_dataloader.dataset.set_epoch(epoch)
+        return prepared(train_dataloader)
+
+    def validation_batches(epoch):
+        if train_dataloader is None:
+            return prepared(_soma_batches(val_dataloader, label_encoder))
+        return prepared(val_dataloader)
+
+    batch_loss_history, _ = trainer.fit(train_batches, num_epochs, batches_per_epoch,
+                                        val_batches=validation_batches, val_every=val_every,
+                                        val_max_batches=val_batches)
+
+    model = trainer.module
+    if output_path is not None and rank == 0:
+        normalization = {"log1p": True} if normalizer is None else normalizer.params()
+        torch.save({"model_state_dict": model.state_dict(), "bundle": bundle.content_hash,
+                    "normalization": normalization}, output_path)
+        print(f"Saved model to {output_path}")
+    if distributed:
+        destroy_distributed()
+    return model, batch_loss_history
+
+
+def load_train_config(path):
+    """
+    Reads a config file of `train` keyword arguments (see `load_config`), so that
+    runs can be launched headless, e.g. `mccell train --config sweep/run-3.toml`.
+
+    Raises:
+        ValueError: If the file has options that `train` does not take.
+    """
+    config = load_config(path)
+    unknown = sorted(set(config) - set(inspect.signature(train).parameters))
+    if unknown:
+        raise ValueError(f"Unknown training options in {path}: {', '.join(unknown)}")
+    return config
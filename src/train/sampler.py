@@ -0,0 +1,256 @@
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+
+from src.data_pipeline.shards import _coo_to_csr
+from src.train.shard_dataset import csr_batch
+
+DEFAULT_BLOCK_CELLS = 32
+
+
+def node_membership(bundle):
+    """
+    Returns the (terms x terms) bool array whose column `v` marks the terms in
+    the subtree of node `v`: the node itself and, for internal nodes, its
+    descendants (from the bundle's parent-child matrix).
+    """
+    n_terms = len(bundle.terms)
+    membership = np.eye(n_terms, dtype=bool)
+    membership[:, len(bundle.leaf_values):] |= bundle.parent_child
+    return membership
+
+
+def stratum_weights(bundle, label_counts, alpha=0.0):
+    """
+    Sampling weight of each label so that batches are stratified over the
+    ontology's leaf and internal nodes.
+
+    Every node with cells in its subtree gets the same share of the draws, and
+    spreads it over the labels in its subtree in proportion to `count ** alpha`:
+    with `alpha=0` evenly, with `alpha=1` like the data. A label's weight is the
+    sum of the shares it receives from the nodes above it, so every leaf and
+    every internal node is represented regardless of how many cells it has.
+
+    Args:
+        bundle (ArtifactBundle): Provides the hierarchy; labels are `mapping_dict` indices.
+        label_counts (np.ndarray): Number of cells of each label.
+        alpha (float): Within-node smoothing exponent.
+
+    Returns:
+        np.ndarray: float64 weights summing to 1, zero for labels without cells.
+    """
+    label_counts = np.asarray(label_counts, dtype=np.float64)
+    membership = node_membership(bundle) & (label_counts > 0)[:, None]
+    label_mass = np.where(label_counts > 0, label_counts ** alpha, 0.0)
+    node_mass = label_mass @ membership
+    nodes = node_mass > 0
+    if not nodes.any():
+        raise ValueError("None of the bundle's labels has any cells.")
+    # (labels x nodes) share of each node's draws going to each label
+    shares = membership[:, nodes] * label_mass[:, None] / node_mass[nodes]
+    weights = shares.sum(axis=1)
+    return weights / weights.sum()
+
+
+class StratifiedBlockSampler:
+    """
+    Draws batches of cell ids stratified over the ontology, reading contiguous
+    blocks of cells within each label.
+
+    A per-label index lists the ids of each label's cells in increasing order
+    and cuts it into blocks of `block_cells` consecutive entries. Each batch
+    draws labels by `stratum_weights` and takes the next unread block of each
+    drawn label (the blocks of a label are visited in a shuffled order, then
+    reshuffled). Compared to a global shuffle, which reads `batch_size`
+    scattered cells, a batch is `batch_size / block_cells` runs of nearby ids,
+    and the per-label coverage follows the hierarchy rather than the skewed
+    label distribution.
+
+    Args:
+        ids (np.ndarray): Cell ids in storage order (e.g. soma_joinids or shard
+            store positions), sorted.
+        labels (np.ndarray): `mapping_dict` index of each cell.
+        bundle (ArtifactBundle): The hierarchy (see `stratum_weights`).
+        batch_size (int): Cells per batch.
+        block_cells (int): Consecutive cells of one label read together.
+        alpha (float): Within-node smoothing exponent of `stratum_weights`.
+        n_batches (int): Batches per epoch.
+        seed (int): Base seed; see `set_epoch`.
+
+    Yields:
+        np.ndarray: Sorted, unique ids of the cells of a batch.
+    """
+
+    def __init__(self, ids, labels, bundle, batch_size=256, block_cells=DEFAULT_BLOCK_CELLS, alpha=0.0,
+                 n_batches=1000, seed=111):
+        ids = np.asarray(ids)
+        labels = np.asarray(labels)
+        if len(ids) != len(labels):
+            raise ValueError(f"Got {len(ids)} ids and {len(labels)} labels.")
+        if len(ids) > 1 and not (np.diff(ids) > 0).all():
+            raise ValueError("ids must be sorted and unique.")
+        n_terms = len(bundle.terms)
+        # Per-label index: a stable sort keeps each label's ids in storage order
+        order = np.argsort(labels, kind="stable")
+        self.ids = ids[order]
+        self.counts = np.bincount(labels, minlength=n_terms)[:n_terms]
+        self.offsets = np.concatenate([[0], np.cumsum(self.counts)])
+        self.weights = stratum_weights(bundle, self.counts, alpha)
+        self.batch_size = batch_size
+        self.block_cells = block_cells
+        self.n_batches = n_batches
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        """Changes the draws on the next iteration; call once per epoch."""
+        self.epoch = epoch
+
+    def __len__(self):
+        return self.n_batches
+
+    def _block(self, rng, label, cursors):
+        """Returns the next unread block of `label`, reshuffling its blocks once all were read."""
+        n_blocks = -(-int(self.counts[label]) // self.block_cells)
+        order, position = cursors.get(label, (None, n_blocks))
+        if position == n_blocks:
+            order, position = rng.permutation(n_blocks), 0
+        cursors[label] = (order, position + 1)
+        start = self.offsets[label] + order[position] * self.block_cells
+        return self.ids[start:min(start + self.block_cells, self.offsets[label + 1])]
+
+    def __iter__(self):
+        rng = np.random.default_rng((self.seed, self.epoch))
+        cursors = {}
+        n_draws = -(-self.batch_size // self.block_cells)
+        target = min(self.batch_size, len(self.ids))
+        for _ in range(self.n_batches):
+            batch = np.zeros(0, dtype=self.ids.dtype)
+            while len(batch) < target:
+                blocks = [self._block(rng, label, cursors)
+                          for label in rng.choice(len(self.weights), size=n_draws, p=self.weights)]
+                # Unique and sorted: a small label drawn twice in a batch contributes its cells once
+                batch = np.unique(np.concatenate([batch] + blocks))
+            if len(batch) > self.batch_size:
+                batch = np.sort(rng.choice(batch, self.batch_size, replace=False))
+            yield batch
+
+
+class SequentialBatchSampler:
+    """Batches of consecutive ids in storage order, e.g. for a validation pass."""
+
+    def __init__(self, ids, batch_size=256):
+        self.ids = np.asarray(ids)
+        self.batch_size = batch_size
+
+    def set_epoch(self, epoch):
+        pass
+
+    def __len__(self):
+        return -(-len(self.ids) // self.batch_size)
+
+    def __iter__(self):
+        for start in range(0, len(self.ids), self.batch_size):
+            yield self.ids[start:start + self.batch_size]
+
+
+def count_runs(ids):
+    """Number of runs of consecutive ids in a sorted batch, i.e. of sequential reads to fetch it."""
+    return int(np.count_nonzero(np.diff(ids) != 1)) + 1 if len(ids) else 0
+
+
+class _SampledDataset(IterableDataset):
+    """
+    Yields (X, y) for the batches of ids drawn by `sampler`. DataLoader workers
+    all iterate the sampler (drawing ids is cheap) and each reads every
+    `num_workers`-th batch, so the batches do not depend on the worker count.
+    """
+
+    def __init__(self, sampler, sparse=False, normalize=None):
+        self.sampler = sampler
+        self.sparse = sparse
+        self.normalize = normalize
+
+    def set_epoch(self, epoch):
+        """Redraws the batches on the next iteration; call once per epoch."""
+        self.sampler.set_epoch(epoch)
+
+    def __len__(self):
+        return len(self.sampler)
+
+    def _read(self, ids):
+        """Returns the CSR arrays (indptr, indices, data) and int64 labels of the cells."""
+        raise NotImplementedError
+
+    def __iter__(self):
+        worker = get_worker_info()
+        for i, ids in enumerate(self.sampler):
+            if worker is not None and i % worker.num_workers != worker.id:
+                continue
+            indptr, indices, data, labels = self._read(ids)
+            if self.normalize is not None:
+                data = self.normalize.normalize_csr(indptr, indices, data)
+            X = csr_batch(indptr, indices, data, self.n_genes, self.sparse)
+            yield X, torch.from_numpy(labels.astype(np.int64))
+
+
+class SampledShardDataset(_SampledDataset):
+    """
+    Reads the batches of store positions drawn by `sampler` from a `ShardStore`,
+    each as runs of consecutive cells (see `ShardStore.read_rows`).
+
+    Yields:
+        tuple: (X, y) as `ShardDataset`.
+    """
+
+    def __init__(self, store, sampler, sparse=False, normalize=None):
+        super().__init__(sampler, sparse, normalize)
+        self.store = store
+        self.n_genes = store.n_genes
+
+    def _read(self, ids):
+        return self.store.read_rows(ids)
+
+
+class SampledExperimentDataset(_SampledDataset):
+    """
+    Reads the batches of soma_joinids drawn by `sampler` from the raw X layer of
+    a local SOMA experiment, restricted to the genes `var_joinids`.
+
+    Args:
+        soma_uri (str): Path to the local SOMA experiment.
+        obs_joinids (np.ndarray): Sorted soma_joinids of the cells the sampler draws from.
+        labels (np.ndarray): `mapping_dict` index of each of those cells.
+        var_joinids (np.ndarray): Sorted soma_joinids of the genes, i.e. the columns of X.
+        sampler: Draws the batches of soma_joinids (e.g. `StratifiedBlockSampler`).
+
+    Yields:
+        tuple: (X, y) with X a float32 tensor (batch x genes), dense or sparse
+        CSR, and y an int64 tensor of `mapping_dict` indices.
+    """
+
+    def __init__(self, soma_uri, obs_joinids, labels, var_joinids, sampler, layer="raw", sparse=False,
+                 normalize=None):
+        super().__init__(sampler, sparse, normalize)
+        self.soma_uri = str(soma_uri)
+        self.obs_joinids = np.asarray(obs_joinids)
+        self.labels = np.asarray(labels)
+        self.var_joinids = np.asarray(var_joinids)
+        self.layer = layer
+        self.n_genes = len(self.var_joinids)
+        self._X = None
+
+    def __getstate__(self):
+        # DataLoader workers open the experiment themselves
+        return dict(self.__dict__, _X=None)
+
+    def _read(self, ids):
+        import tiledbsoma as soma
+
+        if self._X is None:
+            self._X = soma.open(self.soma_uri, mode="r").ms["RNA"].X[self.layer]
+        table = self._X.read(coords=(ids, self.var_joinids)).tables().concat()
+        rows = np.searchsorted(ids, table.column("soma_dim_0").to_numpy())
+        cols = np.searchsorted(self.var_joinids, table.column("soma_dim_1").to_numpy())
+        indptr, indices, data = _coo_to_csr(rows, cols, table.column("soma_data").to_numpy(), len(ids))
+        return indptr, indices, data, self.labels[np.searchsorted(self.obs_joinids, ids)]
@@ -0,0 +1,125 @@
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+
+from src.data_pipeline.shards import concat_csr, take_csr_rows
+
+
+def csr_batch(indptr, indices, data, n_genes, sparse=False):
+    """Builds the float32 X tensor of CSR rows: dense, or a sparse CSR tensor with `sparse=True`."""
+    if not sparse:
+        n_rows = len(indptr) - 1
+        X = np.zeros((n_rows, n_genes), dtype=np.float32)
+        X[np.repeat(np.arange(n_rows), np.diff(indptr)), indices] = data
+        return torch.from_numpy(X)
+    return torch.sparse_csr_tensor(torch.from_numpy(np.asarray(indptr, dtype=np.int64)),
+                                   torch.from_numpy(indices.astype(np.int64)),
+                                   torch.from_numpy(data.astype(np.float32)), size=(len(indptr) - 1, n_genes))
+
+
+class ShardDataset(IterableDataset):
+    """
+    Iterates over a `ShardStore` in shuffled batches of dense expression and label codes.
+
+    Shuffling is two-level: the store is cut into blocks of `block_size`
+    consecutive cells, the blocks are visited in random order (each one a
+    sequential read of the memory-mapped shard), and the cells of
+    `blocks_per_buffer` blocks are shuffled together, still in CSR form, before
+    being batched. Only the batch being yielded is densified, or, with
+    `sparse=True`, handed over as a sparse CSR tensor without densifying. A
+    `normalize` (see `Normalizer`) is applied to the batch's CSR values before that.
+    DataLoader workers each take every `num_workers`-th block. In a data-parallel
+    run, the blocks are dealt to the `world_size` ranks in turn, so each rank
+    reads only its own blocks.
+
+    Yields:
+        tuple: (X, y) with X a float32 tensor (batch x genes) of the stored
+        values, dense or sparse CSR, and y an int64 tensor of `mapping_dict` indices.
+    """
+
+    def __init__(self, store, batch_size=256, cell_mask=None, block_size=4096, blocks_per_buffer=8,
+                 seed=111, drop_last=False, sparse=False, normalize=None, rank=0, world_size=1):
+        self.store = store
+        self.batch_size = batch_size
+        self.cell_mask = cell_mask
+        self.block_size = block_size
+        self.blocks_per_buffer = blocks_per_buffer
+        self.seed = seed
+        self.drop_last = drop_last
+        self.sparse = sparse
+        self.normalize = normalize
+        self.world_size = world_size
+        self.epoch = 0
+        self.blocks = [
+            (i, start, min(start + block_size, int(n)))
+            for i, n in enumerate(store.shard_sizes)
+            for start in range(0, int(n), block_size)
+        ][rank::world_size]
+
+    def set_epoch(self, epoch):
+        """Reshuffles on the next iteration; call once per epoch."""
+        self.epoch = epoch
+
+    def _n_cells(self):
+        if self.world_size == 1:
+            return len(self.store) if self.cell_mask is None else int(np.count_nonzero(self.cell_mask))
+        # Only the cells of this rank's blocks
+        offsets = self.store.shard_offsets
+        if self.cell_mask is None:
+            return sum(stop - start for _, start, stop in self.blocks)
+        return sum(int(np.count_nonzero(self.cell_mask[offsets[i] + start:offsets[i] + stop]))
+                   for i, start, stop in self.blocks)
+
+    def __len__(self):
+        n_cells = self._n_cells()
+        return n_cells // self.batch_size if self.drop_last else -(-n_cells // self.batch_size)
+
+    def _block_cells(self, shard_index, start, stop):
+        """Reads a block as CSR, keeping only the cells in `cell_mask`."""
+        indptr, indices, data, labels = self.store.read_block(shard_index, start, stop)
+        if self.cell_mask is not None:
+            offset = self.store.shard_offsets[shard_index]
+            rows = np.flatnonzero(self.cell_mask[offset + start:offset + stop])
+            indptr, indices, data = take_csr_rows(indptr, indices, data, rows)
+            labels = labels[rows]
+        return (indptr, indices, data), labels
+
+    def _batch(self, indptr, indices, data, rows=None):
+        """Builds the X tensor of the given rows of CSR arrays."""
+        if rows is not None:
+            indptr, indices, data = take_csr_rows(indptr, indices, data, rows)
+        if self.normalize is not None:
+            data = self.normalize.normalize_csr(indptr, indices, data)
+        return csr_batch(indptr, indices, data, self.store.n_genes, self.sparse)
+
+    def __iter__(self):
+        rng = np.random.default_rng((self.seed, self.epoch))
+        order = rng.permutation(len(self.blocks))
+        worker = get_worker_info()
+        if worker is not None:
+            order = order[worker.id::worker.num_workers]
+
+        # The shuffle buffer stays sparse; only the cells of one batch are densified at a time
+        leftover = None
+        for b in range(0, len(order), self.blocks_per_buffer):
+            blocks, labels = [], []
+            for block in order[b:b + self.blocks_per_buffer]:
+                csr, block_labels = self._block_cells(*self.blocks[block])
+                blocks.append(csr)
+                labels.append(block_labels)
+            if leftover is not None:
+                blocks.append(leftover[0])
+                labels.append(leftover[1])
+            indptr, indices, data = concat_csr(blocks)
+            y = np.concatenate(labels).astype(np.int64)
+
+            perm = rng.permutation(len(y))
+            n_full = len(y) // self.batch_size * self.batch_size
+            for s in range(0, n_full, self.batch_size):
+                rows = perm[s:s + self.batch_size]
+                yield self._batch(indptr, indices, data, rows), torch.from_numpy(y[rows])
+            rest = perm[n_full:]
+            leftover = (take_csr_rows(indptr, indices, data, rest), y[rest])
+
+        if leftover is not None and len(leftover[1]) and not self.drop_last:
+            yield self._batch(*leftover[0]), torch.from_numpy(leftover[1])
@@ -0,0 +1,322 @@
+import json
+import time
+from contextlib import nullcontext
+from dataclasses import dataclass
+from pathlib import Path
+
+import torch
+from torch.nn.parallel import DistributedDataParallel
+
+from src.train.distributed import all_reduce, log
+
+# Autocast dtype of each `amp` setting
+AMP_DTYPES = {None: None, "bf16": torch.bfloat16, "fp16": torch.float16}
+
+
+def load_config(path):
+    """
+    Reads a training config file: a JSON or TOML (by extension) table of `train`
+    keyword arguments, e.g. {"shard_path": "data/shards", "num_epochs": 20, "amp": "bf16"}.
+
+    Args:
+        path (str): Path to the .json or .toml file.
+
+    Returns:
+        dict: The keyword arguments.
+
+    Raises:
+        ValueError: If the file does not hold a table of options.
+    """
+    path = Path(path)
+    if path.suffix == ".toml":
+        import tomllib
+
+        with open(path, "rb") as f:
+            config = tomllib.load(f)
+    else:
+        with open(path) as f:
+            config = json.load(f)
+    if not isinstance(config, dict):
+        raise ValueError(f"{path} must hold a table of training options, got {type(config).__name__}.")
+    return config
+
+
+@dataclass
+class Window:
+    """
+    The metrics of a window of training batches (see `RunningMetrics`): the mean of
+    each metric, and the first metric's value for every batch in `history`.
+    """
+    batch_index: int
+    n_batches: int
+    cells: int
+    seconds: float
+    means: dict
+    history: list
+
+    @property
+    def cells_per_second(self):
+        return self.cells / max(self.seconds, 1e-9)
+
+
+class RunningMetrics:
+    """
+    Sums per-batch metrics on the device and reduces them away from the training step.
+
+    `add` only queues device ops, so a step never waits for the GPU to report its
+    loss. `flush` closes a window of batches: it starts a non-blocking copy of the
+    window's sums and per-batch losses to the host and resets them. `ready` returns
+    the windows whose copies have landed, so a window is usually reported while the
+    next one is already running; `ready(wait=True)` waits for all of them.
+
+    Args:
+        names (list): Names of the metrics passed to `add`; the first one's
+            per-batch values are also kept (see `Window.history`).
+        device (torch.device): Device the metrics are computed on.
+    """
+
+    def __init__(self, names, device):
+        self.names = list(names)
+        self.device = torch.device(device)
+        self._pending = []
+        self._reset()
+
+    def _reset(self):
+        self._sums = torch.zeros(len(self.names), device=self.device)
+        self._history = []
+        self._cells = 0
+        self._start = time.perf_counter()
+
+    def add(self, cells, *values):
+        """Adds a batch of `cells` cells with one scalar tensor per metric name."""
+        values = torch.stack([v.detach().float() for v in values])
+        self._sums += values
+        self._history.append(values[0])
+        self._cells += cells
+
+    def flush(self, batch_index=None):
+        """Closes the current window (if it has any batches) and starts copying it to the host."""
+        if not self._history:
+            return
+        values = torch.cat([self._sums, torch.stack(self._history)])
+        event = None
+        if values.device.type == "cuda":
+            host = torch.empty(values.shape, dtype=values.dtype, pin_memory=True)
+            host.copy_(values, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record()
+            values = host
+        self._pending.append((values, event, batch_index, self._cells, time.perf_counter() - self._start))
+        self._reset()
+
+    def ready(self, wait=False):
+        """Returns the flushed windows whose values reached the host, oldest first."""
+        windows = []
+        while self._pending and (wait or self._pending[0][1] is None or self._pending[0][1].query()):
+            values, event, batch_index, cells, seconds = self._pending.pop(0)
+            if event is not None:
+                event.synchronize()
+            values = values.tolist()
+            history = values[len(self.names):]
+            means = {name: total / len(history) for name, total in zip(self.names, values)}
+            windows.append(Window(batch_index, len(history), cells, seconds, means, history))
+        return windows
+
+
+class Trainer:
+    """
+    Runs training and validation of a model with `MarginalizationLoss`.
+
+    Each batch is a host (X, y) pair as `prepare_batch` returns it; it is copied to
+    the device, the forward pass runs under autocast if `amp` is set, and the loss
+    of `grad_accum_steps` batches is accumulated per optimizer step (with gradient
+    clipping and, for fp16, gradient scaling). Losses are reduced through
+    `RunningMetrics`, so the steps themselves never synchronize with the device,
+    and every `log_every` batches the loss and the throughput in cells per second
+    are printed.
+
+    The model may be wrapped in `DistributedDataParallel` (see `init_distributed`).
+    Gradients are then all-reduced only on the last batch of each accumulation
+    group, every rank must run the same number of batches per epoch, and the
+    epoch throughput and validation results are reduced over all ranks; the
+    per-batch losses are this rank's. Progress is printed by rank 0 only.
+
+    Args:
+        model (nn.Module): The model, on `device`, optionally wrapped in `DistributedDataParallel`.
+        loss_fn (MarginalizationLoss): The loss, on `device`.
+        optimizer (torch.optim.Optimizer): Optimizer of the model's parameters.
+        device (torch.device): Device to train on.
+        amp (str, optional): Autocast precision of the forward pass, "bf16" or "fp16".
+            The loss itself is always computed in float32.
+        grad_accum_steps (int): Batches whose gradients are summed per optimizer step.
+        max_grad_norm (float, optional): Clip the gradient norm to this value.
+        log_every (int): Batches between progress messages.
+
+    Raises:
+        ValueError: If `amp` is not one of the supported settings.
+    """
+
+    def __init__(self, model, loss_fn, optimizer, device, amp=None, grad_accum_steps=1, max_grad_norm=1.0,
+                 log_every=50):
+        if amp not in AMP_DTYPES:
+            raise ValueError(f"amp must be one of {sorted(k for k in AMP_DTYPES if k)}, got {amp!r}.")
+        self.model = model
+        self.distributed = isinstance(model, DistributedDataParallel)
+        # The model itself, for validation and checkpoints
+        self.module = model.module if self.distributed else model
+        self.loss_fn = loss_fn
+        self.optimizer = optimizer
+        self.device = torch.device(device)
+        self.amp = amp
+        self.grad_accum_steps = max(1, grad_accum_steps)
+        self.max_grad_norm = max_grad_norm
+        self.log_every = log_every
+        # fp16 gradients can underflow, so they are scaled; with bf16 or float32 the scaler is a no-op
+        self.scaler = torch.amp.GradScaler(self.device.type, enabled=amp == "fp16")
+
+    def _forward(self, X_batch, y_batch, model=None):
+        X_batch = X_batch.to(self.device, non_blocking=True)
+        y_batch = y_batch.to(self.device, non_blocking=True)
+        with torch.autocast(self.device.type, dtype=AMP_DTYPES[self.amp], enabled=self.amp is not None):
+            outputs = (self.model if model is None else model)(X_batch)
+            losses = self.loss_fn(outputs, y_batch)
+        return outputs, y_batch, losses
+
+    def _optimizer_step(self):
+        self.scaler.unscale_(self.optimizer)
+        if self.max_grad_norm is not None:
+            torch.nn.utils.clip_grad_norm_(self.model.parameters(), max_norm=self.max_grad_norm)
+        self.scaler.step(self.optimizer)
+        self.scaler.update()
+        self.optimizer.zero_grad(set_to_none=True)
+
+    def _report(self, windows):
+        for window in windows:
+            log(f'  [Batch {window.batch_index:3d}] Total Loss: {window.means["total"]:.4f} '
+                  f'(Leaf: {window.means["leaf"]:.4f}, Parent: {window.means["parent"]:.4f}), '
+                  f'{window.cells_per_second:,.0f} cells/s')
+        return windows
+
+    def train_epoch(self, batches, max_batches):
+        """
+        Trains on up to `max_batches` batches of `batches`.
+
+        Returns:
+            list: The total loss of every batch.
+        """
+        self.model.train()
+        metrics = RunningMetrics(["total", "leaf", "parent"], self.device)
+        windows = []
+        self.optimizer.zero_grad(set_to_none=True)
+
+        n_batches = 0
+        data_seconds = 0.0
+        epoch_start = step_end = time.perf_counter()
+        for X_batch, y_batch in batches:
+            if n_batches >= max_batches:
+                break
+            data_seconds += time.perf_counter() - step_end
+            n_batches += 1
+
+            # Under DDP, gradients are only all-reduced at the end of an accumulation group
+            sync = n_batches % self.grad_accum_steps == 0 or n_batches == max_batches
+            with self.model.no_sync() if self.distributed and not sync else nullcontext():
+                _, y_batch, (total_loss, loss_leafs, loss_parents) = self._forward(X_batch, y_batch)
+                self.scaler.scale(total_loss / self.grad_accum_steps).backward()
+            if n_batches % self.grad_accum_steps == 0:
+                self._optimizer_step()
+
+            metrics.add(len(y_batch), total_loss, loss_leafs, loss_parents)
+            if n_batches % self.log_every == 0:
+                metrics.flush(n_batches)
+                windows += self._report(metrics.ready())
+            step_end = time.perf_counter()
+
+        # Gradients of a last, incomplete accumulation group
+        if n_batches % self.grad_accum_steps:
+            self._optimizer_step()
+        metrics.flush(n_batches)
+        windows += self._report(metrics.ready(wait=True))
+
+        epoch_seconds = time.perf_counter() - epoch_start
+        cells = sum(window.cells for window in windows)
+        if self.distributed:
+            cells = int(all_reduce(torch.tensor(cells, device=self.device)).item())
+        log(f'  Waited on data for {data_seconds:.1f}s of {epoch_seconds:.1f}s '
+              f'({100 * data_seconds / max(epoch_seconds, 1e-9):.0f}%), {cells / max(epoch_seconds, 1e-9):,.0f} cells/s')
+        return [loss for window in windows for loss in window.history]
+
+    @torch.no_grad()
+    def evaluate(self, batches, max_batches=None):
+        """
+        Computes the mean losses over up to `max_batches` batches of `batches`, and
+        the accuracy of the predicted leaf on the leaf-labeled cells. In a
+        data-parallel run, each rank passes its own batches and the results are
+        over all of them.
+
+        Returns:
+            dict: "total", "leaf" and "parent" mean batch losses, "leaf_accuracy"
+            (nan without leaf-labeled cells) and the number of "cells".
+        """
+        self.module.eval()
+        # Batch losses, correct and leaf-labeled cells, then the batch and cell counts
+        sums = torch.zeros(7, device=self.device)
+        n_batches = 0
+        for X_batch, y_batch in batches:
+            if max_batches is not None and n_batches >= max_batches:
+                break
+            n_batches += 1
+            # Without the DDP wrapper, ranks with fewer batches do not hold the others up
+            outputs, y_batch, (total_loss, loss_leafs, loss_parents) = self._forward(X_batch, y_batch, self.module)
+            is_leaf = self.loss_fn.is_leaf[y_batch]
+            correct = (outputs.argmax(dim=1) == y_batch) & is_leaf
+            sums[:5] += torch.stack([total_loss.float(), loss_leafs.float(), loss_parents.float(),
+                                     correct.sum().float(), is_leaf.sum().float()])
+            sums[5] += 1
+            sums[6] += len(y_batch)
+        total, leaf, parent, correct, n_leaf, n_batches, cells = all_reduce(sums).tolist()
+        n_batches = max(n_batches, 1)
+        return {"total": total / n_batches, "leaf": leaf / n_batches, "parent": parent / n_batches,
+                "leaf_accuracy": correct / n_leaf if n_leaf else float("nan"), "cells": int(cells)}
+
+    def fit(self, train_batches, num_epochs, batches_per_epoch, val_batches=None, val_every=1, val_max_batches=None):
+        """
+        Trains for `num_epochs` epochs and validates every `val_every` epochs.
+
+        Args:
+            train_batches (callable): epoch -> iterable of (X, y) training batches.
+                Iterables with a `close` method (e.g. a `Prefetcher`) are closed
+                after the epoch.
+            num_epochs (int): Number of epochs.
+            batches_per_epoch (int): Training batches per epoch.
+            val_batches (callable, optional): epoch -> iterable of (X, y) validation batches.
+            val_every (int): Epochs between validation passes.
+            val_max_batches (int, optional): Validation batches per pass (default: all).
+
+        Returns:
+            tuple: (batch_loss_history, val_history), the total loss of every training
+            batch and the `evaluate` results of every validation pass.
+        """
+        batch_loss_history, val_history = [], []
+        log(f"\nStarting training for {num_epochs} epochs ({batches_per_epoch} batches each)...")
+        for epoch in range(num_epochs):
+            log(f'\n--- Epoch {epoch + 1} ---')
+            batches = train_batches(epoch)
+            try:
+                batch_loss_history += self.train_epoch(batches, batches_per_epoch)
+            finally:
+                if hasattr(batches, "close"):
+                    batches.close()
+
+            if val_batches is not None and val_every and (epoch + 1) % val_every == 0:
+                batches = val_batches(epoch)
+                try:
+                    results = self.evaluate(batches, val_max_batches)
+                finally:
+                    if hasattr(batches, "close"):
+                        batches.close()
+                val_history.append(results)
+                log(f'  Validation: Total Loss: {results["total"]:.4f} (Leaf: {results["leaf"]:.4f}, '
+                      f'Parent: {results["parent"]:.4f}), Leaf Accuracy: {results["leaf_accuracy"]:.4f}')
+        log('\nFinished Training.')
+        return batch_loss_history, val_history
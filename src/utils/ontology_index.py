@@ -0,0 +1,345 @@
+import json
+from pathlib import Path
+
+import numpy as np
+
+INDEX_FORMAT_VERSION = 1
+
+_ARRAY_FILES = (
+    "term_ids",
+    "term_names",
+    "parents_indptr",
+    "parents_indices",
+    "children_indptr",
+    "children_indices",
+    "ancestors",
+    "descendants",
+)
+
+
+def _csr_from_lists(neighbors):
+    """Packs a list of integer neighbor lists into CSR (indptr, indices) arrays."""
+    indptr = np.zeros(len(neighbors) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(n) for n in neighbors])
+    indices = np.fromiter(
+        (j for n in neighbors for j in sorted(n)), dtype=np.int32, count=int(indptr[-1])
+    )
+    return indptr, indices
+
+
+def _packed_closure(indptr, indices, n_terms):
+    """
+    Computes the reflexive transitive closure of a DAG given as CSR adjacency.
+
+    Nodes are visited in topological order so that every neighbor's row is final
+    before it is OR-ed into the current row. Each row is a bit-packed set of terms.
+
+    Returns:
+        np.ndarray: uint8 array of shape (n_terms, ceil(n_terms / 8)).
+    """
+    # Kahn's algorithm on the reversed edges: a node is ready once all of its
+    # neighbors (e.g. its parents, for the ancestor closure) have been finalized.
+    remaining = np.diff(indptr).astype(np.int64)
+    reverse = [[] for _ in range(n_terms)]
+    for i in range(n_terms):
+        for j in indices[indptr[i]:indptr[i + 1]]:
+            reverse[j].append(i)
+
+    n_bytes = (n_terms + 7) // 8
+    closure = np.zeros((n_terms, n_bytes), dtype=np.uint8)
+    ready = [i for i in range(n_terms) if remaining[i] == 0]
+    n_done = 0
+    while ready:
+        i = ready.pop()
+        n_done += 1
+        neighbors = indices[indptr[i]:indptr[i + 1]]
+        if len(neighbors):
+            closure[i] = np.bitwise_or.reduce(closure[neighbors], axis=0)
+        closure[i, i >> 3] |= np.uint8(0x80 >> (i & 7))
+        for k in reverse[i]:
+            remaining[k] -= 1
+            if remaining[k] == 0:
+                ready.append(k)
+
+    if n_done != n_terms:
+        raise ValueError("The is_a graph contains a cycle; cannot compute its closure.")
+    return closure
+
+
+class IndexTerm:
+    """
+    A lightweight stand-in for `pronto.Term`, returned by `OntologyIndex[term_id]`.
+
+    It exposes the subset of the pronto API used by the pipeline (`id`, `name`,
+    `is_leaf`, `superclasses`, `subclasses`) so code written against a pronto
+    ontology also runs against the memory-mapped index.
+    """
+    __slots__ = ("_index", "id")
+
+    def __init__(self, index, term_id):
+        self._index = index
+        self.id = term_id
+
+    def __repr__(self):
+        return f"IndexTerm({self.id!r}, name={self.name!r})"
+
+    def __eq__(self, other):
+        return isinstance(other, IndexTerm) and other.id == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+    @property
+    def name(self):
+        return self._index.name(self.id)
+
+    def is_leaf(self):
+        return self._index.is_leaf(self.id)
+
+    def superclasses(self, with_self=True):
+        return [IndexTerm(self._index, t) for t in self._index.superclasses(self.id, with_self=with_self)]
+
+    def subclasses(self, with_self=True):
+        return [IndexTerm(self._index, t) for t in self._index.subclasses(self.id, with_self=with_self)]
+
+
+class OntologyIndex:
+    """
+    A compact, memory-mapped view of the Cell Ontology's is_a hierarchy.
+
+    Terms are identified by their position in the sorted `term_ids` array. The
+    index stores CSR parent/child adjacency and the bit-packed reflexive
+    transitive closure in both directions, so ancestor, descendant and leaf
+    queries are a binary search plus a row read, with no Python object graph.
+
+    Arrays are opened with `np.load(..., mmap_mode="r")`, so several processes
+    loading the same index share one page-cached copy.
+    """
+
+    def __init__(self, arrays, meta):
+        self.meta = meta
+        self.term_ids = arrays["term_ids"]
+        self.term_names = arrays["term_names"]
+        self.parents_indptr = arrays["parents_indptr"]
+        self.parents_indices = arrays["parents_indices"]
+        self.children_indptr = arrays["children_indptr"]
+        self.children_indices = arrays["children_indices"]
+        self.ancestors_packed = arrays["ancestors"]
+        self.descendants_packed = arrays["descendants"]
+
+    # --- Construction and (de)serialization ---
+
+    @classmethod
+    def from_pronto(cls, cl):
+        """
+        Builds an index from a loaded pronto.Ontology.
+
+        Args:
+            cl (pronto.Ontology): The loaded Cell Ontology object.
+
+        Returns:
+            OntologyIndex: An in-memory index (call `save` to persist it).
+        """
+        term_ids = sorted(term.id for term in cl.terms())
+        position = {term_id: i for i, term_id in enumerate(term_ids)}
+
+        names = []
+        parents = []
+        children = [[] for _ in term_ids]
+        for i, term_id in enumerate(term_ids):
+            term = cl[term_id]
+            names.append(term.name or "")
+            term_parents = {
+                position[p.id] for p in term.superclasses(distance=1, with_self=False)
+                if p.id in position
+            }
+            parents.append(term_parents)
+            for p in term_parents:
+                children[p].append(i)
+
+        n_terms = len(term_ids)
+        parents_indptr, parents_indices = _csr_from_lists(parents)
+        children_indptr, children_indices = _csr_from_lists(children)
+
+        arrays = {
+            "term_ids": np.array(term_ids, dtype=str),
+            "term_names": np.array(names, dtype=str),
+            "parents_indptr": parents_indptr,
+            "parents_indices": parents_indices,
+            "children_indptr": children_indptr,
+            "children_indices": children_indices,
+            "ancestors": _packed_closure(parents_indptr, parents_indices, n_terms),
+            "descendants": _packed_closure(children_indptr, children_indices, n_terms),
+        }
+        meta = {
+            "format_version": INDEX_FORMAT_VERSION,
+            "n_terms": n_terms,
+            "data_version": cl.metadata.data_version,
+            "ontology": cl.metadata.ontology,
+        }
+        return cls(arrays, meta)
+
+    def save(self, path):
+        """Writes the index as a directory of `.npy` arrays plus `meta.json`."""
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        for name in _ARRAY_FILES:
+            np.save(path / f"{name}.npy", np.asarray(self._array(name)))
+        with open(path / "meta.json", "w") as f:
+            json.dump(self.meta, f, indent=2)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Memory-maps an index previously written by `save`.
+
+        Raises:
+            FileNotFoundError: If the index directory or one of its files is missing.
+            ValueError: If the index was written with an unsupported format version.
+        """
+        path = Path(path)
+        with open(path / "meta.json") as f:
+            meta = json.load(f)
+        if meta.get("format_version") != INDEX_FORMAT_VERSION:
+            raise ValueError(
+                f"Unsupported ontology index format {meta.get('format_version')} at {path}; "
+                "re-run cache_ontology.py."
+            )
+        arrays = {name: np.load(path / f"{name}.npy", mmap_mode="r") for name in _ARRAY_FILES}
+        return cls(arrays, meta)
+
+    def _array(self, name):
+        return {
+            "term_ids": self.term_ids,
+            "term_names": self.term_names,
+            "parents_indptr": self.parents_indptr,
+            "parents_indices": self.parents_indices,
+            "children_indptr": self.children_indptr,
+            "children_indices": self.children_indices,
+            "ancestors": self.ancestors_packed,
+            "descendants": self.descendants_packed,
+        }[name]
+
+    # --- Term lookup ---
+
+    def __len__(self):
+        return len(self.term_ids)
+
+    def __getitem__(self, term_id):
+        self.index_of(term_id)
+        return IndexTerm(self, term_id)
+
+    def __contains__(self, term_id):
+        i = np.searchsorted(self.term_ids, term_id)
+        return i < len(self.term_ids) and self.term_ids[i] == term_id
+
+    @property
+    def data_version(self):
+        return self.meta.get("data_version")
+
+    def index_of(self, term_id):
+        """
+        Returns the integer position of a term ID.
+
+        Raises:
+            KeyError: If the term is not in the ontology (mirrors `cl[term_id]`).
+        """
+        i = int(np.searchsorted(self.term_ids, term_id))
+        if i >= len(self.term_ids) or self.term_ids[i] != term_id:
+            raise KeyError(term_id)
+        return i
+
+    def indices_of(self, term_ids):
+        """
+        Vectorized `index_of`. Unknown terms map to -1 instead of raising.
+
+        Args:
+            term_ids (list): CL IDs to look up.
+
+        Returns:
+            np.ndarray: int64 positions, -1 where a term is missing.
+        """
+        term_ids = np.asarray(term_ids, dtype=str)
+        positions = np.searchsorted(self.term_ids, term_ids)
+        clipped = np.minimum(positions, len(self.term_ids) - 1)
+        found = self.term_ids[clipped] == term_ids
+        return np.where(found, clipped, -1).astype(np.int64)
+
+    def name(self, term_id):
+        return str(self.term_names[self.index_of(term_id)])
+
+    # --- Hierarchy queries ---
+
+    def _unpack_row(self, packed, i):
+        return np.unpackbits(packed[i], count=len(self.term_ids)).view(bool)
+
+    def _closure_ids(self, packed, term_id, with_self):
+        i = self.index_of(term_id)
+        members = np.flatnonzero(self._unpack_row(packed, i))
+        if not with_self:
+            members = members[members != i]
+        return self.term_ids[members].tolist()
+
+    def superclasses(self, term_id, with_self=True):
+        """Returns the IDs of all ancestors of `term_id` (reflexive by default, like pronto)."""
+        return self._closure_ids(self.ancestors_packed, term_id, with_self)
+
+    def subclasses(self, term_id, with_self=True):
+        """Returns the IDs of all descendants of `term_id` (reflexive by default, like pronto)."""
+        return self._closure_ids(self.descendants_packed, term_id, with_self)
+
+    def parents(self, term_id):
+        i = self.index_of(term_id)
+        return self.term_ids[self.parents_indices[self.parents_indptr[i]:self.parents_indptr[i + 1]]].tolist()
+
+    def children(self, term_id):
+        i = self.index_of(term_id)
+        return self.term_ids[self.children_indices[self.children_indptr[i]:self.children_indptr[i + 1]]].tolist()
+
+    def is_leaf(self, term_id):
+        """A term is a leaf if it has no direct subclasses (same definition as pronto)."""
+        i = self.index_of(term_id)
+        return bool(self.children_indptr[i + 1] == self.children_indptr[i])
+
+    def is_ancestor(self, ancestor_id, term_id):
+        """True if `ancestor_id` is `term_id` or one of its superclasses."""
+        i = self.index_of(term_id)
+        j = self.index_of(ancestor_id)
+        return bool(self.ancestors_packed[i, j >> 3] & (0x80 >> (j & 7)))
+
+    def leaf_mask(self, term_ids):
+        """Vectorized `is_leaf`. Terms missing from the ontology are reported as False."""
+        positions = self.indices_of(term_ids)
+        clipped = np.maximum(positions, 0)
+        n_children = self.children_indptr[clipped + 1] - self.children_indptr[clipped]
+        return (positions >= 0) & (n_children == 0)
+
+    def _closure_matrix(self, packed, row_ids, col_ids):
+        rows = self.indices_of(row_ids)
+        cols = self.indices_of(col_ids)
+        out = np.zeros((len(rows), len(cols)), dtype=bool)
+        row_ok = rows >= 0
+        col_ok = cols >= 0
+        if row_ok.any() and col_ok.any():
+            unpacked = np.unpackbits(packed[rows[row_ok]], axis=1, count=len(self.term_ids)).view(bool)
+            out[np.ix_(row_ok, col_ok)] = unpacked[:, cols[col_ok]]
+        return out
+
+    def ancestor_matrix(self, row_ids, col_ids):
+        """
+        Slices the ancestor relation down to a set of terms.
+
+        Args:
+            row_ids (list): CL IDs for the rows.
+            col_ids (list): CL IDs for the columns.
+
+        Returns:
+            np.ndarray: bool array where `[i, j]` is True if `col_ids[j]` is
+            `row_ids[i]` or one of its ancestors. Rows and columns for terms
+            missing from the ontology are all False.
+        """
+        return self._closure_matrix(self.ancestors_packed, row_ids, col_ids)
+
+    def descendant_matrix(self, row_ids, col_ids):
+        """Like `ancestor_matrix`, but `[i, j]` is True if `col_ids[j]` is `row_ids[i]` or one of its descendants."""
+        return self._closure_matrix(self.descendants_packed, row_ids, col_ids)
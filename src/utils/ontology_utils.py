@@ -1,9 +1,9 @@
 import pickle
-import pandas as pd
-import pronto
 from src.utils.paths import PROJECT_ROOT
+from src.utils.ontology_index import OntologyIndex
 
 _ontology = None
+_ontology_index = None
 
 def load_ontology():
     """
@@ -27,6 +27,27 @@ def load_ontology():
             return None
     return _ontology
 
+def load_ontology_index():
+    """
+    Memory-maps the compact ontology index written by `cache_ontology.py`.
+    Like `load_ontology`, the index is cached in memory for the session, but
+    opening it only maps the arrays, so it takes milliseconds rather than
+    unpickling the full pronto object graph.
+
+    Returns:
+        OntologyIndex: The Cell Ontology index, or None if it has not been built.
+    """
+    global _ontology_index
+    if _ontology_index is None:
+        ontology_index_path = PROJECT_ROOT / "data" / "processed" / "ontology_index"
+        try:
+            _ontology_index = OntologyIndex.load(ontology_index_path)
+        except FileNotFoundError:
+            print(f"Error: Ontology index not found at {ontology_index_path}.")
+            print("Please run `python3 src/data_pipeline/cache_ontology.py` first.")
+            return None
+    return _ontology_index
+
 def get_sub_DAG(cl, cl_number: str) -> set:
     """
     Given a CL number, returns a set of all its downstream nodes (descendants).
@@ -56,6 +77,8 @@ def get_cell_info(cl, cl_ids):
     Returns:
         pd.DataFrame: A DataFrame containing the info for the requested CL IDs.
     """
+    import pandas as pd
+
     if isinstance(cl_ids, str):
         cl_ids = [cl_ids]
 
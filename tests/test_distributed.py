@@ -0,0 +1,124 @@
+import json
+import os
+import socket
+import time
+from pathlib import Path
+
+import numpy as np
+import pytest
+import torch
+import torch.multiprocessing as mp
+
+from src.data_pipeline.artifacts import load_artifact_bundle
+from src.data_pipeline.shards import SHARD_FORMAT_VERSION, _write_shard
+from src.train.distributed import rank_cells
+
+BUNDLE_PATH = Path(__file__).resolve().parents[1] / "data" / "processed" / "2025-10-17_bundle"
+WORLD_SIZE = 3
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _write_store(path, labels, n_genes=40, shard_size=700, content_hash="", seed=0):
+    """A shard store of random counts for the given label codes, as `export_shards` lays it out."""
+    rng = np.random.default_rng(seed)
+    shards = []
+    for i, start in enumerate(range(0, len(labels), shard_size)):
+        n_cells = min(shard_size, len(labels) - start)
+        X = np.where(rng.random((n_cells, n_genes)) < 0.2, rng.integers(1, 20, (n_cells, n_genes)), 0)
+        rows, cols = np.nonzero(X)
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=n_cells))]).astype(np.int64)
+        name = f"shard_{i:05d}"
+        _write_shard(path / name, indptr, cols.astype(np.uint16), X[rows, cols].astype(np.uint16),
+                     labels[start:start + n_cells].astype(np.int32), np.arange(start, start + n_cells))
+        shards.append({"name": name, "n_cells": n_cells, "nnz": int(indptr[-1])})
+    manifest = {"format_version": SHARD_FORMAT_VERSION, "n_cells": len(labels), "n_genes": n_genes,
+                "value_dtype": "uint16", "n_clipped": 0, "feature_ids": [f"ENSG{i:011d}" for i in range(n_genes)],
+                "bundle": content_hash, "shards": shards, "metadata": {}}
+    with open(path / "manifest.json", "w") as f:
+        json.dump(manifest, f)
+
+
+def _spawn(fn, args, timeout=300):
+    """Runs `fn(rank, *args)` on WORLD_SIZE processes, failing instead of hanging if they do not finish."""
+    context = mp.spawn(fn, args=args, nprocs=WORLD_SIZE, join=False)
+    deadline = time.monotonic() + timeout
+    while not context.join(timeout=1):
+        if time.monotonic() > deadline:
+            for process in context.processes:
+                process.kill()
+            pytest.fail(f"The ranks did not finish within {timeout}s.")
+
+
+def _set_env(rank, port):
+    os.environ.update(MASTER_ADDR="127.0.0.1", MASTER_PORT=str(port), RANK=str(rank),
+                      WORLD_SIZE=str(WORLD_SIZE), LOCAL_RANK=str(rank), LOCAL_WORLD_SIZE=str(WORLD_SIZE))
+
+
+def _train_rank(rank, port, store_path, out_dir, stratified):
+    import src.train.run as run
+
+    _set_env(rank, port)
+    bundle = load_artifact_bundle(BUNDLE_PATH)
+    run.resolve_bundle = lambda **kwargs: bundle
+    model, history = run.train(shard_path=store_path, num_epochs=2, batches_per_epoch=6, batch_size=32,
+                               device="cpu", prefetch=1, grad_accum_steps=2, log_every=3, val_batches=2,
+                               stratified=stratified, block_cells=8, distributed=True)
+    torch.save({name: p.detach() for name, p in model.named_parameters()}, Path(out_dir) / f"rank{rank}.pt")
+
+
+@pytest.mark.parametrize("stratified", [False, True])
+def test_ranks_train_identical_parameters(tmp_path, stratified):
+    bundle = load_artifact_bundle(BUNDLE_PATH)
+    labels = np.random.default_rng(0).integers(0, len(bundle.terms), 2000)
+    (tmp_path / "shards").mkdir()
+    _write_store(tmp_path / "shards", labels, content_hash=bundle.content_hash)
+
+    _spawn(_train_rank, (_free_port(), str(tmp_path / "shards"), str(tmp_path), stratified))
+
+    params = [torch.load(tmp_path / f"rank{rank}.pt") for rank in range(WORLD_SIZE)]
+    for name, value in params[0].items():
+        for other in params[1:]:
+            assert torch.equal(value, other[name]), name
+
+
+def _fail_on_rank(rank, port, failing_rank, out_dir):
+    from src.train.distributed import destroy_distributed, init_distributed, main_rank_first
+
+    _set_env(rank, port)
+    init_distributed("cpu")
+    try:
+        with main_rank_first():
+            if rank == failing_rank:
+                raise FileNotFoundError("no cached bundle")
+        outcome = "passed"
+    except Exception as e:
+        outcome = type(e).__name__
+    (Path(out_dir) / f"rank{rank}.txt").write_text(outcome)
+    destroy_distributed()
+
+
+@pytest.mark.parametrize("failing_rank", [0, 2])
+def test_main_rank_first_stops_every_rank(tmp_path, failing_rank):
+    _spawn(_fail_on_rank, (_free_port(), failing_rank, str(tmp_path)), timeout=120)
+
+    outcomes = [(tmp_path / f"rank{rank}.txt").read_text() for rank in range(WORLD_SIZE)]
+    assert outcomes == ["FileNotFoundError" if rank == failing_rank else "RuntimeError" for rank in range(WORLD_SIZE)]
+
+
+def test_rank_cells_partitions_the_index():
+    labels = np.random.default_rng(0).integers(0, 40, 5000)
+    masks = np.stack([rank_cells(labels, rank, WORLD_SIZE, block_cells=16) for rank in range(WORLD_SIZE)])
+    # Every cell on exactly one rank
+    assert (masks.sum(axis=0) == 1).all()
+    for label in np.unique(labels):
+        cells = labels == label
+        # Within a label, blocks of 16 consecutive cells stay on one rank
+        owner = masks[:, cells].argmax(axis=0)
+        assert all(len(set(owner[i:i + 16])) == 1 for i in range(0, cells.sum(), 16))
+        if cells.sum() >= 16 * WORLD_SIZE:
+            assert masks[:, cells].any(axis=1).all()
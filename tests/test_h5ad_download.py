@@ -0,0 +1,106 @@
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from src.data_pipeline.h5ad_download import DownloadManifest, download_file, download_h5ads
+
+FILES = {"a.h5ad": bytes(range(256)) * 4000, "b.h5ad": b"h5ad" * 50_000}
+
+
+class _RangeHandler(BaseHTTPRequestHandler):
+    """Serves FILES with HTTP range support, like the S3 bucket; other paths are 404."""
+
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        name = self.path.rsplit("/", 1)[-1]
+        range_header = self.headers.get("Range")
+        self.requests.append((name, range_header))
+        if name not in FILES:
+            self.send_response(404)
+            self.end_headers()
+            return
+        data = FILES[name]
+        start = 0
+        if range_header:
+            start = int(range_header.split("=")[1].rstrip("-"))
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(data)}")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(data) - start))
+        self.end_headers()
+        self.wfile.write(data[start:])
+
+
+@pytest.fixture
+def server():
+    _RangeHandler.requests = []
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), _RangeHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_port}/bucket/", _RangeHandler.requests
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_resumes_from_part_file(server, tmp_path):
+    base_url, requests = server
+    path = tmp_path / "a.h5ad"
+    (tmp_path / "a.h5ad.part").write_bytes(FILES["a.h5ad"][:1000])
+
+    assert download_file(base_url + "a.h5ad", path) == len(FILES["a.h5ad"])
+    assert path.read_bytes() == FILES["a.h5ad"]
+    assert not (tmp_path / "a.h5ad.part").exists()
+    assert requests == [("a.h5ad", "bytes=1000-")]
+
+
+def test_oversized_part_file_restarts_download(server, tmp_path):
+    base_url, requests = server
+    path = tmp_path / "b.h5ad"
+    (tmp_path / "b.h5ad.part").write_bytes(b"x" * (len(FILES["b.h5ad"]) + 10))
+
+    download_file(base_url + "b.h5ad", path)
+    assert path.read_bytes() == FILES["b.h5ad"]
+    assert requests == [("b.h5ad", f"bytes={len(FILES['b.h5ad']) + 10}-"), ("b.h5ad", None)]
+
+
+def test_missing_file_is_marked_failed_without_retries(server, tmp_path):
+    base_url, requests = server
+    manifest = DownloadManifest(tmp_path / "manifest.json")
+    for dataset_id in ("a", "missing"):
+        manifest.update(dataset_id, uri=base_url + f"{dataset_id}.h5ad", url=base_url + f"{dataset_id}.h5ad",
+                        status="resolved")
+
+    assert download_h5ads(manifest, tmp_path / "h5ad", workers=2, retries=3) == ["missing"]
+    # 404 is permanent, so it is requested once
+    assert [name for name, _ in requests].count("missing.h5ad") == 1
+    entries = DownloadManifest(tmp_path / "manifest.json").entries
+    assert entries["missing"]["status"] == "failed" and "404" in entries["missing"]["error"]
+    assert entries["a"]["status"] == "complete"
+    assert entries["a"]["sha256"] == hashlib.sha256(FILES["a.h5ad"]).hexdigest()
+
+
+def test_rerun_skips_complete_files(server, tmp_path):
+    base_url, requests = server
+    manifest = DownloadManifest(tmp_path / "manifest.json")
+    for dataset_id in ("a", "b"):
+        manifest.update(dataset_id, uri=base_url + f"{dataset_id}.h5ad", url=base_url + f"{dataset_id}.h5ad",
+                        status="resolved")
+    assert download_h5ads(manifest, tmp_path / "h5ad", workers=2) == []
+    n_requests = len(requests)
+
+    manifest = DownloadManifest(tmp_path / "manifest.json")
+    assert download_h5ads(manifest, tmp_path / "h5ad", workers=2, verify=True) == []
+    assert len(requests) == n_requests
+    assert (tmp_path / "h5ad" / "b.h5ad").read_bytes() == FILES["b.h5ad"]